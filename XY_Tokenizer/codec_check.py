@@ -0,0 +1,109 @@
+import argparse
+import logging
+import torch
+
+from utils.helpers import set_logging, load_audio, find_audio_files
+from xy_tokenizer.model import XY_Tokenizer
+
+
+def code_agreement(ref_codes_list, codes_list):
+    """Fraction of (level, frame) positions where the codes match the reference # B * (nq, T)"""
+    matched, total = 0, 0
+    for ref_codes, codes in zip(ref_codes_list, codes_list):
+        length = min(ref_codes.shape[-1], codes.shape[-1])
+        matched += (ref_codes[:, :length] == codes[:, :length]).sum().item()
+        total += ref_codes.shape[0] * max(ref_codes.shape[-1], codes.shape[-1])
+    return matched / max(total, 1)
+
+
+def spectral_distance(ref_wav_list, wav_list, n_fft=1024, hop_length=256):
+    """Mean L1 distance between log-magnitude spectrograms # B * (T,)"""
+    distances = []
+    for ref_wav, wav in zip(ref_wav_list, wav_list):
+        length = min(ref_wav.shape[-1], wav.shape[-1])
+        if length < n_fft:
+            continue
+        window = torch.hann_window(n_fft, device=ref_wav.device)
+        ref_spec = torch.stft(ref_wav[:length].float(), n_fft, hop_length, window=window, return_complex=True).abs()
+        spec = torch.stft(wav[:length].float(), n_fft, hop_length, window=window, return_complex=True).abs()
+        distances.append((torch.log(ref_spec + 1e-5) - torch.log(spec + 1e-5)).abs().mean().item())
+    return sum(distances) / max(len(distances), 1)
+
+
+def waveform_snr(ref_wav_list, wav_list):
+    """Mean SNR in dB of the waveforms against the reference # B * (T,)"""
+    snrs = []
+    for ref_wav, wav in zip(ref_wav_list, wav_list):
+        length = min(ref_wav.shape[-1], wav.shape[-1])
+        noise = (ref_wav[:length].float() - wav[:length].float()).pow(2).sum()
+        signal = ref_wav[:length].float().pow(2).sum()
+        snrs.append((10 * torch.log10(signal / (noise + 1e-10) + 1e-10)).item())
+    return sum(snrs) / max(len(snrs), 1)
+
+
+if __name__ == "__main__":
+    set_logging()
+
+    parser = argparse.ArgumentParser(description="Compare codec outputs of a cheaper configuration against the reference one")
+    parser.add_argument("--config_path", type=str, default="./config/xy_tokenizer_config.yaml")
+    parser.add_argument("--checkpoint_path", type=str, default="./weights/xy_tokenizer.ckpt")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--input_dir", type=str, required=True, help="Reference set of audio files")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--mode", type=str, default="overlap", choices=["overlap", "precision"],
+        help="overlap: reduced overlap against 10 seconds, precision: reduced precision against fp32",
+    )
+
+    parser.add_argument("--overlap_seconds", type=float, default=2, help="Overlap under test in overlap mode")
+    parser.add_argument("--overlap_mode", type=str, default="center", choices=["tail", "center"])
+    parser.add_argument("--crossfade_seconds", type=float, default=1.0)
+    parser.add_argument("--precision", type=str, default="bf16", choices=["bf16", "fp16", "int8"], help="Precision under test in precision mode")
+    parser.add_argument("--min_code_agreement", type=float, default=None, help="Fail if the code agreement is below this value")
+    parser.add_argument("--max_spectral_distance", type=float, default=None, help="Fail if the spectral distance is above this value")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    generator = XY_Tokenizer.load_from_checkpoint(config_path=args.config_path, ckpt_path=args.checkpoint_path).to(device).eval()
+    if args.mode == "precision":
+        candidate = XY_Tokenizer.load_from_checkpoint(config_path=args.config_path, ckpt_path=args.checkpoint_path).to(device).eval()
+        candidate.set_precision(args.precision)
+        logging.info(f"Comparing {args.precision} against fp32")
+    else:
+        candidate = generator
+        logging.info(f"Comparing overlap {args.overlap_seconds}s ({args.overlap_mode}, crossfade {args.crossfade_seconds}s) against 10s")
+    audio_paths = find_audio_files(input_dir=args.input_dir)
+    logging.info(f"Reference set: {len(audio_paths)} files")
+
+    ref_codes_all, codes_all, ref_wav_all, wav_all = [], [], [], []
+    with torch.no_grad():
+        for i in range(0, len(audio_paths), args.batch_size):
+            batch_paths = audio_paths[i:i + args.batch_size]
+            wav_list = [load_audio(path, target_sample_rate=generator.input_sample_rate).squeeze().to(device) for path in batch_paths]
+
+            ref_codes_list = generator.encode(wav_list, overlap_seconds=10, device=device)["codes_list"]
+            ref_wav_list = generator.decode(ref_codes_list, overlap_seconds=10, device=device)["syn_wav_list"]
+
+            # Decode the same reference codes so that only the decoder configuration differs
+            if args.mode == "precision":
+                codes_list = candidate.encode(wav_list, overlap_seconds=10, device=device)["codes_list"]
+                wav_list = candidate.decode(ref_codes_list, overlap_seconds=10, device=device)["syn_wav_list"]
+            else:
+                codes_list = candidate.encode(wav_list, overlap_seconds=args.overlap_seconds, device=device, overlap_mode=args.overlap_mode)["codes_list"]
+                wav_list = candidate.decode(ref_codes_list, overlap_seconds=args.overlap_seconds, device=device, crossfade_seconds=args.crossfade_seconds)["syn_wav_list"]
+
+            ref_codes_all.extend(ref_codes_list)
+            codes_all.extend(codes_list)
+            ref_wav_all.extend(ref_wav_list)
+            wav_all.extend(wav_list)
+
+    agreement = code_agreement(ref_codes_all, codes_all)
+    distance = spectral_distance(ref_wav_all, wav_all)
+    snr = waveform_snr(ref_wav_all, wav_all)
+    logging.info(f"Encode code agreement: {agreement:.4f}")
+    logging.info(f"Decode spectral distance: {distance:.4f}, waveform SNR: {snr:.2f} dB")
+
+    failed = (args.min_code_agreement is not None and agreement < args.min_code_agreement) or \
+        (args.max_spectral_distance is not None and distance > args.max_spectral_distance)
+    if failed:
+        raise SystemExit("Codec check failed")
+    logging.info("Codec check passed")
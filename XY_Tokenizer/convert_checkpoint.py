@@ -0,0 +1,18 @@
+import os
+import argparse
+import logging
+
+from utils.helpers import set_logging
+from xy_tokenizer.model import XY_Tokenizer
+
+if __name__ == "__main__":
+    set_logging()
+
+    parser = argparse.ArgumentParser(description="Convert the codec checkpoint to a generator-only safetensors file")
+    parser.add_argument("--checkpoint_path", type=str, default="./weights/xy_tokenizer.ckpt")
+    parser.add_argument("--output_path", type=str, default=None, help="Defaults to the checkpoint path with a .safetensors extension")
+    args = parser.parse_args()
+
+    output_path = args.output_path or os.path.splitext(args.checkpoint_path)[0] + ".safetensors"
+    XY_Tokenizer.convert_checkpoint(args.checkpoint_path, output_path)
+    logging.info(f"Saved generator weights to {output_path}")
@@ -1,11 +1,121 @@
 import os
+import sys
 import argparse
 import logging
+import numpy as np
 import torch
+import torchaudio
+from concurrent.futures import ProcessPoolExecutor
 
 from utils.helpers import set_logging, waiting_for_debug, load_audio, save_audio, find_audio_files
 from xy_tokenizer.model import XY_Tokenizer
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from speech_codes import CodeStore
+
+
+def _init_corpus_worker():
+    # Each loader process resamples on a single thread, the pool provides the parallelism
+    torch.set_num_threads(1)
+
+
+def _load_corpus_audio(path, sample_rate):
+    return load_audio(path, target_sample_rate=sample_rate).squeeze().numpy()
+
+
+def get_audio_duration(path):
+    info = torchaudio.info(path)
+    return info.num_frames / info.sample_rate
+
+
+def make_duration_batches(audio_paths, durations, max_batch_seconds, max_batch_size):
+    """Sort files by duration (longest first) and group them so that the padded batch stays under max_batch_seconds"""
+    order = sorted(range(len(audio_paths)), key=lambda i: durations[i], reverse=True)
+    batches, batch = [], []
+    for i in order:
+        # The first file of a batch is its longest one, it sets the padded length
+        padded_seconds = (durations[batch[0]] if batch else durations[i]) * (len(batch) + 1)
+        if batch and (padded_seconds > max_batch_seconds or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return [[audio_paths[i] for i in batch] for batch in batches]
+
+
+def _probe_duration(path):
+    """(duration, None), or (None, error) for an unreadable file"""
+    try:
+        return get_audio_duration(path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def tokenize_corpus(generator, audio_paths, args, device):
+    """Encode a corpus into a speech_codes.CodeStore in output_dir, one entry per file keyed by its path
+
+    The store is the same memory-mappable uint16 format as the rest of the project (finetune packs, prompt
+    code cache, inference.py --codes_only). Every entry is appended data first, index line last, so an
+    interrupted run resumes from the files missing in the index. Unreadable files are logged and recorded
+    as empty entries with a "failed" metadata field instead of aborting the run; --retry_failed retries them.
+    """
+    store = CodeStore(args.output_dir, channels=generator.nq)
+    completed = {key for key in store.keys() if key is not None and
+                 not (args.retry_failed and store.metadata(store.find(key)).get("failed"))}
+    audio_paths = [path for path in audio_paths if path not in completed]
+    logging.info(f"Skipping {len(completed)} already tokenized files, {len(audio_paths)} remaining")
+    if not audio_paths:
+        return
+
+    failed = 0
+
+    def record_failure(path, error):
+        nonlocal failed
+        logging.error(f"Skipping {path}: {error}")
+        store.append(np.zeros((0, store.channels), dtype=np.uint16), key=path, metadata={"failed": error})
+        failed += 1
+
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_corpus_worker) as executor:
+        readable_paths, durations = [], []
+        for path, (duration, error) in zip(audio_paths, executor.map(_probe_duration, audio_paths, chunksize=64)):
+            if error is not None:
+                record_failure(path, error)
+            else:
+                readable_paths.append(path)
+                durations.append(duration)
+        batches = make_duration_batches(readable_paths, durations, args.max_batch_seconds, args.max_batch_size)
+        logging.info(f"Tokenizing {sum(durations) / 3600:.2f} hours in {len(batches)} batches")
+
+        def submit(batch_paths):
+            return [executor.submit(_load_corpus_audio, path, generator.input_sample_rate) for path in batch_paths]
+
+        # Keep prefetch_batches batches of audio loading ahead of the codec
+        futures = [submit(batch_paths) for batch_paths in batches[:args.prefetch_batches]]
+        for batch_idx, batch_paths in enumerate(batches):
+            loaded_paths, wav_list = [], []
+            for path, future in zip(batch_paths, futures.pop(0)):
+                try:
+                    wav_list.append(torch.from_numpy(future.result()).to(device))
+                    loaded_paths.append(path)
+                except Exception as e:
+                    record_failure(path, str(e))
+            if batch_idx + args.prefetch_batches < len(batches):
+                futures.append(submit(batches[batch_idx + args.prefetch_batches]))
+            if not wav_list:
+                continue
+
+            codes_list = generator.encode(wav_list, overlap_seconds=args.overlap_seconds, device=device)["codes_list"] # B * (nq, T)
+            for path, codes in zip(loaded_paths, codes_list):
+                store.append(codes.permute(1, 0), key=path) # (T, nq) uint16
+            store.sync()
+            logging.info(f"Encoded batch {batch_idx + 1}/{len(batches)} ({len(loaded_paths)} files)")
+    store.sync()
+    store.close()
+    if failed:
+        logging.warning(f"{failed} files could not be read, recorded as failed in {store.path}")
+
+
 if __name__ == "__main__":
     set_logging()
     
@@ -16,6 +126,15 @@ if __name__ == "__main__":
     
     parser.add_argument("--input_dir", type=str, required=True)
     parser.add_argument("--output_dir", type=str, required=True)
+
+    # Corpus mode: encode only, write codes to shards, resume after interruption
+    parser.add_argument("--corpus_mode", action="store_true", help="Encode only and append codes to a code store with an index")
+    parser.add_argument("--num_workers", type=int, default=8, help="Audio loading and resampling processes")
+    parser.add_argument("--max_batch_seconds", type=float, default=600, help="Maximum padded audio seconds per batch")
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--prefetch_batches", type=int, default=2)
+    parser.add_argument("--retry_failed", action="store_true", help="Retry files recorded as unreadable by an earlier run")
+    parser.add_argument("--overlap_seconds", type=float, default=10)
     
     
     parser.add_argument("--debug_ip", type=str)
@@ -30,7 +149,8 @@ if __name__ == "__main__":
     device = torch.device(args.device)
 
     ## Load codec model
-    generator = XY_Tokenizer.load_from_checkpoint(config_path=args.config_path, ckpt_path=args.checkpoint_path).to(device).eval()
+    parts = ("encoder",) if args.corpus_mode else ("encoder", "decoder")
+    generator = XY_Tokenizer.load_from_checkpoint(config_path=args.config_path, ckpt_path=args.checkpoint_path, parts=parts).to(device).eval()
     
     ## Find audios
     audio_paths = find_audio_files(input_dir=args.input_dir)
@@ -39,33 +159,36 @@ if __name__ == "__main__":
     os.makedirs(args.output_dir, exist_ok=True)
     logging.info(f"Processing {len(audio_paths)} audio files, output will be saved to {args.output_dir}")
 
-    with torch.no_grad():
-        ## Process audios in batches
-        batch_size = 8
-        for i in range(0, len(audio_paths), batch_size):
-            batch_paths = audio_paths[i:i + batch_size]
-            logging.info(f"Processing batch {i // batch_size + 1}/{len(audio_paths) // batch_size + 1}, files: {batch_paths}")
-
-            # Load audio files
-            wav_list = [load_audio(path, target_sample_rate=generator.input_sample_rate).squeeze().to(device) for path in batch_paths]
-            logging.info(f"Successfully loaded {len(wav_list)} audio files with lengths {[len(wav) for wav in wav_list]} samples")
-
-            # Encode
-            encode_result = generator.encode(wav_list, overlap_seconds=10)
-            codes_list = encode_result["codes_list"]  # B * (nq, T)
-            logging.info(f"Encoding completed, code lengths: {[codes.shape[-1] for codes in codes_list]}")
-            logging.info(f"{codes_list = }")
-
-            # Decode
-            decode_result = generator.decode(codes_list, overlap_seconds=10)
-            syn_wav_list = decode_result["syn_wav_list"]  # B * (T,)
-            logging.info(f"Decoding completed, generated waveform lengths: {[len(wav) for wav in syn_wav_list]} samples")
-
-            # Save generated audios
-            for path, syn_wav in zip(batch_paths, syn_wav_list):
-                output_path = os.path.join(args.output_dir, os.path.basename(path))
-                save_audio(output_path, syn_wav.cpu().reshape(1, -1), sample_rate=generator.output_sample_rate)
-                logging.info(f"Saved generated audio to {output_path}")
-
-        
+    if args.corpus_mode:
+        with torch.no_grad():
+            tokenize_corpus(generator, audio_paths, args, device)
+    else:
+        with torch.no_grad():
+            ## Process audios in batches
+            batch_size = 8
+            for i in range(0, len(audio_paths), batch_size):
+                batch_paths = audio_paths[i:i + batch_size]
+                logging.info(f"Processing batch {i // batch_size + 1}/{len(audio_paths) // batch_size + 1}, files: {batch_paths}")
+
+                # Load audio files
+                wav_list = [load_audio(path, target_sample_rate=generator.input_sample_rate).squeeze().to(device) for path in batch_paths]
+                logging.info(f"Successfully loaded {len(wav_list)} audio files with lengths {[len(wav) for wav in wav_list]} samples")
+
+                # Encode
+                encode_result = generator.encode(wav_list, overlap_seconds=args.overlap_seconds, device=device)
+                codes_list = encode_result["codes_list"]  # B * (nq, T)
+                logging.info(f"Encoding completed, code lengths: {[codes.shape[-1] for codes in codes_list]}")
+                logging.info(f"{codes_list = }")
+
+                # Decode
+                decode_result = generator.decode(codes_list, overlap_seconds=args.overlap_seconds, device=device)
+                syn_wav_list = decode_result["syn_wav_list"]  # B * (T,)
+                logging.info(f"Decoding completed, generated waveform lengths: {[len(wav) for wav in syn_wav_list]} samples")
+
+                # Save generated audios
+                for path, syn_wav in zip(batch_paths, syn_wav_list):
+                    output_path = os.path.join(args.output_dir, os.path.basename(path))
+                    save_audio(output_path, syn_wav.cpu().reshape(1, -1), sample_rate=generator.output_sample_rate)
+                    logging.info(f"Saved generated audio to {output_path}")
+
     logging.info("All audio processing completed")
\ No newline at end of file
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
 import yaml
+import contextlib
 import logging
 import torch
 import torch.nn as nn
@@ -11,8 +13,22 @@ from .nn.modules import OmniAudioEncoder, OmniAudioDecoder, ResidualDownConv, Up
 from .nn.quantizer import ResidualVQ
 
 class XY_Tokenizer(nn.Module):
-    def __init__(self, generator_params):
+    # Submodules needed by each part of the codec, the quantizer is shared
+    PART_MODULES = {
+        "encoder": ("semantic_encoder", "semantic_encoder_adapter", "acoustic_encoder", "pre_rvq_adapter", "downsample", "quantizer"),
+        "decoder": ("quantizer", "post_rvq_adapter", "upsample", "acoustic_decoder", "enhanced_vocos"),
+    }
+
+    def __init__(self, generator_params, parts=("encoder", "decoder")):
         super().__init__()
+        unknown_parts = set(parts) - set(self.PART_MODULES)
+        if unknown_parts:
+            raise ValueError(f"Unknown codec parts: {sorted(unknown_parts)}")
+        self.parts = frozenset(parts)
+        self.precision = "fp32" # See set_precision
+        has_encoder = "encoder" in self.parts
+        has_decoder = "decoder" in self.parts
+
         # Basic parameters
         self.input_sample_rate = generator_params['input_sample_rate']
         self.output_sample_rate = generator_params['output_sample_rate']
@@ -24,32 +40,75 @@ class XY_Tokenizer(nn.Module):
         ## Codec part
 
         ## Semantic channel
-        self.semantic_encoder = OmniAudioEncoder(**generator_params['semantic_encoder_kwargs'])
+        self.semantic_encoder = OmniAudioEncoder(**generator_params['semantic_encoder_kwargs']) if has_encoder else None
         
-        self.semantic_encoder_adapter = Transformer(**generator_params['semantic_encoder_adapter_kwargs'])
+        self.semantic_encoder_adapter = Transformer(**generator_params['semantic_encoder_adapter_kwargs']) if has_encoder else None
         
         ## Acoustic channel
-        self.acoustic_encoder = OmniAudioEncoder(**generator_params['acoustic_encoder_kwargs'])
+        self.acoustic_encoder = OmniAudioEncoder(**generator_params['acoustic_encoder_kwargs']) if has_encoder else None
         
         ## Semantic & acoustic shared parameters
-        self.pre_rvq_adapter = Transformer(**generator_params['pre_rvq_adapter_kwargs'])
+        self.pre_rvq_adapter = Transformer(**generator_params['pre_rvq_adapter_kwargs']) if has_encoder else None
         
-        self.downsample = ResidualDownConv(**generator_params['downsample_kwargs'])
+        self.downsample = ResidualDownConv(**generator_params['downsample_kwargs']) if has_encoder else None
         
         self.quantizer = ResidualVQ(**generator_params['quantizer_kwargs'])
         self.nq = generator_params['quantizer_kwargs']['num_quantizers']
+        self.codebook_size = generator_params['quantizer_kwargs']['codebook_size']
+        self.register_buffer('dequant_tables', None, persistent=False) # Optional (nq, codebook_size, D) lookup tables, see build_dequant_tables
+        self.register_buffer('dequant_bias', None, persistent=False) # Optional (D,) constant term of the lookup tables
 
-        self.post_rvq_adapter = Transformer(**generator_params['post_rvq_adapter_kwargs'])
+        self.post_rvq_adapter = Transformer(**generator_params['post_rvq_adapter_kwargs']) if has_decoder else None
                     
         ## Acoustic channel
-        self.upsample = UpConv(**generator_params['upsample_kwargs'])
+        self.upsample = UpConv(**generator_params['upsample_kwargs']) if has_decoder else None
 
-        self.acoustic_decoder = OmniAudioDecoder(**generator_params['acoustic_decoder_kwargs'])
+        self.acoustic_decoder = OmniAudioDecoder(**generator_params['acoustic_decoder_kwargs']) if has_decoder else None
 
-        self.enhanced_vocos = Vocos(**generator_params['vocos_kwargs'])
+        self.enhanced_vocos = Vocos(**generator_params['vocos_kwargs']) if has_decoder else None
 
         ## Feature extractor
-        self.feature_extractor = MelFeatureExtractor(**generator_params['feature_extractor_kwargs'])
+        self.feature_extractor = MelFeatureExtractor(**generator_params['feature_extractor_kwargs']) if has_encoder else None
+
+    PRECISIONS = ("fp32", "bf16", "fp16", "int8")
+
+    def set_precision(self, precision):
+        """
+            Select the inference precision of the codec
+            Input:
+                precision: One of
+                    "fp32": full precision
+                    "bf16" / "fp16": the encoder and decoder stacks run under autocast, the RVQ stays in fp32
+                    "int8": dynamic int8 quantization of the Linear layers of the encoders, adapters, acoustic decoder
+                        and Vocos, CPU only and not reversible
+        """
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unsupported codec precision: {precision}, expected one of {self.PRECISIONS}")
+        if self.precision == "int8" and precision != "int8":
+            raise RuntimeError("Codec layers were already quantized to int8")
+
+        if precision == "int8" and self.precision != "int8":
+            if any(p.device.type != "cpu" for p in self.parameters()):
+                raise RuntimeError("int8 codec inference is only supported on CPU")
+            for name in ("semantic_encoder", "semantic_encoder_adapter", "acoustic_encoder", "pre_rvq_adapter",
+                         "post_rvq_adapter", "acoustic_decoder", "enhanced_vocos"):
+                module = getattr(self, name)
+                if module is not None:
+                    setattr(self, name, torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8))
+        self.precision = precision
+        return self
+
+    def _autocast(self, device):
+        # Autocast context for the reduced-precision modes
+        if self.precision == "bf16":
+            return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+        if self.precision == "fp16":
+            return torch.autocast(device_type=device.type, dtype=torch.float16)
+        return contextlib.nullcontext()
+
+    def _check_part(self, part):
+        if part not in self.parts:
+            raise RuntimeError(f"XY_Tokenizer was loaded without the {part} (parts={sorted(self.parts)})")
 
     @torch.inference_mode()
     def inference_tokenize(self, x, input_lengths):
@@ -63,6 +122,7 @@ class XY_Tokenizer(nn.Module):
                     "codes": Quantization codes # (nq, B, T)
                     "codes_lengths": Quantization code lengths # (B,)
         """
+        self._check_part("encoder")
         list_x = [xi[:, :x_len].reshape(-1).cpu().numpy() for xi, x_len in zip(x, input_lengths)]
         features = self.feature_extractor(
             list_x,
@@ -73,26 +133,28 @@ class XY_Tokenizer(nn.Module):
         input_mel = features['input_features'].to(x.device).to(x.dtype) # (B, D, 3000)
         audio_attention_mask = features['attention_mask'].to(x.device) # (B, 3000)
         
-        # Get batch size and sequence length of the input
-        mel_output_length = torch.sum(audio_attention_mask, dim=-1).long() # (B,)
-        
-        # Semantic channel
-        semantic_encoder_output, semantic_encoder_output_length = self.semantic_encoder(input_mel, mel_output_length) # (B, D, T), 100hz -> 50hz
-        
-        semantic_encoder_adapter_output, semantic_encoder_adapter_output_length = self.semantic_encoder_adapter(semantic_encoder_output, semantic_encoder_output_length) # (B, D, T), 50hz
-        
-        # Acoustic channel
-        acoustic_encoder_output, acoustic_encoder_output_length = self.acoustic_encoder(input_mel, mel_output_length) # (B, D, T), 100hz -> 50hz
-        
-        # Semantic & acoustic mixing
-        concated_semantic_acoustic_channel = torch.concat([semantic_encoder_adapter_output, acoustic_encoder_output], dim=1) # (B, D, T)
-        concated_semantic_acoustic_channel_length = acoustic_encoder_output_length
-        
-        pre_rvq_adapter_output, pre_rvq_adapter_output_length = self.pre_rvq_adapter(concated_semantic_acoustic_channel, concated_semantic_acoustic_channel_length) # (B, D, T), 50hz
-        
-        downsample_output, downsample_output_length = self.downsample(pre_rvq_adapter_output, pre_rvq_adapter_output_length) # (B, D, T), 50hz -> 12.5hz
+        with self._autocast(x.device):
+            # Get batch size and sequence length of the input
+            mel_output_length = torch.sum(audio_attention_mask, dim=-1).long() # (B,)
+            
+            # Semantic channel
+            semantic_encoder_output, semantic_encoder_output_length = self.semantic_encoder(input_mel, mel_output_length) # (B, D, T), 100hz -> 50hz
+            
+            semantic_encoder_adapter_output, semantic_encoder_adapter_output_length = self.semantic_encoder_adapter(semantic_encoder_output, semantic_encoder_output_length) # (B, D, T), 50hz
+            
+            # Acoustic channel
+            acoustic_encoder_output, acoustic_encoder_output_length = self.acoustic_encoder(input_mel, mel_output_length) # (B, D, T), 100hz -> 50hz
+            
+            # Semantic & acoustic mixing
+            concated_semantic_acoustic_channel = torch.concat([semantic_encoder_adapter_output, acoustic_encoder_output], dim=1) # (B, D, T)
+            concated_semantic_acoustic_channel_length = acoustic_encoder_output_length
+            
+            pre_rvq_adapter_output, pre_rvq_adapter_output_length = self.pre_rvq_adapter(concated_semantic_acoustic_channel, concated_semantic_acoustic_channel_length) # (B, D, T), 50hz
+            
+            downsample_output, downsample_output_length = self.downsample(pre_rvq_adapter_output, pre_rvq_adapter_output_length) # (B, D, T), 50hz -> 12.5hz
 
-        zq, codes, vq_loss, _, quantizer_output_length = self.quantizer(downsample_output, downsample_output_length) # (B, D, T), (nq, B, T), (nq,), (nq, B, D, T), (B,)
+        # Nearest-codebook search stays in fp32
+        zq, codes, vq_loss, _, quantizer_output_length = self.quantizer(downsample_output.float(), downsample_output_length) # (B, D, T), (nq, B, T), (nq,), (nq, B, D, T), (B,)
 
         return {
             "zq": zq, # (B, D, T)
@@ -111,36 +173,99 @@ class XY_Tokenizer(nn.Module):
                     "y": Synthesized audio waveform # (B, 1, T)
                     "output_length": Output lengths # (B,)
         """
-        zq = self.quantizer.decode_codes(codes) # (B, D, T)
+        self._check_part("decoder")
+        zq = self.decode_codes(codes) # (B, D, T)
         
-        post_rvq_adapter_output, post_rvq_adapter_output_length = self.post_rvq_adapter(zq, codes_lengths) # (B, D, T), 12.5hz
-        
-        # Acoustic channel            
-        upsample_output, upsample_output_length = self.upsample(post_rvq_adapter_output, post_rvq_adapter_output_length) # (B, D, T), 12.5hz -> 50hz
+        with self._autocast(zq.device):
+            post_rvq_adapter_output, post_rvq_adapter_output_length = self.post_rvq_adapter(zq, codes_lengths) # (B, D, T), 12.5hz
+            
+            # Acoustic channel            
+            upsample_output, upsample_output_length = self.upsample(post_rvq_adapter_output, post_rvq_adapter_output_length) # (B, D, T), 12.5hz -> 50hz
 
-        acoustic_decoder_output, acoustic_decoder_output_length = self.acoustic_decoder(upsample_output, upsample_output_length) # (B, D, T), 50hz -> 100hz
+            acoustic_decoder_output, acoustic_decoder_output_length = self.acoustic_decoder(upsample_output, upsample_output_length) # (B, D, T), 50hz -> 100hz
+
+            y, vocos_output_length = self.enhanced_vocos(acoustic_decoder_output, acoustic_decoder_output_length) # (B, 1, T), 100hz -> 16khz
+        y = y.float()
 
-        y, vocos_output_length = self.enhanced_vocos(acoustic_decoder_output, acoustic_decoder_output_length) # (B, 1, T), 100hz -> 16khz
-        
         return {
             "y": y, # (B, 1, T)
             "output_length": vocos_output_length, # (B,)
         }
         
+    def decode_codes(self, codes):
+        """
+            Dequantize codes, using the precomputed lookup tables when available
+            Input:
+                codes: Quantization codes # (nq, B, T)
+            Output:
+                zq: Quantized embeddings # (B, D, T)
+        """
+        if self.dequant_tables is None:
+            return self.quantizer.decode_codes(codes)
+
+        zq = self.dequant_bias.float()[None, :, None].expand(codes.shape[1], -1, codes.shape[2]).clone() # (B, D, T)
+        for i in range(codes.shape[0]):
+            zq += F.embedding(codes[i], self.dequant_tables[i]).transpose(1, 2).float() # (B, D, T)
+        return zq
+
+    @torch.no_grad()
+    def build_dequant_tables(self, dtype=torch.float16, cache_path=None, source_path=None):
+        """
+            Precompute one (codebook_size, D) table per quantizer level, so that decode_codes becomes nq gathers and a sum.
+            The RVQ output is the sum of the per-level codebook entries followed by a linear projection,
+            so each table row is decode_codes with only that level set, minus the all-zero output.
+            Input:
+                dtype: Storage dtype of the tables
+                cache_path: Optional file to load the tables from, or to save them to after building
+                source_path: Checkpoint the tables were built from, a cache older than it is rebuilt
+        """
+        cache_valid = cache_path is not None and os.path.exists(cache_path) and \
+            (source_path is None or os.path.getmtime(cache_path) >= os.path.getmtime(source_path))
+        if cache_valid:
+            cache = torch.load(cache_path, map_location='cpu')
+            tables, bias = cache['tables'], cache['bias']
+            logging.info(f"Loaded dequantization tables from {cache_path}")
+        else:
+            device = next(self.quantizer.parameters()).device
+            probe = torch.zeros(self.nq, 1, self.codebook_size, dtype=torch.long, device=device) # (nq, 1, K)
+            bias = self.quantizer.decode_codes(probe)[0, :, 0].float() # (D,)
+            tables = []
+            for i in range(self.nq):
+                probe.zero_()
+                probe[i, 0] = torch.arange(self.codebook_size, device=device)
+                tables.append(self.quantizer.decode_codes(probe)[0].transpose(0, 1).float() - bias) # (K, D)
+            tables = torch.stack(tables).cpu() # (nq, K, D)
+            bias = bias.cpu()
+            if cache_path is not None:
+                torch.save({'tables': tables.to(dtype), 'bias': bias}, cache_path)
+                logging.info(f"Saved dequantization tables to {cache_path}")
+
+        device = next(self.quantizer.parameters()).device
+        self.dequant_tables = tables.to(device=device, dtype=dtype)
+        self.dequant_bias = bias.to(device=device)
+
     @torch.inference_mode()
-    def encode(self, wav_list, overlap_seconds=10, device=torch.device("cuda")):
+    def encode(self, wav_list, overlap_seconds=10, device=torch.device("cuda"), overlap_mode="tail"):
         """
             Input:
                 wav_list: List of audio waveforms, each with potentially different length, may exceed 30 seconds # B * (T,)
                 overlap_seconds: Overlap in seconds, process 30 seconds at a time, keeping (30 - overlap_seconds) seconds of valid output
+                overlap_mode: How the overlap is used as context for the kept codes
+                    "tail": the whole overlap is right context, codes are kept from the start of each window
+                    "center": the overlap is split into left and right context, codes are kept from the middle of each window
             Output:
                 dict: Contains the following key-value pairs
                     "codes_list": List of quantization codes # B * (nq, T)
         """
-        duration_seconds = 30 - overlap_seconds
-        chunk_size = int(30 * self.input_sample_rate) # Maximum samples per chunk
-        duration_size = int(duration_seconds * self.input_sample_rate) # Valid output samples per chunk
-        code_duration_length = duration_size // self.encoder_downsample_rate # Valid code length per chunk
+        if overlap_mode not in ("tail", "center"):
+            raise ValueError(f"Unsupported overlap_mode: {overlap_mode}")
+
+        chunk_code_length = int(30 * self.input_sample_rate // self.encoder_downsample_rate) # Maximum code length per chunk
+        overlap_code_length = int(overlap_seconds * self.input_sample_rate // self.encoder_downsample_rate) # Overlapped code length between chunks
+        duration_code_length = chunk_code_length - overlap_code_length # Valid code length per chunk
+        left_context_length = overlap_code_length // 2 if overlap_mode == "center" else 0 # Codes discarded at the start of each chunk but the first
+        chunk_size = chunk_code_length * self.encoder_downsample_rate # Maximum samples per chunk
+        duration_size = duration_code_length * self.encoder_downsample_rate # Stride in samples between chunks
 
         # Get maximum waveform length
         max_length = max(len(wav) for wav in wav_list)
@@ -151,13 +276,20 @@ class XY_Tokenizer(nn.Module):
             wav_tensor[i, 0, :len(wav)] = wav
             input_lengths[i] = len(wav) # (B,)
 
-        # Calculate number of chunks needed
-        max_chunks = (max_length + duration_size - 1) // duration_size
-        codes_list = []
+        max_code_length = max_length // self.encoder_downsample_rate
+        codes_tensor = torch.zeros(self.nq, batch_size, max_code_length, device=device, dtype=torch.long)
 
         # Process the entire batch in chunks
-        for chunk_idx in range(max_chunks):
-            start = chunk_idx * duration_size
+        chunk_idx = 0
+        while True:
+            keep_start = left_context_length if chunk_idx > 0 else 0 # Local start of the kept codes
+            keep_length = duration_code_length + left_context_length - keep_start # Local length of the kept codes
+            code_start = chunk_idx * duration_code_length # Global code index of the chunk start
+            if code_start + keep_start >= max_code_length:
+                break
+            chunk_idx += 1
+
+            start = code_start * self.encoder_downsample_rate
             end = min(start + chunk_size, max_length)
             chunk = wav_tensor[:, :, start:end] # (B, 1, T')
             chunk_lengths = torch.clamp(input_lengths - start, 0, end - start) # (B,)
@@ -172,39 +304,38 @@ class XY_Tokenizer(nn.Module):
             chunk_code_lengths = result["codes_lengths"] # (B,)
 
             # Extract valid portion
-            valid_code_lengths = torch.clamp(chunk_code_lengths, 0, code_duration_length) # (B,)
-            valid_chunk_codes = torch.zeros(self.nq, batch_size, code_duration_length, device=device, dtype=chunk_codes.dtype)
-            for b in range(batch_size):
-                if valid_code_lengths[b] > 0:
-                    valid_chunk_codes[:, b, :valid_code_lengths[b]] = chunk_codes[:, b, :valid_code_lengths[b]] # (nq, B, valid_code_length)
-
-            codes_list.append(valid_chunk_codes) # (nq, B, valid_code_length)
-
-        # Concatenate all chunks
-        if codes_list:
-            codes_tensor = torch.cat(codes_list, dim=-1) # (nq, B, T_total)
-            codes_list = [codes_tensor[:, i, :input_lengths[i] // self.encoder_downsample_rate] for i in range(batch_size)] # B * (nq, T)
-        else:
-            codes_list = [torch.zeros(self.nq, 0, device=device, dtype=torch.long) for _ in range(batch_size)] # B * (nq, 0)
+            keep_end = min(keep_start + keep_length, chunk_codes.shape[-1], max_code_length - code_start)
+            if keep_end <= keep_start:
+                continue
+            positions = torch.arange(keep_start, keep_end, device=device) # (T_keep,)
+            valid_mask = positions[None, :] < chunk_code_lengths[:, None] # (B, T_keep)
+            codes_tensor[:, :, code_start + keep_start:code_start + keep_end] = chunk_codes[:, :, keep_start:keep_end] * valid_mask # (nq, B, T_keep)
+
+        codes_list = [codes_tensor[:, i, :input_lengths[i] // self.encoder_downsample_rate] for i in range(batch_size)] # B * (nq, T)
 
         return {
             "codes_list": codes_list # B * (nq, T)
         }
         
     @torch.inference_mode()
-    def decode(self, codes_list, overlap_seconds=10, device=torch.device("cuda")):
+    def decode(self, codes_list, overlap_seconds=10, device=torch.device("cuda"), crossfade_seconds=0.0):
         """
             Input:
                 codes_list: List of quantization codes # B * (nq, T)
                 overlap_seconds: Overlap in seconds, process 30 seconds at a time, keeping (30 - overlap_seconds) seconds of valid output
+                crossfade_seconds: Length of the linear crossfade between consecutive chunks, clipped to the overlap
+                    0 cuts hard at the start of the overlap, otherwise the crossfade is centered in the overlap
             Output:
                 dict: Contains the following key-value pairs
                     "syn_wav_list": List of synthesized audio waveforms # B * (T,)
         """
-        duration_seconds = 30 - overlap_seconds
         chunk_code_length = int(30 * self.input_sample_rate // self.encoder_downsample_rate) # Maximum code length per chunk
-        duration_code_length = int(duration_seconds * self.input_sample_rate // self.encoder_downsample_rate) # Valid code length per chunk
-        duration_wav_length = duration_code_length * self.decoder_upsample_rate # Valid waveform length per chunk
+        overlap_code_length = int(overlap_seconds * self.input_sample_rate // self.encoder_downsample_rate) # Overlapped code length between chunks
+        duration_code_length = chunk_code_length - overlap_code_length # Valid code length per chunk
+        duration_wav_length = duration_code_length * self.decoder_upsample_rate # Stride in samples between chunks
+        overlap_wav_length = overlap_code_length * self.decoder_upsample_rate # Overlapped samples between chunks
+        fade_length = min(int(crossfade_seconds * self.output_sample_rate), overlap_wav_length) # Crossfade samples
+        fade_offset = (overlap_wav_length - fade_length) // 2 if fade_length > 0 else 0 # Crossfade start within the overlap
 
         # Get maximum code length
         max_code_length = max(codes.shape[-1] for codes in codes_list)
@@ -217,7 +348,9 @@ class XY_Tokenizer(nn.Module):
 
         # Calculate number of chunks needed
         max_chunks = (max_code_length + duration_code_length - 1) // duration_code_length
-        wav_list = []
+        max_wav_length = max_code_length * self.decoder_upsample_rate
+        wav_tensor = torch.zeros(batch_size, 1, max_wav_length, device=device)
+        fade_in = torch.linspace(0, 1, fade_length + 2, device=device)[1:-1] # (fade_length,)
 
         # Process the entire batch in chunks
         for chunk_idx in range(max_chunks):
@@ -235,29 +368,35 @@ class XY_Tokenizer(nn.Module):
             chunk_wav = result["y"] # (B, 1, T')
             chunk_wav_lengths = result["output_length"] # (B,)
 
-            # Extract valid portion
-            valid_wav_lengths = torch.clamp(chunk_wav_lengths, 0, duration_wav_length) # (B,)
-            valid_chunk_wav = torch.zeros(batch_size, 1, duration_wav_length, device=device)
-            for b in range(batch_size):
-                if valid_wav_lengths[b] > 0:
-                    valid_chunk_wav[b, :, :valid_wav_lengths[b]] = chunk_wav[b, :, :valid_wav_lengths[b]] # (B, 1, valid_wav_length)
-
-            wav_list.append(valid_chunk_wav) # (B, 1, valid_wav_length)
-
-        # Concatenate all chunks
-        if wav_list:
-            wav_tensor = torch.cat(wav_list, dim=-1) # (B, 1, T_total)
-            syn_wav_list = [wav_tensor[i, 0, :code_lengths[i] * self.decoder_upsample_rate] for i in range(batch_size)] # B * (T,)
-        else:
-            syn_wav_list = [torch.zeros(0, device=device) for _ in range(batch_size)] # B * (0,)
+            # Weight the chunk so that consecutive chunks sum to one over the overlap
+            wav_start = start * self.decoder_upsample_rate
+            chunk_length = min(chunk_wav.shape[-1], max_wav_length - wav_start)
+            weight = torch.ones(chunk_length, device=device)
+            if chunk_idx > 0:
+                weight[:fade_offset] = 0
+                weight[fade_offset:fade_offset + fade_length] = fade_in[:max(0, chunk_length - fade_offset)]
+            if chunk_idx < max_chunks - 1:
+                fade_start = duration_wav_length + fade_offset
+                weight[fade_start:fade_start + fade_length] *= (1 - fade_in)[:max(0, chunk_length - fade_start)]
+                weight[fade_start + fade_length:] = 0
+
+            # Overlap-add the valid portion
+            positions = torch.arange(chunk_length, device=device) # (T',)
+            valid_mask = positions[None, :] < chunk_wav_lengths[:, None] # (B, T')
+            wav_tensor[:, :, wav_start:wav_start + chunk_length] += chunk_wav[:, :, :chunk_length] * (weight * valid_mask)[:, None, :] # (B, 1, T')
+
+        syn_wav_list = [wav_tensor[i, 0, :code_lengths[i] * self.decoder_upsample_rate] for i in range(batch_size)] # B * (T,)
             
         return {
             "syn_wav_list": syn_wav_list # B * (T,)
         }
     
     @classmethod
-    def load_from_checkpoint(cls, config_path: str, ckpt_path: str):
+    def load_from_checkpoint(cls, config_path: str, ckpt_path: str, parts=("encoder", "decoder"), dequant_table_dtype=None, precision="fp32"):
         # Load model from configuration file and checkpoint
+        # parts: subset of {"encoder", "decoder"}, only the submodules they need are built and loaded
+        # dequant_table_dtype: if set (e.g. torch.float16), precompute the RVQ lookup tables and cache them next to the checkpoint
+        # precision: inference precision, see set_precision
         logging.info(f"Loading model from {config_path} and {ckpt_path}")
         
         # Load configuration
@@ -265,15 +404,44 @@ class XY_Tokenizer(nn.Module):
             config = yaml.safe_load(f)
         
         # Create model instance
-        model = cls(config['generator_params'])
+        model = cls(config['generator_params'], parts=parts)
         
         # Load checkpoint
-        checkpoint = torch.load(ckpt_path, map_location='cpu')
-        
-        # Check if checkpoint contains 'generator' key
-        if 'generator' in checkpoint:
-            model.load_state_dict(checkpoint['generator'])
+        if ckpt_path.endswith('.safetensors'):
+            # Memory-mapped, the weights are assigned without copying so processes share the page cache
+            from safetensors.torch import load_file
+            state_dict = load_file(ckpt_path, device='cpu')
         else:
-            model.load_state_dict(checkpoint)
+            checkpoint = torch.load(ckpt_path, map_location='cpu')
+
+            # Check if checkpoint contains 'generator' key
+            state_dict = checkpoint['generator'] if 'generator' in checkpoint else checkpoint
+            del checkpoint
+
+        # Drop the weights of the submodules that were not built
+        skipped_modules = {name for part_modules in cls.PART_MODULES.values() for name in part_modules if getattr(model, name) is None}
+        state_dict = {k: v for k, v in state_dict.items() if k.split('.')[0] not in skipped_modules}
+        model.load_state_dict(state_dict, assign=ckpt_path.endswith('.safetensors'))
+
+        if dequant_table_dtype is not None:
+            dtype_name = str(dequant_table_dtype).replace('torch.', '')
+            model.build_dequant_tables(dtype=dequant_table_dtype, cache_path=f"{os.path.splitext(ckpt_path)[0]}.dequant_{dtype_name}.pt", source_path=ckpt_path)
+
+        model.set_precision(precision)
         
-        return model
\ No newline at end of file
+        return model
+
+    @staticmethod
+    def convert_checkpoint(ckpt_path: str, output_path: str):
+        # Convert a (possibly full training state) pickle checkpoint to a generator-only safetensors file
+        from safetensors.torch import save_file
+        logging.info(f"Converting {ckpt_path} to {output_path}")
+
+        checkpoint = torch.load(ckpt_path, map_location='cpu')
+        state_dict = checkpoint['generator'] if 'generator' in checkpoint else checkpoint
+        del checkpoint
+
+        # Clone so that tensors sharing storage are saved independently
+        state_dict = {k: v.detach().clone().contiguous() for k, v in state_dict.items()}
+        save_file(state_dict, output_path)
+        return output_path
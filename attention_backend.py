@@ -0,0 +1,174 @@
+"""Attention backend selection without reloading weights
+
+The LM is loaded once with eager attention, which every host supports. Qwen3 attention and mask creation
+read config._attn_implementation on every forward, so the backend can be switched in place: each candidate
+runs a short synthetic forward, the fastest one that works is kept, and the choice is cached per host in a
+small JSON file so later runs only verify it.
+
+    model = ...  # loaded with attn_implementation="eager"
+    attn_impl = select_attn_implementation(model, cache_path="attn_backend.json")
+"""
+import os
+import json
+import time
+import platform
+import threading
+from importlib import metadata
+
+import torch
+import transformers
+
+ATTENTION_BACKENDS = ("flash_attention_2", "sdpa", "eager")  # Preference order, fastest first on most hosts
+LOAD_ATTN_IMPLEMENTATION = "eager"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "moss_ttsd", "attn_backend.json")
+
+
+def set_attn_implementation(model, attn_implementation):
+    """Switch the attention backend of a loaded model in place, for every submodule config"""
+    if hasattr(model, "set_attn_implementation"):  # Newer transformers validate and propagate themselves
+        model.set_attn_implementation(attn_implementation)
+        return
+    for module in model.modules():
+        config = getattr(module, "config", None)
+        if config is not None and hasattr(config, "_attn_implementation"):
+            config._attn_implementation = attn_implementation
+
+
+def backend_available(attn_implementation, device, dtype):
+    """Cheap static checks, before spending a forward pass on a backend that cannot work"""
+    if attn_implementation == "flash_attention_2":
+        from transformers.utils import is_flash_attn_2_available
+        return device.type == "cuda" and dtype in (torch.float16, torch.bfloat16) and is_flash_attn_2_available()
+    if attn_implementation == "sdpa":
+        return hasattr(torch.nn.functional, "scaled_dot_product_attention")
+    return True
+
+
+def host_signature(model):
+    """Everything the choice depends on: device, library versions and model dtype"""
+    device = next(model.parameters()).device
+    if device.type == "cuda":
+        major, minor = torch.cuda.get_device_capability(device)
+        device_name = f"{torch.cuda.get_device_name(device)} sm{major}{minor} cuda{torch.version.cuda}"
+    else:
+        device_name = f"cpu {platform.machine()}"
+    try:
+        flash_version = metadata.version("flash_attn")
+    except metadata.PackageNotFoundError:
+        flash_version = None
+    return "|".join([device_name, f"torch{torch.__version__}", f"transformers{transformers.__version__}",
+                     f"flash_attn{flash_version}", str(next(model.parameters()).dtype)])
+
+
+def probe_backend(model, attn_implementation, seq_len=256, repeats=3):
+    """Switch to a backend and time a synthetic padded forward of the LM backbone
+
+    The batch has two rows, one left-padded like a generation batch, so the padded-mask path is exercised.
+
+    Returns:
+        float: Mean seconds per forward, after one warm-up forward
+
+    Raises:
+        Exception: Whatever the backend raises, or RuntimeError for non-finite outputs
+    """
+    backbone = getattr(model, "model", model)  # The attention layers; the LM heads are backend independent
+    config = model.config
+    device = next(model.parameters()).device
+    input_ids = torch.full((2, seq_len, config.channels), config.speech_pad_token, dtype=torch.long, device=device)
+    input_ids[..., 0] = torch.randint(0, min(config.vocab_size, 1000), (2, seq_len), device=device)
+    attention_mask = torch.ones(2, seq_len, dtype=torch.long, device=device)
+    attention_mask[1, :seq_len // 4] = 0
+
+    set_attn_implementation(model, attn_implementation)
+    timings = []
+    with torch.no_grad():
+        for step in range(repeats + 1):
+            start = time.perf_counter()
+            hidden = backbone(input_ids=input_ids, attention_mask=attention_mask, use_cache=False).last_hidden_state
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            if step:
+                timings.append(time.perf_counter() - start)
+    if not torch.isfinite(hidden[attention_mask.bool()]).all():
+        raise RuntimeError("non-finite outputs")
+    return sum(timings) / max(len(timings), 1)
+
+
+_cache_lock = threading.Lock()
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache_path, key, entry):
+    with _cache_lock:
+        cache = _read_cache(cache_path)
+        cache[key] = entry
+        directory = os.path.dirname(cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, cache_path)
+
+
+def select_attn_implementation(model, cache_path=DEFAULT_CACHE_PATH, candidates=ATTENTION_BACKENDS, seq_len=256, repeats=3,
+                               reprobe=False):
+    """Pick and switch to the fastest working attention backend of a loaded model
+
+    A backend cached for this host is only checked with a tiny forward; otherwise every available candidate
+    is probed and timed, and the fastest is cached.
+
+    Args:
+        model: Loaded AsteroidTTSInstruct, on its final device
+        cache_path: JSON file of choices per host signature, None to disable caching
+        candidates: Backends to consider
+        seq_len: Tokens per row of the timed synthetic forward
+        repeats: Timed forwards per backend
+        reprobe: Ignore the cached choice
+
+    Returns:
+        str: The backend now in use
+    """
+    device = next(model.parameters()).device
+    dtype = next(model.parameters()).dtype
+    key = host_signature(model)
+
+    cached = _read_cache(cache_path).get(key) if cache_path and not reprobe else None
+    if cached and cached.get("attn_implementation") in candidates:
+        attn_implementation = cached["attn_implementation"]
+        try:
+            probe_backend(model, attn_implementation, seq_len=16, repeats=0)
+            print(f"Using cached attention implementation: {attn_implementation}")
+            return attn_implementation
+        except Exception as e:
+            print(f"Cached attention implementation {attn_implementation} failed ({e}), probing again")
+
+    timings = {}
+    for attn_implementation in candidates:
+        if not backend_available(attn_implementation, device, dtype):
+            print(f"Attention implementation {attn_implementation}: unavailable")
+            continue
+        try:
+            timings[attn_implementation] = probe_backend(model, attn_implementation, seq_len=seq_len, repeats=repeats)
+            print(f"Attention implementation {attn_implementation}: {timings[attn_implementation] * 1000:.1f} ms per forward")
+        except Exception as e:
+            print(f"Attention implementation {attn_implementation}: failed ({e})")
+    if not timings:
+        raise RuntimeError(f"No working attention implementation among {list(candidates)}")
+
+    attn_implementation = min(timings, key=timings.get)
+    set_attn_implementation(model, attn_implementation)
+    if device.type == "cuda":
+        torch.cuda.empty_cache()  # Release the probe activations
+    if cache_path:
+        _write_cache(cache_path, key, {"attn_implementation": attn_implementation,
+                                       "timings_ms": {name: round(t * 1000, 2) for name, t in timings.items()}})
+    print(f"Selected attention implementation: {attn_implementation}")
+    return attn_implementation
@@ -0,0 +1,192 @@
+import functools
+
+import torch
+import torchaudio
+
+
+@functools.lru_cache(maxsize=32)
+def get_resampler(orig_sr, target_sr, dtype=torch.float32):
+    """Return a cached Resample transform, so the sinc kernel is built once per (orig_sr, target_sr, dtype)"""
+    return torchaudio.transforms.Resample(orig_sr, target_sr, dtype=dtype)
+
+
+def resample(wav, orig_sr, target_sr):
+    """Resample a (..., T) waveform with a cached kernel"""
+    if orig_sr == target_sr:
+        return wav
+    return get_resampler(orig_sr, target_sr, wav.dtype)(wav)
+
+
+def resampled_length(length, orig_sr, target_sr):
+    """Number of samples torchaudio's resampler returns for an input of the given length"""
+    return -(-length * target_sr // orig_sr)
+
+
+def to_mono(wav):
+    """Convert a (T,) or (C, T) waveform to (1, T) by averaging the channels"""
+    if wav.dim() == 1:
+        wav = wav.unsqueeze(0)
+    if wav.shape[0] > 1:
+        wav = wav.mean(dim=0, keepdim=True)  # Convert multi-channel to mono
+    return wav
+
+
+def load_waveform(audio_input, start_seconds=0.0, max_seconds=None):
+    """Load a file path or pass through a (wav, sr) tuple, optionally reading only part of a file
+
+    Args:
+        audio_input: String (file path) or tuple (wav, sr)
+        start_seconds: Offset of the first sample to read
+        max_seconds: If set, read at most this many seconds, so long files are not fully decoded
+
+    Returns:
+        tuple: (wav, sr)
+    """
+    if isinstance(audio_input, tuple) and len(audio_input) == 2:
+        # Already a (wav, sr) tuple
+        wav, sr = audio_input
+        start = int(start_seconds * sr)
+        end = start + int(max_seconds * sr) if max_seconds is not None else None
+        return wav[..., start:end], sr
+    elif isinstance(audio_input, str):
+        # Is a file path, needs to be loaded
+        if start_seconds or max_seconds is not None:
+            sr = torchaudio.info(audio_input).sample_rate
+            num_frames = int(max_seconds * sr) if max_seconds is not None else -1
+            return torchaudio.load(audio_input, frame_offset=int(start_seconds * sr), num_frames=num_frames)
+        return torchaudio.load(audio_input)
+    else:
+        raise ValueError(f"Unsupported audio input format: {type(audio_input)}")
+
+
+def duration_seconds(audio_input):
+    """Duration of a file path or (wav, sr) tuple, read from the file header without decoding"""
+    if isinstance(audio_input, tuple) and len(audio_input) == 2:
+        wav, sr = audio_input
+        return wav.shape[-1] / sr
+    elif isinstance(audio_input, str):
+        info = torchaudio.info(audio_input)
+        return info.num_frames / info.sample_rate
+    else:
+        raise ValueError(f"Unsupported audio input format: {type(audio_input)}")
+
+
+def load_mono(audio_input, target_sample_rate=16000, start_seconds=0.0, max_seconds=None):
+    """Load one input as a (1, T) mono waveform at target_sample_rate"""
+    wav, sr = load_waveform(audio_input, start_seconds, max_seconds)
+    return resample(to_mono(wav), sr, target_sample_rate)
+
+
+def resample_batch(wavs, orig_sr, target_sr):
+    """Resample (1, T) waveforms sharing one sample rate with a single call on a padded batch
+
+    The resampler zero-pads its input, so trimming each row to its own output length gives the same
+    result as resampling the waveforms one by one.
+    """
+    if orig_sr == target_sr or not wavs:
+        return list(wavs)
+    lengths = [wav.shape[-1] for wav in wavs]
+    batch = torch.zeros(len(wavs), max(lengths), dtype=wavs[0].dtype)
+    for i, wav in enumerate(wavs):
+        batch[i, :lengths[i]] = wav.reshape(-1)
+    resampled = resample(batch, orig_sr, target_sr)
+    return [resampled[i:i + 1, :resampled_length(length, orig_sr, target_sr)] for i, length in enumerate(lengths)]
+
+
+def load_mono_batch(audio_inputs, target_sample_rate=16000, start_seconds=0.0, max_seconds=None):
+    """Load several inputs as (1, T) mono waveforms at target_sample_rate
+
+    Repeated file paths are read once, and inputs are resampled in one batched call per source sample rate.
+
+    Returns:
+        list: One (1, T) tensor per input
+    """
+    loaded = {}
+    keys = []
+    for audio_input in audio_inputs:
+        # File paths are deduplicated by path, tuples by identity
+        key = audio_input if isinstance(audio_input, str) else id(audio_input)
+        if key not in loaded:
+            wav, sr = load_waveform(audio_input, start_seconds, max_seconds)
+            loaded[key] = (to_mono(wav), sr)
+        keys.append(key)
+
+    by_rate = {}
+    for key, (wav, sr) in loaded.items():
+        by_rate.setdefault((sr, wav.dtype), []).append(key)
+    resampled = {}
+    for (sr, _), rate_keys in by_rate.items():
+        for key, wav in zip(rate_keys, resample_batch([loaded[key][0] for key in rate_keys], sr, target_sample_rate)):
+            resampled[key] = wav
+    return [resampled[key] for key in keys]
+
+
+def trim_prompt(wav, sample_rate, max_seconds=None, max_pause_seconds=0.5, threshold_db=-40.0, frame_seconds=0.02):
+    """Energy-based trimming of a (1, T) reference prompt to bound its prefill cost
+
+    1. Remove leading and trailing silence.
+    2. Shorten internal pauses longer than max_pause_seconds to max_pause_seconds.
+    3. If still longer than max_seconds, keep the max_seconds window with the best SNR,
+       starting at a pause when possible.
+
+    Steps 1 and 2 keep the prompt text aligned with the audio; step 3 drops speech, so the
+    caller must warn that the prompt text may no longer match.
+
+    Args:
+        wav: (1, T) waveform
+        sample_rate: Sample rate of wav
+        max_seconds: Maximum duration of the result, None for no cap
+        max_pause_seconds: Longest internal pause kept
+        threshold_db: Frames quieter than the loudest frame by more than this are silence
+        frame_seconds: Analysis frame length
+
+    Returns:
+        tuple: (trimmed (1, T) waveform, whether speech was cut by the cap)
+    """
+    frame = max(1, int(frame_seconds * sample_rate))
+    num_frames = wav.shape[-1] // frame
+    if num_frames == 0:
+        return wav, False
+
+    frames = wav[..., :num_frames * frame].reshape(num_frames, frame)
+    energy_db = 10 * torch.log10(frames.pow(2).mean(dim=-1) + 1e-10)  # (num_frames,)
+    voiced = energy_db > energy_db.max() + threshold_db
+    if not voiced.any():
+        return wav, False
+
+    # Leading / trailing silence and long internal pauses
+    voiced_idx = torch.nonzero(voiced).squeeze(-1)
+    first, last = voiced_idx[0].item(), voiced_idx[-1].item()
+    max_pause_frames = max(1, int(max_pause_seconds / frame_seconds))
+    keep = torch.zeros(num_frames, dtype=torch.bool)
+    keep[first:last + 1] = True
+    run_start = None
+    for i in range(first, last + 2):
+        if i <= last and not voiced[i]:
+            run_start = i if run_start is None else run_start
+        elif run_start is not None:
+            run_length = i - run_start
+            if run_length > max_pause_frames:
+                # Keep half of the allowed pause on each side of the gap
+                keep[run_start + max_pause_frames // 2:i - (max_pause_frames - max_pause_frames // 2)] = False
+            run_start = None
+
+    keep_idx = torch.nonzero(keep).squeeze(-1)
+    trimmed = frames[keep_idx].reshape(1, -1)
+    if max_seconds is None or trimmed.shape[-1] <= int(max_seconds * sample_rate):
+        return trimmed.to(wav.dtype), False
+
+    # Best-SNR window over the kept frames: highest mean energy above the noise floor
+    kept_db = energy_db[keep_idx]
+    noise_floor = torch.quantile(energy_db, 0.1)
+    snr = (kept_db - noise_floor).clamp(min=0)
+    window = int(max_seconds / frame_seconds)
+    window_snr = torch.cumsum(torch.cat([snr.new_zeros(1), snr]), dim=0)
+    window_snr = window_snr[window:] - window_snr[:-window]  # (len(kept) - window + 1,)
+    # Prefer windows starting at a pause so the cut does not fall inside a word
+    starts_at_pause = torch.ones_like(window_snr, dtype=torch.bool)
+    starts_at_pause[1:] = ~voiced[keep_idx][:len(window_snr) - 1]
+    if starts_at_pause.any():
+        window_snr = torch.where(starts_at_pause, window_snr, window_snr.new_full((), -1.0))
+    start = int(torch.argmax(window_snr).item())
+    return frames[keep_idx[start:start + window]].reshape(1, -1).to(wav.dtype), True
@@ -0,0 +1,173 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torchaudio
+
+# Output formats: file extension and torchaudio.save arguments
+AUDIO_FORMATS = {
+    "wav": ("wav", {"format": "wav"}),  # 32-bit float, as written before formats were configurable
+    "pcm16": ("wav", {"format": "wav", "encoding": "PCM_S", "bits_per_sample": 16}),
+    "flac": ("flac", {"format": "flac", "bits_per_sample": 16}),
+    "opus": ("opus", {"format": "ogg", "encoding": "opus"}),
+}
+_EXTENSION_FORMATS = {"wav": "wav", "flac": "flac", "opus": "opus", "ogg": "opus"}
+
+
+def audio_extension(audio_format):
+    return AUDIO_FORMATS[audio_format][0]
+
+
+def to_host(tensors):
+    """Copy several device tensors of one dtype to the host with a single transfer
+
+    Returns:
+        list: CPU tensors with the original shapes
+    """
+    if not tensors:
+        return []
+    if all(tensor.device.type == "cpu" for tensor in tensors):
+        return [tensor.detach() for tensor in tensors]
+    flat = torch.cat([tensor.detach().reshape(-1) for tensor in tensors]).cpu()
+    parts = torch.split(flat, [tensor.numel() for tensor in tensors])
+    return [part.reshape(tensor.shape) for part, tensor in zip(parts, tensors)]
+
+
+def _prepare(audio_data, audio_format):
+    audio_data = audio_data.detach().cpu().float()
+    if audio_format != "wav":
+        audio_data = audio_data.clamp(-1.0, 1.0)  # Integer and lossy encoders wrap or distort out-of-range samples
+    return audio_data
+
+
+def encode_audio(audio_data, sample_rate, audio_format="wav"):
+    """Encode one (channels, samples) waveform in memory, e.g. for an HTTP response
+
+    Returns:
+        bytes: The encoded file
+    """
+    _, save_kwargs = AUDIO_FORMATS[audio_format]
+    buffer = io.BytesIO()
+    torchaudio.save(buffer, _prepare(audio_data, audio_format), sample_rate, **save_kwargs)
+    return buffer.getvalue()
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return  # Directories cannot be opened on Windows, where the rename is durable without it
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_audio(output_path, audio_data, sample_rate, audio_format=None):
+    """Encode and write one waveform through a fsynced temporary file, so neither a reader nor a crash leaves a truncated file
+
+    Args:
+        output_path: Output file path
+        audio_data: (channels, samples) float waveform in [-1, 1]
+        sample_rate: Sample rate of audio_data
+        audio_format: Key of AUDIO_FORMATS, inferred from the file extension if None
+    """
+    if audio_format is None:
+        audio_format = _EXTENSION_FORMATS.get(os.path.splitext(output_path)[1].lstrip(".").lower(), "wav")
+    _, save_kwargs = AUDIO_FORMATS[audio_format]
+    audio_data = _prepare(audio_data, audio_format)
+
+    directory, name = os.path.split(output_path)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        torchaudio.save(tmp_path, audio_data, sample_rate, **save_kwargs)
+        # The data must be on disk before the rename, and the rename before on_done records the file as complete
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+        _fsync_directory(directory)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AudioWriter:
+    """Encodes and writes audio files on background threads, off the generation path
+
+    submit() returns immediately; at most max_pending files wait in memory, after which submit blocks
+    until a write finishes. An optional on_done(output_path) callback runs once a file is complete, e.g.
+    to record it in a JobManifest. Errors are reported and counted, not raised into the generation loop.
+
+    Args:
+        audio_format: Key of AUDIO_FORMATS
+        num_workers: Writer threads; torchaudio encodes in native code
+        max_pending: Maximum number of submitted waveforms not yet written
+        report: Print every written file
+    """
+
+    def __init__(self, audio_format="wav", num_workers=2, max_pending=32, report=True):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unknown audio format {audio_format}, expected one of {sorted(AUDIO_FORMATS)}")
+        self.audio_format = audio_format
+        self.extension = audio_extension(audio_format)
+        self.report = report
+        self._pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="audio-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._futures = []
+        self.written = 0
+        self.failed = 0
+
+    def output_path(self, output_dir, name):
+        """output_dir/name with this writer's extension"""
+        return os.path.join(output_dir, f"{name}.{self.extension}")
+
+    def submit(self, output_path, audio_data, sample_rate, on_done=None):
+        """Queue one (channels, samples) waveform, already on the host, for writing; returns a Future"""
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._write, output_path, audio_data, sample_rate, on_done)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()] + [future]
+        return future
+
+    def _write(self, output_path, audio_data, sample_rate, on_done):
+        try:
+            save_audio(output_path, audio_data, sample_rate, self.audio_format)
+            if on_done is not None:
+                on_done(output_path)
+            with self._lock:
+                self.written += 1
+            if self.report:
+                print(f"Saved audio to {output_path}")
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f"Error saving audio to {output_path}: {e}")
+        finally:
+            self._slots.release()
+
+    def wait(self):
+        """Block until every submitted file is written"""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
+        if self.failed:
+            print(f"Warning: {self.failed} audio files could not be written")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,160 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from speech_codes import CodeStore, to_code_array
+
+
+def checkpoint_fingerprint(ckpt_path, sample_bytes=1 << 20):
+    """Cheap fingerprint of a codec checkpoint: file size plus the first and last bytes
+
+    Args:
+        ckpt_path: Checkpoint file path
+        sample_bytes: Number of bytes hashed at each end of the file
+
+    Returns:
+        str: Hex digest identifying the checkpoint
+    """
+    size = os.path.getsize(ckpt_path)
+    hasher = hashlib.sha256(str(size).encode())
+    with open(ckpt_path, "rb") as f:
+        hasher.update(f.read(sample_bytes))
+        if size > sample_bytes:
+            f.seek(max(size - sample_bytes, sample_bytes))
+            hasher.update(f.read(sample_bytes))
+    return hasher.hexdigest()[:16]
+
+
+class PromptCodeCache:
+    """Content-addressed cache of reference-audio codes
+
+    Entries are keyed by the hash of the waveform that is actually encoded, its sample rate and the
+    codec checkpoint, and hold (T, nq) codes without the text-vocabulary offset. Hot entries stay in an
+    in-memory LRU as uint16 arrays; with a cache_dir, every entry is also appended to a memory-mapped
+    speech_codes.CodeStore in that directory.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=256):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._store = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            if os.path.exists(os.path.join(cache_dir, "store.json")):
+                self._store = CodeStore(cache_dir)
+
+    @staticmethod
+    def make_key(wav, sample_rate, checkpoint_id):
+        hasher = hashlib.sha256()
+        hasher.update(f"{sample_rate}:{checkpoint_id}:{wav.numel()}:".encode())
+        hasher.update(wav.detach().to(torch.float32).cpu().contiguous().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """(T, nq) uint16 codes of an entry, None on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        position = self._store.find(key) if self._store is not None else None
+        if position is not None:
+            codes = np.array(self._store.speech(position))
+            self._remember(key, codes)
+            with self._lock:
+                self.hits += 1
+            return codes
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, codes):
+        codes = to_code_array(codes)
+        self._remember(key, codes)
+        if self.cache_dir:
+            with self._lock:
+                if self._store is None:
+                    self._store = CodeStore(self.cache_dir, channels=codes.shape[1])
+            if key not in self._store:
+                self._store.append(codes, key=key)
+
+    def _remember(self, key, codes):
+        with self._lock:
+            self._entries[key] = codes
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def encode(self, spt, wav, device):
+        """Return the (T, nq) codes of a mono waveform, running the codec only on a cache miss
+
+        Args:
+            spt: XY_Tokenizer codec
+            wav: Waveform tensor at spt.input_sample_rate, (1, T) or (T,)
+            device: Device the codec runs on
+
+        Returns:
+            np.ndarray: Codes of shape (T, nq)
+        """
+        return self.encode_batch(spt, [wav], device)[0]
+
+    def encode_batch(self, spt, wavs, device, max_batch_seconds=300, max_batch_size=32):
+        """Return the (T, nq) codes of several waveforms, encoding the distinct cache misses together
+
+        Misses are deduplicated by content, sorted by length and encoded in batches whose padded
+        audio stays under max_batch_seconds.
+
+        Args:
+            spt: XY_Tokenizer codec
+            wavs: Waveform tensors at spt.input_sample_rate, (1, T) or (T,)
+            device: Device the codec runs on
+            max_batch_seconds: Padded audio budget of one codec call
+            max_batch_size: Maximum number of waveforms in one codec call
+
+        Returns:
+            list: Codes of shape (T, nq), one per input waveform
+        """
+        checkpoint_id = getattr(spt, "checkpoint_id", None) or f"object-{id(spt)}"
+        keys = [self.make_key(wav, spt.input_sample_rate, checkpoint_id) for wav in wavs]
+
+        found, missing = {}, {}
+        for key, wav in zip(keys, wavs):
+            if key in found or key in missing:
+                continue
+            codes = self.get(key)
+            if codes is None:
+                missing[key] = wav.reshape(-1)
+            else:
+                found[key] = codes
+
+        # Length-bucketed batches of the distinct misses
+        max_batch_samples = max_batch_seconds * spt.input_sample_rate
+        batches, batch = [], []
+        for key in sorted(missing, key=lambda k: missing[k].shape[-1]):
+            # Sorted ascending, so the new waveform is the longest one of the batch
+            if batch and (missing[key].shape[-1] * (len(batch) + 1) > max_batch_samples or len(batch) >= max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(key)
+        if batch:
+            batches.append(batch)
+
+        for batch in batches:
+            with torch.no_grad():
+                encode_result = spt.encode([missing[key].to(device) for key in batch], device=device)
+            for key, codes in zip(batch, encode_result["codes_list"]):
+                found[key] = to_code_array(codes.permute(1, 0))
+                self.put(key, found[key])
+
+        # Compact in the cache, int64 for the callers that add the text offset
+        return [found[key].astype(np.int64) for key in keys]
@@ -0,0 +1,113 @@
+"""Decode speech codes saved by `inference.py --codes_only` into audio, in length-bucketed codec batches
+
+    python decode_codes.py --codes outputs/codes --output_dir outputs_audio --batch_size 8
+"""
+import argparse
+import os
+
+import torch
+
+from XY_Tokenizer.xy_tokenizer.model import XY_Tokenizer
+from code_cache import checkpoint_fingerprint
+from model_bundle import resolve_bundle
+from speech_codes import CodeStore, plan_decode_batches, decode_code_batch
+from audio_writer import AUDIO_FORMATS, AudioWriter
+
+SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
+SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
+
+
+def audio_path(store, position, extension, output_dir=None):
+    """Output file of a store entry: its name metadata (e.g. output_3) plus the extension, next to the store by default"""
+    name = store.metadata(position).get("name") or f"entry_{position}"
+    return os.path.join(output_dir or os.path.dirname(os.path.abspath(store.path)), f"{name}.{extension}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode saved speech codes with XY_Tokenizer")
+    parser.add_argument("--codes", nargs="+", required=True,
+                        help="Code store directories, e.g. <output_dir>/codes of an inference.py --codes_only run")
+    parser.add_argument("--output_dir", default=None,
+                        help="Directory for the decoded audio (default: None, the directory holding each code store)")
+    parser.add_argument("--batch_size", type=int, default=8,
+                        help="Maximum number of code sequences per codec call (default: 8)")
+    parser.add_argument("--max_batch_frames", type=int, default=None,
+                        help="Padded budget of batch size times longest code length per codec call (default: None)")
+    parser.add_argument("--spt_config_path", default=SPT_CONFIG_PATH,
+                        help=f"XY_Tokenizer config the codes were generated with (default: {SPT_CONFIG_PATH})")
+    parser.add_argument("--spt_checkpoint_path", default=SPT_CHECKPOINT_PATH,
+                        help=f"XY_Tokenizer checkpoint, .ckpt or generator-only .safetensors (default: {SPT_CHECKPOINT_PATH})")
+    parser.add_argument("--bundle", default=None,
+                        help="Take the codec from an offline bundle made by model_bundle.py, as with inference.py --bundle (default: None)")
+    parser.add_argument("--codec_precision", choices=["fp32", "bf16", "fp16", "int8"], default="fp32",
+                        help="XY_Tokenizer precision, int8 decodes on CPU (default: fp32)")
+    parser.add_argument("--audio_format", choices=sorted(AUDIO_FORMATS), default="wav",
+                        help="Output audio format: wav (32-bit float), pcm16 (16-bit wav), flac or opus (default: wav)")
+    parser.add_argument("--overwrite", action="store_true", default=False,
+                        help="Decode files whose audio already exists (default: False)")
+    args = parser.parse_args()
+    writer = AudioWriter(args.audio_format)
+
+    # (store, position) of every entry still to decode; a later entry with the same key supersedes earlier ones
+    entries = []
+    for path in args.codes:
+        store = CodeStore(path)
+        if not len(store):
+            print(f"Warning: {path} holds no code entries")
+        for position, key in enumerate(store.keys()):
+            if key is not None and store.find(key) != position:
+                continue
+            if args.overwrite or not os.path.exists(audio_path(store, position, writer.extension, args.output_dir)):
+                entries.append((store, position))
+    if not entries:
+        print("No code entries to decode")
+        return
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.codec_precision == "int8" and device != "cpu":
+        # Dynamically quantized Linear layers have no CUDA kernels
+        print("Codec precision int8 is CPU only, decoding on CPU")
+        device = "cpu"
+    print(f"Using device: {device}")
+
+    # Only the decoder half of the codec is needed
+    if args.bundle:
+        bundle = resolve_bundle(args.bundle)
+        spt_config_path, spt_checkpoint_path = bundle["spt_config_path"], bundle["spt_checkpoint_path"]
+        checkpoint_id = bundle["checkpoint_id"]  # Identity of the original checkpoint, as recorded by inference.py --bundle
+    else:
+        spt_config_path, spt_checkpoint_path = args.spt_config_path, args.spt_checkpoint_path
+        checkpoint_id = checkpoint_fingerprint(spt_checkpoint_path)
+    spt = XY_Tokenizer.load_from_checkpoint(config_path=spt_config_path, ckpt_path=spt_checkpoint_path,
+                                            parts=("decoder",), precision=args.codec_precision)
+    spt = spt.to(device)
+    spt.eval()
+
+    # Lengths come from the store indexes; entries of similar length are decoded together
+    for store in {id(store): store for store, _ in entries}.values():
+        codecs = {store.metadata(position).get("codec") for position in range(len(store))} - {None, checkpoint_id}
+        if codecs:
+            print(f"Warning: {store.path} holds codes of codec checkpoints {sorted(codecs)}, decoding with {checkpoint_id}")
+    batches = plan_decode_batches([(i, len(store.speech(position))) for i, (store, position) in enumerate(entries)],
+                                  args.batch_size, args.max_batch_frames)
+    print(f"Decoding {len(entries)} code entries in {len(batches)} batches")
+
+    # Files are encoded and written in the background while the next batch decodes
+    for batch in batches:
+        batch_entries = [entries[i] for i in batch]
+        try:
+            wavs = decode_code_batch(spt, [store.speech(position) for store, position in batch_entries], device)
+        except Exception as e:
+            print(f"Error decoding {[audio_path(store, position, writer.extension) for store, position in batch_entries]}: {e}, skipping...")
+            continue
+        for (store, position), wav in zip(batch_entries, wavs):
+            writer.submit(audio_path(store, position, writer.extension, args.output_dir), wav, spt.output_sample_rate)
+
+    writer.close()
+    print(f"Decoding completed. Saved {writer.written}/{len(entries)} audio files")
+
+
+if __name__ == "__main__":
+    main()
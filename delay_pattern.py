@@ -0,0 +1,134 @@
+"""Vectorized delay-pattern operations shared by inference and training
+
+The LM reads and writes MAX_CHANNELS token channels with a delay pattern: channel c of frame t sits at
+row t + c, so a (T, C) sequence becomes (T + C - 1, C). Every function here accepts NumPy arrays or torch
+tensors and returns the same kind, building its result in one preallocated buffer with index arithmetic
+instead of per-channel or per-sample loops.
+"""
+import numpy as np
+import torch
+
+
+def _is_torch(x):
+    return isinstance(x, torch.Tensor)
+
+
+def _full(like, shape, value, dtype=None):
+    if _is_torch(like):
+        return torch.full(shape, value, dtype=dtype or like.dtype, device=like.device)
+    return np.full(shape, value, dtype=dtype or like.dtype)
+
+
+def _arange(like, n):
+    if _is_torch(like):
+        return torch.arange(n, device=like.device)
+    return np.arange(n)
+
+
+def _fill_buffer(like, shape, fill, first_fill):
+    """Buffer of fill values whose channel 0 holds first_fill (e.g. the text pad token)"""
+    out = _full(like, shape, fill)
+    if first_fill is not None:
+        out[..., 0] = first_fill
+    return out
+
+
+def delay(x, fill, first_fill=None):
+    """Apply the delay pattern to one (T, C) sequence
+
+    Args:
+        x: (T, C) array or tensor
+        fill: Value of the positions no frame maps to
+        first_fill: Value of the empty positions of channel 0, defaults to fill
+
+    Returns:
+        (T + C - 1, C) array or tensor of the same kind and dtype as x
+    """
+    seq_len, channels = x.shape
+    out = _fill_buffer(x, (seq_len + channels - 1, channels), fill, first_fill)
+    cols = _arange(x, channels)
+    rows = _arange(x, seq_len)[:, None] + cols[None, :]
+    out[rows, cols[None, :]] = x
+    return out
+
+
+def undelay(x):
+    """Invert the delay pattern
+
+    Args:
+        x: (L, C) or (B, L, C) delayed array or tensor with L >= C - 1
+
+    Returns:
+        (L - C + 1, C) or (B, L - C + 1, C) array or tensor, out[..., t, c] = x[..., t + c, c]
+    """
+    channels = x.shape[-1]
+    seq_len = x.shape[-2] - channels + 1
+    cols = _arange(x, channels)
+    rows = _arange(x, seq_len)[:, None] + cols[None, :]
+    return x[..., rows, cols[None, :]]
+
+
+def _place_ragged(seqs, fill, first_fill, side, max_length, delayed):
+    """Shared body of pad_batch and delay_batch"""
+    like = seqs[0]
+    channels = like.shape[1]
+    extra = channels - 1 if delayed else 0
+    lengths = [seq.shape[0] + extra for seq in seqs]
+    length = max(lengths) if max_length is None else min(max(lengths), max_length)
+
+    out = _fill_buffer(like, (len(seqs), length, channels), fill, first_fill)
+    mask = _full(like, (len(seqs), length), 0, dtype=torch.float64 if _is_torch(like) else np.float64)
+
+    # Flatten the batch into one (N, C) block with the batch row and output row of every input row
+    stacked = torch.cat(list(seqs)) if _is_torch(like) else np.concatenate(seqs)
+    positions = np.concatenate([np.arange(seq.shape[0]) for seq in seqs])
+    batch_rows = np.repeat(np.arange(len(seqs)), [seq.shape[0] for seq in seqs])
+    offsets = np.array([length - n if side == "left" else 0 for n in lengths])
+    rows = (offsets[batch_rows] + positions)[:, None] + (np.arange(channels)[None, :] if delayed else 0)
+    rows = np.broadcast_to(rows, (rows.shape[0], channels))
+    cols = np.broadcast_to(np.arange(channels)[None, :], rows.shape)
+    batch_rows = np.broadcast_to(batch_rows[:, None], rows.shape)
+
+    # With max_length, right-padded sequences lose rows past the end and left-padded ones rows before the start
+    valid = (rows >= 0) & (rows < length)
+    src_rows = np.broadcast_to(np.arange(stacked.shape[0])[:, None], rows.shape)
+    index = [a[valid] for a in (batch_rows, rows, cols, src_rows)]
+    if _is_torch(like):
+        index = [torch.from_numpy(np.ascontiguousarray(a)).to(like.device) for a in index]
+    b, r, c, src = index
+    out[b, r, c] = stacked[src, c]
+
+    # Attention covers each sequence's own (possibly truncated) span
+    span = np.arange(length)[None, :]
+    starts, ends = np.maximum(offsets, 0)[:, None], np.minimum(offsets + np.array(lengths), length)[:, None]
+    mask_np = ((span >= starts) & (span < ends)).astype(np.float64)
+    mask[...] = torch.from_numpy(mask_np).to(like.device) if _is_torch(like) else mask_np
+    return out, mask
+
+
+def pad_batch(seqs, fill, first_fill=None, side="left", max_length=None):
+    """Pad ragged (T_i, C) sequences into one (B, L, C) batch
+
+    Args:
+        seqs: Non-empty list of (T_i, C) arrays or tensors of one kind and dtype
+        fill: Padding value
+        first_fill: Padding value of channel 0, defaults to fill
+        side: "left" (generation) or "right" (training)
+        max_length: Optional length cap; longer sequences keep their start when right-padded and their end when left-padded
+
+    Returns:
+        tuple: ((B, L, C) batch, (B, L) float64 attention mask)
+    """
+    return _place_ragged(seqs, fill, first_fill, side, max_length, delayed=False)
+
+
+def delay_batch(seqs, fill, first_fill=None, side="left", max_length=None):
+    """Delay and pad ragged (T_i, C) sequences into one (B, L, C) batch in a single pass
+
+    Equivalent to pad_batch([delay(seq, fill, first_fill) for seq in seqs], ...) without the per-sample
+    intermediate arrays.
+
+    Returns:
+        tuple: ((B, L, C) batch, (B, L) float64 attention mask)
+    """
+    return _place_ragged(seqs, fill, first_fill, side, max_length, delayed=True)
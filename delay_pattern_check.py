@@ -0,0 +1,164 @@
+"""Property check and benchmark of delay_pattern against the loop implementations it replaced
+
+    python delay_pattern_check.py --trials 200 --batch_size 16
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import delay_pattern
+
+PAD_TOKEN_ID = 151643  # Text pad token of the MOSS-TTSD tokenizer
+FILLER = 1024
+
+
+# Reference implementations: the per-channel / per-sample loops previously used in generation_utils and finetune
+
+def reference_shifting_inputs(input_ids, pad_token_id, pad_token=FILLER, max_channels=8):
+    seq_len = input_ids.shape[0]
+    new_seq_len = seq_len + max_channels - 1
+    shifted_input_ids = np.full((new_seq_len, max_channels), pad_token, dtype=np.int64)
+    shifted_input_ids[:, 0] = np.full(new_seq_len, pad_token_id, dtype=np.int64)
+    for i in range(max_channels):
+        shifted_input_ids[i : (seq_len + i), i] = input_ids[:, i]
+    return shifted_input_ids
+
+
+def reference_rpadding(input_ids, channels, pad_token_id):
+    attention_masks = [np.ones(inputs.shape[0]) for inputs in input_ids]
+    max_length = max(ids.shape[0] for ids in input_ids)
+    padded_input_ids, padded_attns = [], []
+    for ids, attn in zip(input_ids, attention_masks):
+        pad_len = max_length - ids.shape[0]
+        input_pad = np.full((pad_len, channels), FILLER)
+        input_pad[:, 0] = pad_token_id
+        padded_input_ids.append(np.concatenate([input_pad, ids]))
+        padded_attns.append(np.concatenate([np.zeros(pad_len), attn]))
+    return torch.tensor(np.stack(padded_input_ids)), torch.tensor(np.stack(padded_attns))
+
+
+def reference_unshift(outputs, channels):
+    seq_len = outputs.shape[1] - channels + 1
+    speech_ids = torch.full((outputs.shape[0], seq_len, channels), 0)
+    for j in range(channels):
+        speech_ids[..., j] = outputs[:, j : seq_len + j, j]
+    return speech_ids
+
+
+def reference_truncate_and_shift(input_ids, labels, channels, pad_token_id):
+    seq_len = input_ids.shape[0]
+    new_seq_len = seq_len + channels - 1
+    shifted_input_ids = np.full((new_seq_len, channels), FILLER)
+    shifted_input_ids[:, 0] = np.full(new_seq_len, pad_token_id)
+    shifted_labels = np.full((new_seq_len, channels), -100)
+    for i in range(channels):
+        shifted_input_ids[i : (seq_len + i), i] = input_ids[:, i]
+        shifted_labels[i : (seq_len + i), i] = labels[:, i]
+    return shifted_input_ids, shifted_labels, np.ones(new_seq_len)
+
+
+def reference_collate(input_ids, labels, attention_masks, max_length, pad_token_id):
+    channels = input_ids[0].shape[1]
+    max_length = min(max(ids.shape[0] for ids in input_ids), max_length)
+    padded_input_ids, padded_labels, padded_attns = [], [], []
+    for ids, lbls, attn in zip(input_ids, labels, attention_masks):
+        seq_len = ids.shape[0]
+        if seq_len < max_length:
+            pad_len = max_length - seq_len
+            input_pad = np.full((pad_len, channels), FILLER)
+            input_pad[:, 0] = pad_token_id
+            padded_input_ids.append(np.concatenate([ids, input_pad]))
+            padded_labels.append(np.concatenate([lbls, np.full((pad_len, channels), -100)]))
+            padded_attns.append(np.concatenate([attn, np.zeros(pad_len)]))
+        else:
+            padded_input_ids.append(ids[:max_length])
+            padded_labels.append(lbls[:max_length])
+            padded_attns.append(attn[:max_length])
+    return (torch.tensor(np.stack(padded_input_ids), dtype=torch.long),
+            torch.tensor(np.stack(padded_labels), dtype=torch.long),
+            torch.tensor(np.stack(padded_attns), dtype=torch.long))
+
+
+def random_batch(rng, batch_size, channels, max_len):
+    return [rng.integers(0, 2048, size=(int(rng.integers(1, max_len + 1)), channels)).astype(np.int64)
+            for _ in range(batch_size)]
+
+
+def check(trials, batch_size, channels, max_len, seed=0):
+    """Compare delay_pattern with the reference loops on random ragged batches; raise on any mismatch"""
+    rng = np.random.default_rng(seed)
+    for trial in range(trials):
+        seqs = random_batch(rng, int(rng.integers(1, batch_size + 1)), channels, max_len)
+
+        # Inference: shifting_inputs + rpadding
+        shifted = [reference_shifting_inputs(seq, PAD_TOKEN_ID, max_channels=channels) for seq in seqs]
+        for seq, ref in zip(seqs, shifted):
+            assert np.array_equal(delay_pattern.delay(seq, FILLER, PAD_TOKEN_ID), ref), f"delay mismatch in trial {trial}"
+            assert np.array_equal(delay_pattern.undelay(ref), seq), f"undelay mismatch in trial {trial}"
+        ref_ids, ref_mask = reference_rpadding(shifted, channels, PAD_TOKEN_ID)
+        for kind in (np.asarray, torch.from_numpy):
+            ids, mask = delay_pattern.delay_batch([kind(seq) for seq in seqs], FILLER, PAD_TOKEN_ID, side="left")
+            assert torch.equal(torch.as_tensor(ids), ref_ids), f"delay_batch ids mismatch in trial {trial}"
+            assert torch.equal(torch.as_tensor(mask), ref_mask), f"delay_batch mask mismatch in trial {trial}"
+            ids, mask = delay_pattern.pad_batch([kind(ref) for ref in shifted], FILLER, PAD_TOKEN_ID, side="left")
+            assert torch.equal(torch.as_tensor(ids), ref_ids), f"pad_batch ids mismatch in trial {trial}"
+
+        # Inference: unshift of generated outputs
+        assert torch.equal(delay_pattern.undelay(ref_ids), reference_unshift(ref_ids, channels)), f"batched undelay mismatch in trial {trial}"
+
+        # Training: truncate_and_shift + collator, with and without truncation
+        labels = [rng.integers(-100, 2048, size=seq.shape).astype(np.int64) for seq in seqs]
+        refs = [reference_truncate_and_shift(seq, lbl, channels, PAD_TOKEN_ID) for seq, lbl in zip(seqs, labels)]
+        for max_length in (10 ** 6, int(rng.integers(1, max_len + channels))):
+            ref_ids, ref_labels, ref_mask = reference_collate(*zip(*refs), max_length, PAD_TOKEN_ID)
+            ids, mask = delay_pattern.delay_batch(seqs, FILLER, PAD_TOKEN_ID, side="right", max_length=max_length)
+            lbls, _ = delay_pattern.delay_batch(labels, -100, side="right", max_length=max_length)
+            assert np.array_equal(ids, ref_ids.numpy()), f"training ids mismatch in trial {trial}"
+            assert np.array_equal(lbls, ref_labels.numpy()), f"training labels mismatch in trial {trial}"
+            assert np.array_equal(mask.astype(np.int64), ref_mask.numpy()), f"training mask mismatch in trial {trial}"
+    print(f"All {trials} trials match the reference implementations")
+
+
+def benchmark(batch_size, channels, max_len, repeats=20, seed=0):
+    """Time the reference loops against delay_pattern on one batch"""
+    rng = np.random.default_rng(seed)
+    seqs = random_batch(rng, batch_size, channels, max_len)
+
+    def timed(fn):
+        fn()
+        begin = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - begin) / repeats * 1000
+
+    ref_ids, _ = reference_rpadding([reference_shifting_inputs(s, PAD_TOKEN_ID, max_channels=channels) for s in seqs], channels, PAD_TOKEN_ID)
+    results = {
+        "shift+pad (reference)": timed(lambda: reference_rpadding(
+            [reference_shifting_inputs(s, PAD_TOKEN_ID, max_channels=channels) for s in seqs], channels, PAD_TOKEN_ID)),
+        "delay_batch (numpy)": timed(lambda: delay_pattern.delay_batch(seqs, FILLER, PAD_TOKEN_ID)),
+        "unshift (reference)": timed(lambda: reference_unshift(ref_ids, channels)),
+        "undelay (torch)": timed(lambda: delay_pattern.undelay(ref_ids)),
+    }
+    print(f"Batch of {batch_size} sequences of up to {max_len} frames, {channels} channels:")
+    for name, ms in results.items():
+        print(f"  {name:<24} {ms:8.3f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the vectorized delay-pattern utilities")
+    parser.add_argument("--trials", type=int, default=200, help="Random batches compared with the reference loops")
+    parser.add_argument("--batch_size", type=int, default=16, help="Largest batch size of the check, batch size of the benchmark")
+    parser.add_argument("--channels", type=int, default=8, help="Number of token channels")
+    parser.add_argument("--max_len", type=int, default=64, help="Longest random sequence of the check")
+    parser.add_argument("--benchmark_len", type=int, default=2000, help="Longest sequence of the benchmark")
+    args = parser.parse_args()
+
+    check(args.trials, args.batch_size, args.channels, args.max_len)
+    benchmark(args.batch_size, args.channels, args.benchmark_len)
+
+
+if __name__ == "__main__":
+    main()
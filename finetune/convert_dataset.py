@@ -0,0 +1,68 @@
+"""Convert pickled finetune data (<name>.pkl + <name>_metas.npy) into memory-mapped code store packs
+
+    python finetune/convert_dataset.py --data_dir data/ --output_dir data_packed/
+
+Each pickle file becomes <output_dir>/<name>/ with input_ids/ and labels/ stores (see speech_codes.CodeStore):
+uint16 speech channels and an int32 text channel, about a quarter of the int64 size and a small fraction of
+the pickled lists. finetune.py reads the packs directly with --data_dir <output_dir>.
+"""
+import os
+import sys
+import pickle
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from speech_codes import CodeStore
+
+MAX_CHANNELS = 8
+
+
+def convert_pickle(pkl_file, pack_dir, channels=MAX_CHANNELS):
+    """Append every sample of one pickle file to the input_ids and labels stores of pack_dir
+
+    Returns:
+        int: Number of samples converted
+    """
+    input_store = CodeStore(os.path.join(pack_dir, "input_ids"), channels=channels, text_channel=True)
+    label_store = CodeStore(os.path.join(pack_dir, "labels"), channels=channels, text_channel=True)
+    if len(input_store) or len(label_store):
+        raise ValueError(f"{pack_dir} already holds converted samples")
+
+    metas = np.load(pkl_file.replace(".pkl", "_metas.npy"))
+    count = 0
+    with open(pkl_file, "rb") as f:
+        for start_pointer in metas[0]:
+            f.seek(int(start_pointer))
+            example = pickle.load(f)
+            input_store.append(np.array(example["input_ids"], dtype=np.int64)[:, :channels])
+            label_store.append(np.array(example["labels"], dtype=np.int64)[:, :channels])
+            count += 1
+    input_store.close()
+    label_store.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pickled finetune data into code store packs")
+    parser.add_argument("--data_dir", type=str, required=True, help="Directory holding the .pkl and _metas.npy files")
+    parser.add_argument("--output_dir", type=str, required=True, help="Directory for the code store packs")
+    parser.add_argument("--channels", type=int, default=MAX_CHANNELS, help="Channels kept per frame (default: 8)")
+    args = parser.parse_args()
+
+    pkls = sorted(each for each in os.listdir(args.data_dir) if each.endswith(".pkl"))
+    if not pkls:
+        print(f"No .pkl files found in {args.data_dir}")
+        return
+    total = 0
+    for pkl in pkls:
+        pack_dir = os.path.join(args.output_dir, pkl[:-len(".pkl")])
+        count = convert_pickle(os.path.join(args.data_dir, pkl), pack_dir, args.channels)
+        print(f"Converted {count} samples from {pkl} to {pack_dir}")
+        total += count
+    print(f"Conversion completed. {total} samples in {len(pkls)} packs under {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
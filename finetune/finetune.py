@@ -9,6 +9,8 @@ from torch.utils.data import Dataset
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from modeling_asteroid import AsteroidTTSInstruct
+import delay_pattern
+from speech_codes import CodeStore
 from transformers import AutoTokenizer
 from transformers.trainer import Trainer
 from transformers.training_args import TrainingArguments
@@ -22,11 +24,29 @@ MODEL_PATH = "fnlp/MOSS-TTSD-v0.5"
 MAX_CHANNELS = 8
 
 class LazySupervisedDataset(Dataset):
+    """Training samples from code stores (see convert_dataset.py) and/or legacy pickle files in data_dir
+
+    A code store pack is a subdirectory holding input_ids/ and labels/ speech_codes.CodeStore directories;
+    its samples stay memory-mapped and are read on access. Pickle files are loaded into memory as before.
+    """
+
     def __init__(self, data_dir, channels: int, tokenizer: PreTrainedTokenizer):
         super(LazySupervisedDataset, self).__init__()
         self.tokenizer, self.channels = tokenizer, channels
-        pkls = [os.path.join(data_dir, each) for each in os.listdir(data_dir) if each.endswith('.pkl')]
         self.data = []
+
+        # Code store packs, referenced as ((input_ids store, labels store), position)
+        self.packs = []
+        for each in sorted(os.listdir(data_dir)):
+            pack_dir = os.path.join(data_dir, each)
+            if os.path.exists(os.path.join(pack_dir, "input_ids", "store.json")):
+                pack = (CodeStore(os.path.join(pack_dir, "input_ids")), CodeStore(os.path.join(pack_dir, "labels")))
+                if len(pack[0]) != len(pack[1]):
+                    raise ValueError(f"Code store pack {pack_dir} has {len(pack[0])} input_ids but {len(pack[1])} labels entries")
+                self.packs.append(pack)
+                self.data.extend((pack, position) for position in range(len(pack[0])))
+
+        pkls = [os.path.join(data_dir, each) for each in os.listdir(data_dir) if each.endswith('.pkl')]
         for pkl_file in pkls:
             # Load metas file containing three arrays: [pointers, tokens_lengths, tims_lengths]
             metas = np.load(pkl_file.replace(".pkl", "_metas.npy"))
@@ -45,20 +65,13 @@ class LazySupervisedDataset(Dataset):
     
     def truncate_and_shift(self, example: Dict[str, List]) -> Dict[str, np.ndarray]:
         # Read input_ids and labels from data instead of copying input_ids
-        input_ids = np.array(example["input_ids"])[:, :self.channels]
-        labels = np.array(example["labels"])[:, :self.channels]  # Use labels from data
-        
-        seq_len = input_ids.shape[0]
-        new_seq_len = seq_len + self.channels - 1
-
-        shifted_input_ids = np.full((new_seq_len, self.channels), 1024)
-        shifted_input_ids[:, 0] = np.full(new_seq_len, self.tokenizer.pad_token_id)
-        shifted_labels = np.full((new_seq_len, self.channels), -100)
+        input_ids = np.array(example["input_ids"], dtype=np.int64)[:, :self.channels]
+        labels = np.array(example["labels"], dtype=np.int64)[:, :self.channels]  # Use labels from data
+        new_seq_len = input_ids.shape[0] + self.channels - 1
 
         # Delay Pattern: Shift input_ids and labels
-        for i in range(self.channels):
-            shifted_input_ids[i : (seq_len + i), i] = input_ids[:, i]
-            shifted_labels[i : (seq_len + i), i] = labels[:, i]
+        shifted_input_ids = delay_pattern.delay(input_ids, 1024, self.tokenizer.pad_token_id)
+        shifted_labels = delay_pattern.delay(labels, -100)
         
         return {
             "input_ids": shifted_input_ids,
@@ -68,6 +81,9 @@ class LazySupervisedDataset(Dataset):
 
     def __getitem__(self, i) -> Dict[str, np.ndarray]:
         line = self.data[i]
+        if isinstance(line, tuple):
+            (input_ids, labels), position = line
+            line = {"input_ids": input_ids.get(position), "labels": labels.get(position)}
         
         # Data validation
         if "input_ids" not in line or "labels" not in line:
@@ -82,32 +98,16 @@ class DataCollatorForSupervisedDataset:
     filler_token_id: int = 1024
 
     def __call__(self, instances: List[Dict[str, np.ndarray]]) -> Dict[str, torch.Tensor]:
-        input_ids = [instance["input_ids"] for instance in instances]
-        labels = [instance["labels"] for instance in instances]
-        attention_masks = [instance["attention_mask"] for instance in instances]
-        channels = input_ids[0].shape[1]
-        max_length = min(max(ids.shape[0] for ids in input_ids), self.max_length)
-        padded_input_ids, padded_labels, padded_attns = [], [], []
-        
-        for ids, lbls, attn in zip(input_ids, labels, attention_masks):
-            seq_len = ids.shape[0]
-            if seq_len < max_length:
-                pad_len = max_length - seq_len
-                input_pad = np.full((pad_len, channels), self.filler_token_id)
-                input_pad[:, 0] = self.pad_token_id
-                padded_input_ids.append(np.concatenate([ids, input_pad]))
-                label_pad = np.full((pad_len, channels), -100)
-                padded_labels.append(np.concatenate([lbls, label_pad]))
-                attn_pad = np.zeros(pad_len)
-                padded_attns.append(np.concatenate([attn, attn_pad]))
-            else:
-                padded_input_ids.append(ids[:max_length])
-                padded_labels.append(lbls[:max_length])
-                padded_attns.append(attn[:max_length])
+        # Right-pad (and truncate to max_length) the whole batch in one preallocated buffer per field
+        input_ids, attention_mask = delay_pattern.pad_batch(
+            [instance["input_ids"] for instance in instances], self.filler_token_id, self.pad_token_id,
+            side="right", max_length=self.max_length)
+        labels, _ = delay_pattern.pad_batch(
+            [instance["labels"] for instance in instances], -100, side="right", max_length=self.max_length)
 
-        input_ids = torch.tensor(np.stack(padded_input_ids), dtype=torch.long)
-        labels = torch.tensor(np.stack(padded_labels), dtype=torch.long)
-        attention_mask = torch.tensor(np.stack(padded_attns), dtype=torch.long)
+        input_ids = torch.from_numpy(input_ids).long()
+        labels = torch.from_numpy(labels).long()
+        attention_mask = torch.from_numpy(attention_mask).long()
 
         return {
             "input_ids": input_ids,
@@ -1,27 +1,79 @@
 import os
-import re
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
-import torchaudio
 import numpy as np
 
 from transformers import AutoTokenizer
 from modeling_asteroid import AsteroidTTSInstruct
 from XY_Tokenizer.xy_tokenizer.model import XY_Tokenizer
+from code_cache import PromptCodeCache, checkpoint_fingerprint
+import audio_ingest
+import delay_pattern
+from text_normalizer import DEFAULT_NORMALIZER
+from prompt_tokenizer import PromptTokenizer, build_prompt
+from speech_codes import to_code_array
+from audio_writer import to_host
 
 MAX_CHANNELS = 8
 SILENCE_DURATION = 0.0  # Fixed silence duration: 0 seconds
+CODE_FRAME_RATE = 12.5  # XY_Tokenizer code frames per second
+OUTPUT_FRAMES_PER_TEXT_TOKEN = 4.0  # Rough speech frames generated per text token, used only for batch planning
 
-def load_model(model_path, spt_config_path, spt_checkpoint_path, torch_dtype=torch.bfloat16, attn_implementation="flash_attention_2"):
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    
-    model = AsteroidTTSInstruct.from_pretrained(model_path, torch_dtype=torch_dtype, attn_implementation=attn_implementation)
+# In-memory cache of reference-audio codes shared by all callers that don't pass their own
+PROMPT_CODE_CACHE = PromptCodeCache()
 
-    spt = XY_Tokenizer.load_from_checkpoint(config_path=spt_config_path, ckpt_path=spt_checkpoint_path)
-    
-    model.eval()
-    spt.eval()
-    return tokenizer, model, spt
+# One segment-memoizing PromptTokenizer per LM tokenizer
+_PROMPT_TOKENIZERS = {}
+
+
+def get_prompt_tokenizer(tokenizer):
+    """Shared PromptTokenizer of an LM tokenizer"""
+    if id(tokenizer) not in _PROMPT_TOKENIZERS:
+        _PROMPT_TOKENIZERS[id(tokenizer)] = PromptTokenizer(tokenizer)
+    return _PROMPT_TOKENIZERS[id(tokenizer)]
+
+def load_model(model_path, spt_config_path, spt_checkpoint_path, torch_dtype=torch.bfloat16, attn_implementation="flash_attention_2", spt_precision="fp32",
+               device=None, parallel=True, local_files_only=False, checkpoint_id=None):
+    """Load the LM tokenizer, the Asteroid LM and the XY_Tokenizer codec
+
+    The three are independent, so by default they load on separate threads: file reads, weight
+    deserialization and host-to-device copies release the GIL and overlap.
+
+    Args:
+        device: Optional device each model is moved to as soon as it is loaded
+        parallel: Load the three concurrently
+        local_files_only: Never contact the Hub, e.g. for a model bundle (see model_bundle.py)
+        checkpoint_id: Codec identity used in cache keys, fingerprinted from spt_checkpoint_path if None
+
+    Returns:
+        tuple: (tokenizer, model, spt)
+    """
+    if spt_precision == "int8" and device is not None and torch.device(device).type != "cpu":
+        # Dynamically quantized Linear layers have no CUDA kernels; fail here rather than on the first encode
+        raise ValueError(f"Codec precision int8 is CPU only, but the models are loaded on {device}; use fp32, bf16 or fp16")
+
+    def load_tokenizer():
+        return AutoTokenizer.from_pretrained(model_path, local_files_only=local_files_only)
+
+    def load_lm():
+        model = AsteroidTTSInstruct.from_pretrained(model_path, torch_dtype=torch_dtype, attn_implementation=attn_implementation,
+                                                    local_files_only=local_files_only)
+        model.eval()
+        return model.to(device) if device is not None else model
+
+    def load_codec():
+        spt = XY_Tokenizer.load_from_checkpoint(config_path=spt_config_path, ckpt_path=spt_checkpoint_path, precision=spt_precision)
+        spt.checkpoint_id = checkpoint_id or checkpoint_fingerprint(spt_checkpoint_path)  # Part of the prompt code cache key
+        spt.eval()
+        return spt.to(device) if device is not None else spt
+
+    loaders = (load_tokenizer, load_lm, load_codec)
+    if not parallel:
+        return tuple(loader() for loader in loaders)
+    with ThreadPoolExecutor(max_workers=len(loaders)) as pool:
+        futures = [pool.submit(loader) for loader in loaders]
+        return tuple(future.result() for future in futures)
 
 
 def process_jsonl_item(item):
@@ -87,7 +139,129 @@ def process_jsonl_item(item):
     }
 
 
-def load_audio_data(prompt_audio, target_sample_rate=16000):
+def estimate_item_tokens(item, tokenizer, system_prompt=""):
+    """Cheap estimate of an item's prompt length and generated length, without loading its audio
+
+    Args:
+        item: Data item in any format accepted by process_jsonl_item
+        tokenizer: LM tokenizer
+        system_prompt: System prompt prepended to every item
+
+    Returns:
+        tuple: (prompt_tokens, output_frames), the prompt including reference audio frames
+    """
+    processed_item = process_jsonl_item(item)
+    prompt_tokenizer = get_prompt_tokenizer(tokenizer)
+    text_tokens = len(prompt_tokenizer.encode(processed_item["text"]))
+    full_text = processed_item["prompt_text"] + processed_item["text"]
+    prompt_tokens = len(prompt_tokenizer.encode(build_prompt(system_prompt, full_text))) + MAX_CHANNELS - 1
+
+    prompt_audio = processed_item["prompt_audio"]
+    if prompt_audio:
+        try:
+            seconds = sum(audio_ingest.duration_seconds(audio) for audio in _speaker_inputs(prompt_audio) if audio)
+            prompt_tokens += int(seconds * CODE_FRAME_RATE)
+        except Exception as e:
+            # Unreadable audio fails later, when the item is loaded
+            print(f"Warning: could not read prompt audio duration: {e}")
+    return prompt_tokens, int(text_tokens * OUTPUT_FRAMES_PER_TEXT_TOKEN)
+
+
+def padding_efficiency(costs):
+    """Share of a batch's padded prompt + output positions that hold real tokens
+
+    Args:
+        costs: (prompt_tokens, output_frames) of each item, e.g. from estimate_item_tokens
+    """
+    if not costs:
+        return 1.0
+    padded = len(costs) * (max(prompt for prompt, _ in costs) + max(output for _, output in costs))
+    return sum(prompt + output for prompt, output in costs) / padded if padded else 1.0
+
+
+def bucket_batches(indexed_items, cost_fn, max_batch_tokens=None, max_batch_size=None, lookahead=64,
+                   bucket_tokens=128, min_efficiency=0.0, report=True):
+    """Group a stream of items into length-bucketed (indices, batch_items) batches
+
+    Items are read lookahead at a time and ordered by prompt-length bucket, then predicted output length,
+    so that a batch holds items of similar lengths and rpadding and generation waste little on padding.
+    A batch is closed when adding the next item would push its padded cost,
+    batch_size * (longest prompt + longest predicted output), over max_batch_tokens, exceed max_batch_size,
+    or drop its padding efficiency below min_efficiency. An item over the budget on its own forms a batch of one.
+
+    Args:
+        indexed_items: Iterable of (index, item) pairs, e.g. enumerate(items); it is consumed lazily
+        cost_fn: Function item -> (prompt_tokens, output_frames), e.g. estimate_item_tokens
+        max_batch_tokens: Optional padded token budget of one batch
+        max_batch_size: Optional cap on the number of items per batch
+        lookahead: Number of items sorted together
+        bucket_tokens: Width of the prompt and output length buckets
+        min_efficiency: Lowest padding efficiency (see padding_efficiency) a batch may reach by growing
+        report: Print the size and padding efficiency of every batch
+
+    Yields:
+        tuple: (indices, batch_items)
+    """
+    def emit(batch):
+        if report:
+            print(f"Batch of {len(batch)} items {[entry[0] for entry in batch][:8]}{'...' if len(batch) > 8 else ''}: "
+                  f"padding efficiency {padding_efficiency([entry[2] for entry in batch]):.1%}")
+        return [entry[0] for entry in batch], [entry[1] for entry in batch]
+
+    def pack(window):
+        window.sort(key=lambda entry: (entry[2][0] // bucket_tokens, entry[2][1] // bucket_tokens, entry[2][0]))
+        batch = []
+        for entry in window:
+            if batch:
+                costs = [e[2] for e in batch] + [entry[2]]
+                padded = len(costs) * (max(c[0] for c in costs) + max(c[1] for c in costs))
+                if ((max_batch_tokens and padded > max_batch_tokens)
+                        or (max_batch_size and len(batch) >= max_batch_size)
+                        or padding_efficiency(costs) < min_efficiency):
+                    yield emit(batch)
+                    batch = []
+            batch.append(entry)
+        if batch:
+            yield emit(batch)
+
+    window = []
+    for idx, item in indexed_items:
+        window.append((idx, item, cost_fn(item)))
+        if len(window) >= lookahead:
+            yield from pack(window)
+            window = []
+    yield from pack(window)
+
+
+# Reference audio read per speaker when trimming caps it to max_seconds: silence removal and the best-SNR
+# window search in audio_ingest.trim_prompt still get some material to choose from
+PROMPT_READ_FACTOR = 2.0
+
+
+def prompt_read_seconds(trim_options):
+    """Seconds of each reference worth decoding under trim_options, None to read whole files"""
+    if not trim_options or trim_options.get("max_seconds") is None:
+        return None
+    return trim_options["max_seconds"] * PROMPT_READ_FACTOR
+
+
+def trim_speaker_audio(wav, target_sample_rate=16000, trim_options=None, name="prompt"):
+    """Apply audio_ingest.trim_prompt to one speaker's reference, warning when its prompt text may no longer match
+
+    Args:
+        trim_options: None to disable trimming, otherwise keyword arguments of audio_ingest.trim_prompt
+    """
+    if trim_options is None:
+        return wav
+    original_seconds = wav.shape[-1] / target_sample_rate
+    wav, capped = audio_ingest.trim_prompt(wav, target_sample_rate, **trim_options)
+    if capped:
+        print(f"Warning: {name} audio was capped from {original_seconds:.1f}s to {wav.shape[-1] / target_sample_rate:.1f}s, "
+              f"its prompt text may no longer match the audio")
+    return wav
+
+
+def load_audio_data(prompt_audio, target_sample_rate=16000, trim_options=None):
     """Load audio data and return processed audio tensor
     
     Args:
@@ -95,6 +269,7 @@ def load_audio_data(prompt_audio, target_sample_rate=16000):
             - String: audio file path
             - Tuple: (wav, sr) result from torchaudio.load
             - Dict: {"speaker1": path_or_tuple, "speaker2": path_or_tuple}
+        trim_options: Optional keyword arguments of audio_ingest.trim_prompt, applied to each speaker
     """
     if prompt_audio is None:
         return None
@@ -103,23 +278,19 @@ def load_audio_data(prompt_audio, target_sample_rate=16000):
         # Check if prompt_audio is a dictionary (containing speaker1 and speaker2)
         if isinstance(prompt_audio, dict) and "speaker1" in prompt_audio and "speaker2" in prompt_audio:
             # Process audio from both speakers separately
-            wav1, sr1 = _load_single_audio(prompt_audio["speaker1"])
-            wav2, sr2 = _load_single_audio(prompt_audio["speaker2"])
+            read_seconds = prompt_read_seconds(trim_options)
+            wav1 = audio_ingest.load_mono(prompt_audio["speaker1"], target_sample_rate, max_seconds=read_seconds)
+            wav2 = audio_ingest.load_mono(prompt_audio["speaker2"], target_sample_rate, max_seconds=read_seconds)
+            wav1 = trim_speaker_audio(wav1, target_sample_rate, trim_options, name="speaker1")
+            wav2 = trim_speaker_audio(wav2, target_sample_rate, trim_options, name="speaker2")
             # Merge audio from both speakers
-            wav = merge_speaker_audios(wav1, sr1, wav2, sr2, target_sample_rate)
+            wav = merge_speaker_audios(wav1, target_sample_rate, wav2, target_sample_rate, target_sample_rate)
             if wav is None:
                 return None
         else:
-            # Single audio
-            wav, sr = _load_single_audio(prompt_audio)
-            # Resample to 16k
-            if sr != target_sample_rate: 
-                wav = torchaudio.functional.resample(wav, sr, target_sample_rate)
-            # Ensure mono channel
-            if wav.shape[0] > 1:
-                wav = wav.mean(dim=0, keepdim=True)  # Convert multi-channel to mono
-            if len(wav.shape) == 1: 
-                wav = wav.unsqueeze(0)
+            # Single audio, resampled to 16k and mixed to mono
+            wav = audio_ingest.load_mono(prompt_audio, target_sample_rate, max_seconds=prompt_read_seconds(trim_options))
+            wav = trim_speaker_audio(wav, target_sample_rate, trim_options)
         
         return wav
     except Exception as e:
@@ -136,38 +307,15 @@ def _load_single_audio(audio_input):
     Returns:
         tuple: (wav, sr)
     """
-    if isinstance(audio_input, tuple) and len(audio_input) == 2:
-        # Already a (wav, sr) tuple
-        wav, sr = audio_input
-        return wav, sr
-    elif isinstance(audio_input, str):
-        # Is a file path, needs to be loaded
-        wav, sr = torchaudio.load(audio_input)
-        return wav, sr
-    else:
-        raise ValueError(f"Unsupported audio input format: {type(audio_input)}")
+    return audio_ingest.load_waveform(audio_input)
 
 
 def merge_speaker_audios(wav1, sr1, wav2, sr2, target_sample_rate=16000):
     """Merge audio data from two speakers"""
     try:
-        # Process first audio
-        if sr1 != target_sample_rate:
-            wav1 = torchaudio.functional.resample(wav1, sr1, target_sample_rate)
-        # Ensure mono channel
-        if wav1.shape[0] > 1:
-            wav1 = wav1.mean(dim=0, keepdim=True)  # Convert multi-channel to mono
-        if len(wav1.shape) == 1:
-            wav1 = wav1.unsqueeze(0)
-        
-        # Process second audio  
-        if sr2 != target_sample_rate:
-            wav2 = torchaudio.functional.resample(wav2, sr2, target_sample_rate)
-        # Ensure mono channel
-        if wav2.shape[0] > 1:
-            wav2 = wav2.mean(dim=0, keepdim=True)  # Convert multi-channel to mono
-        if len(wav2.shape) == 1:
-            wav2 = wav2.unsqueeze(0)
+        # Resample to the target rate and ensure mono channel
+        wav1 = audio_ingest.resample(audio_ingest.to_mono(wav1), sr1, target_sample_rate)
+        wav2 = audio_ingest.resample(audio_ingest.to_mono(wav2), sr2, target_sample_rate)
         
         # Concatenate audio
         merged_wav = torch.cat([wav1, wav2], dim=1)
@@ -177,64 +325,180 @@ def merge_speaker_audios(wav1, sr1, wav2, sr2, target_sample_rate=16000):
         raise
 
 
-def process_inputs(tokenizer, spt, prompt, text, device, audio_data=None, max_channels=8, pad_token=1024):
-    seq = f"<|begin_of_style|>{prompt}<|end_of_style|>\n<|begin_of_text|>{text}<|end_of_text|>\n<|begin_of_speech|>"
-    inputs1 = np.array(tokenizer.encode(seq))
+def _speaker_inputs(prompt_audio):
+    """Split a prompt audio value into its per-speaker inputs"""
+    if isinstance(prompt_audio, dict) and "speaker1" in prompt_audio and "speaker2" in prompt_audio:
+        return [prompt_audio["speaker1"], prompt_audio["speaker2"]]
+    return [prompt_audio]
+
+
+def load_speaker_audios(prompt_audio, target_sample_rate=16000, max_seconds=None, trim_options=None):
+    """Load prompt audio as a list of per-speaker mono tensors, without merging the speakers
+
+    Args:
+        prompt_audio: Same formats as load_audio_data
+        max_seconds: If set, read at most this many seconds of each speaker's reference
+        trim_options: Optional keyword arguments of audio_ingest.trim_prompt, applied to each speaker
+
+    Returns:
+        list: One (1, T) tensor per speaker, or None
+    """
+    if prompt_audio is None:
+        return None
+    return load_batch_speaker_audios([prompt_audio], target_sample_rate, max_seconds, trim_options)[0]
+
+
+def load_batch_speaker_audios(prompt_audios, target_sample_rate=16000, max_seconds=None, trim_options=None):
+    """load_speaker_audios for a whole batch: shared files are read once and same-rate inputs are resampled together
+
+    Unless max_seconds is given, a trim_options cap limits how much of each file is decoded (see prompt_read_seconds).
+
+    Returns:
+        list: Per item, a list of (1, T) tensors or None
+    """
+    if max_seconds is None:
+        max_seconds = prompt_read_seconds(trim_options)
+    inputs, owners = [], []
+    for i, prompt_audio in enumerate(prompt_audios):
+        if prompt_audio:
+            for audio_input in _speaker_inputs(prompt_audio):
+                inputs.append(audio_input)
+                owners.append(i)
+
+    wavs = audio_ingest.load_mono_batch(inputs, target_sample_rate, max_seconds=max_seconds) if inputs else []
+    item_wavs = [[] if prompt_audio else None for prompt_audio in prompt_audios]
+    for i, wav in zip(owners, wavs):
+        name = f"speaker{len(item_wavs[i]) + 1}" if isinstance(prompt_audios[i], dict) else "prompt"
+        item_wavs[i].append(trim_speaker_audio(wav, target_sample_rate, trim_options, name=name))
+    return item_wavs
+
+
+def _pad_to_frame(wav, frame_size):
+    """Right-pad a (1, T) waveform with silence to a multiple of the codec frame size"""
+    pad = (-wav.shape[-1]) % frame_size
+    return torch.nn.functional.pad(wav, (0, pad)) if pad else wav
+
+
+def _prepare_prompt_segments(spt, wavs):
+    """Pad every speaker segment but the last to a whole codec frame and append the fixed silence to the last one"""
+    segments = [_pad_to_frame(wav, spt.encoder_downsample_rate) for wav in wavs[:-1]]
+    # Add fixed silence at the end of audio (using 16k sample rate)
+    silence = torch.zeros(wavs[-1].shape[0], int(SILENCE_DURATION * 16000))
+    segments.append(torch.cat([wavs[-1], silence], dim=1))
+    return segments
+
+
+def encode_prompt_codes(spt, wavs, device, code_cache=None):
+    """Encode each speaker's reference independently and concatenate the codes
+
+    Every segment but the last is padded to a whole codec frame, so the result has the same
+    number of frames as encoding the concatenated (padded) waveform, and each speaker's codes
+    can be reused from the cache in any pairing.
+
+    Returns:
+        np.ndarray: Codes of shape (T, nq)
+    """
+    return encode_batch_prompt_codes(spt, [wavs], device, code_cache)[0]
+
+
+def encode_batch_prompt_codes(spt, wavs_list, device, code_cache=None):
+    """Encode the prompts of a whole batch with as few codec calls as possible
+
+    All speaker segments of all items go through one PromptCodeCache.encode_batch call, which
+    deduplicates them and encodes the misses in length-bucketed batches; the codes are then fanned
+    back out and concatenated per item.
+
+    Args:
+        wavs_list: Per item, a list of per-speaker (1, T) tensors or None
+
+    Returns:
+        list: Per item, codes of shape (T, nq) or None
+    """
+    code_cache = code_cache if code_cache is not None else PROMPT_CODE_CACHE
+    segments, owners = [], []
+    for i, wavs in enumerate(wavs_list):
+        if wavs:
+            for segment in _prepare_prompt_segments(spt, wavs):
+                segments.append(segment)
+                owners.append(i)
+
+    codes_list = code_cache.encode_batch(spt, segments, device) if segments else []
+    item_codes = [[] for _ in wavs_list]
+    for i, codes in zip(owners, codes_list):
+        item_codes[i].append(codes)
+    return [np.concatenate(codes) if codes else None for codes in item_codes]
+
+
+def check_prompt_code_concat(spt, wavs, device, boundary_frames=4):
+    """Compare code-level concatenation against encoding the concatenated waveform
+
+    Args:
+        spt: XY_Tokenizer codec
+        wavs: Per-speaker (1, T) tensors at spt.input_sample_rate
+        boundary_frames: Frames on each side of a speaker boundary counted as the boundary region
+
+    Returns:
+        dict: Frame counts of both paths and the code agreement overall and around the boundaries
+    """
+    concat_codes = encode_prompt_codes(spt, wavs, device, code_cache=PromptCodeCache(max_entries=len(wavs)))
+    padded = _prepare_prompt_segments(spt, wavs)
+    with torch.no_grad():
+        merged_codes = spt.encode([torch.cat(padded, dim=1).squeeze().to(device)], device=device)["codes_list"][0].permute(1, 0).cpu().numpy()
+
+    length = min(len(concat_codes), len(merged_codes))
+    matches = concat_codes[:length] == merged_codes[:length]  # (T, nq)
+    boundaries = np.cumsum([wav.shape[-1] // spt.encoder_downsample_rate for wav in padded[:-1]])
+    boundary_mask = np.zeros(length, dtype=bool)
+    for boundary in boundaries:
+        boundary_mask[max(0, boundary - boundary_frames):boundary + boundary_frames] = True
+
+    return {
+        "code_concat_frames": len(concat_codes),
+        "waveform_concat_frames": len(merged_codes),
+        "agreement": float(matches.mean()) if length else 1.0,
+        "boundary_agreement": float(matches[boundary_mask].mean()) if boundary_mask.any() else 1.0,
+    }
+
+
+def process_inputs(tokenizer, spt, prompt, text, device, audio_data=None, max_channels=8, pad_token=1024, code_cache=None, audio_codes=None, prompt_ids=None):
+    if prompt_ids is None:
+        # Token ids of the text part, e.g. precomputed for the whole batch by PromptTokenizer.encode_batch
+        prompt_ids = get_prompt_tokenizer(tokenizer).encode(build_prompt(prompt, text))
+    inputs1 = np.array(prompt_ids)
     input_ids = np.full((inputs1.shape[0], max_channels), pad_token)
     input_ids[:, 0] = inputs1
     
-    if audio_data is not None:
+    if audio_data is not None and audio_codes is None:
         try:
-            # audio_data should now be a processed audio tensor
-            wav = audio_data
-            
-            # Add fixed 5-second silence at the end of audio (using 16k sample rate)
-            silence_samples = int(SILENCE_DURATION * 16000)
-            silence = torch.zeros(wav.shape[0], silence_samples)
-            wav = torch.cat([wav, silence], dim=1)
+            # audio_data is a processed audio tensor, or a list of per-speaker tensors from load_speaker_audios
+            wavs = list(audio_data) if isinstance(audio_data, (list, tuple)) else [audio_data]
             
-            with torch.no_grad():
-                # Use SPT encoding
-                encode_result = spt.encode([wav.squeeze().to(device)])
-                audio_token = encode_result["codes_list"][0].permute(1, 0).cpu().numpy()  # Adjust dimension order
-                
-            # similar to DAC encoding adjustment
-            audio_token[:, 0] = audio_token[:, 0] + 151665  # Keep this line if offset is needed, otherwise delete
-            input_ids = np.concatenate([input_ids, audio_token])
+            # Use SPT encoding per speaker, served from the cache when a waveform was already encoded
+            audio_codes = encode_prompt_codes(spt, wavs, device, code_cache)  # (T, nq)
         except Exception as e:
             print(f"Error processing audio data: {e}")
             raise
+
+    if audio_codes is not None:
+        # audio_codes are (T, nq) prompt codes, e.g. precomputed for the whole batch by encode_batch_prompt_codes
+        audio_token = np.array(audio_codes, dtype=np.int64)  # Compact codes would overflow with the offset
+        # similar to DAC encoding adjustment
+        audio_token[:, 0] = audio_token[:, 0] + 151665  # Keep this line if offset is needed, otherwise delete
+        input_ids = np.concatenate([input_ids, audio_token])
     
     return input_ids
 
 
 def shifting_inputs(input_ids, tokenizer, pad_token=1024, max_channels=8):
-    seq_len = input_ids.shape[0]
-    new_seq_len = seq_len + max_channels - 1
-    shifted_input_ids = np.full((new_seq_len, max_channels), pad_token, dtype=np.int64)
-    shifted_input_ids[:, 0] = np.full(new_seq_len, tokenizer.pad_token_id, dtype=np.int64)
-    for i in range(max_channels):
-        shifted_input_ids[i : (seq_len + i), i] = input_ids[:, i]
-    return shifted_input_ids
+    """Apply the delay pattern to one (T, max_channels) prompt"""
+    return delay_pattern.delay(np.asarray(input_ids, dtype=np.int64)[:, :max_channels], pad_token, tokenizer.pad_token_id)
 
 
 def rpadding(input_ids, channels, tokenizer):
-    attention_masks = [np.ones(inputs.shape[0]) for inputs in input_ids]
-    max_length = max(ids.shape[0] for ids in input_ids)
-    padded_input_ids, padded_attns = [], []
-        
-    for ids, attn in zip(input_ids, attention_masks):
-        pad_len = max_length - ids.shape[0]
-        input_pad = np.full((pad_len, channels), 1024)
-        input_pad[:, 0] = tokenizer.pad_token_id
-        padded_input_ids.append(np.concatenate([input_pad, ids]))
-        attn_pad = np.zeros(pad_len)
-        padded_attns.append(np.concatenate([attn_pad, attn]))
-
-    input_ids = torch.tensor(np.stack(padded_input_ids))
-    attention_mask = torch.tensor(np.stack(padded_attns))
-
-    return input_ids, attention_mask
+    """Left-pad delayed prompts into one batch, returning torch input ids and attention mask"""
+    padded_input_ids, attention_mask = delay_pattern.pad_batch(
+        [np.asarray(ids, dtype=np.int64) for ids in input_ids], 1024, tokenizer.pad_token_id, side="left")
+    return torch.from_numpy(padded_input_ids), torch.from_numpy(attention_mask)
 
 
 def find_max_valid_positions(C: torch.Tensor, invalid_value=1024) -> torch.Tensor:
@@ -261,217 +525,391 @@ def normalize_text(text: str) -> str:
     6. Replace consecutive "哈" (>=2) with "(笑)".
     7. Auto-recognize [S1] / [S2] … tags; if missing, treat as whole segment.
     8. Merge adjacent identical speaker tags.
+
+    Uses the shared, cached text_normalizer.DEFAULT_NORMALIZER.
     """
-    # Replace [1], [2] etc. format with [S1], [S2] etc. format
-    text = re.sub(r'\[(\d+)\]', r'[S\1]', text)
+    return DEFAULT_NORMALIZER(text)
 
-    # Remove decorative characters
-    remove_chars = "【】《》（）『』「」""\"\-""～~"
 
+def prepare_batch_texts(batch_items, system_prompt, indices, use_normalize=False):
+    """Parse a batch of data items into model texts, prompts, prompt audio inputs and text metadata
 
-    # Remove brackets for non-speaker tags (keep content, only remove brackets themselves)
-    text = re.sub(r'\[(?!S\d+\])([^\]]*)\]', r'\1', text)
+    Args:
+        indices: Job-wide index of each item, used in the metadata and output names
+    """
+    batch_size = len(batch_items)
+    prompts = [system_prompt] * batch_size
+    processed_items = [process_jsonl_item(item) for item in batch_items]
+
+    # Merge text, if prompt_text is empty, full_text is just text
+    original_full_texts = [
+        processed_item["prompt_text"] + processed_item["text"] if processed_item["prompt_text"] else processed_item["text"]
+        for processed_item in processed_items
+    ]
+
+    # Apply text normalization based on parameter, once per distinct text
+    normalized_texts = DEFAULT_NORMALIZER.normalize_batch(original_full_texts) if use_normalize else [None] * batch_size
+
+    texts = []
+    prompt_audios = []
+    actual_texts_data = []  # Store actual text data used
+    for i, (processed_item, original_full_text, normalized_text) in enumerate(zip(processed_items, original_full_texts, normalized_texts)):
+        full_text = normalized_text if use_normalize else original_full_text
+
+        # Replace speaker tags
+        final_text = full_text.replace("[S1]", "<speaker1>").replace("[S2]", "<speaker2>")
+        texts.append(final_text)
+
+        # Save actual text information used
+        actual_texts_data.append({
+            "index": indices[i],
+            "original_text": original_full_text,
+            "normalized_text": normalized_text,
+            "final_text": final_text,
+            "use_normalize": use_normalize
+        })
 
-    # Use positive lookahead to split text by speaker tags (tags themselves are still preserved)
-    segments = re.split(r'(?=\[S\d+\])', text.replace("\n", " "))
-    processed_parts = []
+        # Get reference audio
+        prompt_audios.append(processed_item["prompt_audio"])
 
-    for seg in segments:
-        seg = seg.strip()
-        if not seg:
-            continue
+    return texts, prompts, prompt_audios, actual_texts_data
 
-        # Extract tags
-        m = re.match(r'^(\[S\d+\])\s*(.*)', seg)
-        tag, content = m.groups() if m else ('', seg)
 
-        # Remove irrelevant symbols
-        content = re.sub(f"[{re.escape(remove_chars)}]", "", content)
+def build_batch_inputs(tokenizer, spt, texts, prompts, prompt_codes, device):
+    """Build the shifted, left-padded (B, T, MAX_CHANNELS) input ids and attention mask of a batch"""
+    # Tokenize the text parts of the whole batch at once, reusing memoized segments such as the system prompt
+    prompt_ids_list = get_prompt_tokenizer(tokenizer).encode_batch([build_prompt(prompt, text) for text, prompt in zip(texts, prompts)])
+    input_ids_list = [
+        np.asarray(process_inputs(tokenizer, spt, prompt, text, device, audio_codes=audio_codes, prompt_ids=prompt_ids), dtype=np.int64)
+        for text, prompt, audio_codes, prompt_ids in zip(texts, prompts, prompt_codes, prompt_ids_list)
+    ]
 
-        # Handle consecutive "哈" characters: replace 2 or more with "(笑)"
-        content = re.sub(r'哈{2,}', '(笑)', content)
+    # Delay and left-pad the whole batch in one pass
+    input_ids, attention_mask = delay_pattern.delay_batch(input_ids_list, 1024, tokenizer.pad_token_id, side="left")
+    print(f"Prompt padding efficiency: {attention_mask.mean():.1%} of {attention_mask.size} positions")
+    return torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
 
-        # Handle English laughter (e.g., "haha", "ha ha")
-        content = re.sub(r'\b(ha(\s*ha)+)\b', '(laughs)', content, flags=re.IGNORECASE)
 
-        # First handle multi-character punctuation marks
-        content = content.replace('——', '，')
-        content = content.replace('……', '，')
+def generate_speech_ids(model, input_ids, attention_mask, device):
+    """Run batch generation and undo the delay pattern
 
-        # Handle single-character internal punctuation marks
-        internal_punct_map = str.maketrans({
-            '！': '，', '!': ',',
-            '；': '，', ';': ',',
-            '：': '，', ':': ',',
-            '、': '，', 
-            '？': '，', '?': ','
-        })
-        content = content.translate(internal_punct_map)
-        content = content.strip()
+    Returns:
+        tuple: (speech_ids of shape (B, T, MAX_CHANNELS) without the text offset, last valid position per sample)
+    """
+    start = input_ids.shape[1] - MAX_CHANNELS + 1
+
+    # Move inputs to GPU
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+
+    # Generate model outputs
+    outputs = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+    )
+    print(f"Original outputs shape: {outputs.shape}")
+    print(f"Start value: {start}")
+    print(f"Shape after slicing: {outputs[:, start:].shape}")
+    print(f"MAX_CHANNELS: {MAX_CHANNELS}")
+    print(f"Calculated seq_len: {outputs.shape[1] - MAX_CHANNELS + 1}")
+    # Process outputs: undo the delay pattern and the text-vocabulary offset of channel 0
+    speech_ids = delay_pattern.undelay(outputs[:, start:])
+    speech_ids[..., 0] -= 151665
+
+    # Find valid positions for each sample
+    return speech_ids, find_max_valid_positions(speech_ids)
+
+
+def validate_item(item):
+    """Check a data item before it reaches the GPU stages
+
+    Returns:
+        str: Description of the problem, or None if the item is usable
+    """
+    if not isinstance(item, dict):
+        return f"item must be a JSON object, got {type(item).__name__}"
+    try:
+        processed_item = process_jsonl_item(item)
+    except Exception as e:
+        return f"malformed item: {e}"
+    if not isinstance(processed_item["text"], str) or not processed_item["text"].strip():
+        return "empty text"
+
+    prompt_audio = processed_item["prompt_audio"]
+    if prompt_audio:
+        for audio in _speaker_inputs(prompt_audio):
+            if not audio:
+                continue
+            if isinstance(audio, str) and not os.path.isfile(audio):
+                return f"prompt audio not found: {audio}"
+            try:
+                if audio_ingest.duration_seconds(audio) <= 0:
+                    return f"empty prompt audio: {audio if isinstance(audio, str) else 'tensor'}"
+            except Exception as e:
+                return f"unreadable prompt audio: {e}"
+    return None
 
-        # Keep only the final period
-        if len(content) > 1:
-            last_ch = "。" if content[-1] == "，" else ("." if content[-1] == "," else content[-1])
-            body = content[:-1].replace('。', '，')
-            content = body + last_ch
 
-        processed_parts.append({'tag': tag, 'content': content})
+def failed_text_data(index, item, error, use_normalize=False):
+    """Text metadata entry of an item that was rejected before generation"""
+    return {
+        "index": index,
+        "original_text": item.get("text", "") if isinstance(item, dict) else "",
+        "normalized_text": None,
+        "final_text": None,
+        "use_normalize": use_normalize,
+        "error": error
+    }
 
-    if not processed_parts:
-        return ""
 
-    # Merge consecutive same speakers
-    merged_lines = []
-    current_tag = processed_parts[0]['tag']
-    current_content = [processed_parts[0]['content']]
+def split_valid_items(batch_items, indices, use_normalize=False):
+    """Separate invalid items from a batch so they cannot fail it
 
-    for part in processed_parts[1:]:
-        if part['tag'] == current_tag and current_tag:
-            current_content.append(part['content'])
+    Returns:
+        tuple: (valid_items, valid_indices, failed_texts_data)
+    """
+    valid_items, valid_indices, failed_texts_data = [], [], []
+    for index, item in zip(indices, batch_items):
+        error = validate_item(item)
+        if error is None:
+            valid_items.append(item)
+            valid_indices.append(index)
         else:
-            merged_lines.append(f"{current_tag}{''.join(current_content)}".strip())
-            current_tag = part['tag']
-            current_content = [part['content']]
+            print(f"Skipping sample {index}: {error}")
+            failed_texts_data.append(failed_text_data(index, item, error, use_normalize))
+    return valid_items, valid_indices, failed_texts_data
+
+
+def is_oom_error(e):
+    """Whether an exception is a device out-of-memory error (torch.cuda.OutOfMemoryError is a RuntimeError)"""
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+class BatchSizeLimiter:
+    """Learns the largest generation batch size that fits in memory per prompt-length bucket
+
+    Every OOM halves the limit of its bucket. Longer prompts never get a larger limit than shorter ones,
+    so an OOM at some length also constrains every longer bucket.
+    """
+
+    def __init__(self, bucket_tokens=256):
+        self.bucket_tokens = bucket_tokens
+        self.limits = {}  # bucket -> max batch size
+
+    def _bucket(self, prompt_tokens):
+        return prompt_tokens // self.bucket_tokens
+
+    def limit(self, prompt_tokens):
+        """Largest batch size believed safe for prompts of this length, None if unknown"""
+        bucket = self._bucket(prompt_tokens)
+        limits = [limit for b, limit in self.limits.items() if b <= bucket]
+        return min(limits) if limits else None
+
+    def record_oom(self, prompt_tokens, batch_size):
+        bucket = self._bucket(prompt_tokens)
+        new_limit = max(1, batch_size // 2)
+        self.limits[bucket] = min(self.limits.get(bucket, new_limit), new_limit)
+        print(f"Batch size {batch_size} ran out of memory at {prompt_tokens} prompt tokens, "
+              f"limiting prompts of {bucket * self.bucket_tokens}+ tokens to batches of {self.limits[bucket]}")
+
+
+# Batch size limits learned by all callers that don't pass their own
+BATCH_SIZE_LIMITER = BatchSizeLimiter()
+
+
+def _slice_batch(input_ids, attention_mask, rows):
+    """Take some rows of a left-padded batch and drop the padding columns they all share"""
+    input_ids, attention_mask = input_ids[rows], attention_mask[rows]
+    shared_pad = int((attention_mask == 0).sum(dim=1).min().item())
+    return input_ids[:, shared_pad:], attention_mask[:, shared_pad:]
+
+
+def _concat_speech_ids(parts):
+    """Concatenate (speech_ids, li) results of sub-batches, padding speech ids with the invalid code"""
+    max_len = max(speech_ids.shape[1] for speech_ids, _ in parts)
+    padded = []
+    for speech_ids, _ in parts:
+        pad = speech_ids.new_full((speech_ids.shape[0], max_len - speech_ids.shape[1], MAX_CHANNELS), 1024)
+        padded.append(torch.cat([speech_ids, pad], dim=1))
+    return torch.cat(padded, dim=0), torch.cat([li for _, li in parts])
+
+
+def generate_speech_ids_safe(model, input_ids, attention_mask, device, limiter=None):
+    """generate_speech_ids that survives out-of-memory errors
+
+    Batches above the limiter's limit for their prompt length are split up front. On OOM the batch is
+    split in half and retried recursively, and the limiter learns the failing size. A single sample that
+    still runs out of memory gets no valid speech tokens instead of failing its batch.
+    """
+    limiter = limiter if limiter is not None else BATCH_SIZE_LIMITER
+    batch_size, prompt_tokens = input_ids.shape[0], input_ids.shape[1]
+    limit = limiter.limit(prompt_tokens)
+
+    if limit is None or batch_size <= limit:
+        out_of_memory = False
+        try:
+            return generate_speech_ids(model, input_ids, attention_mask, device)
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+            out_of_memory = True
+        # Retry outside the except block, so the failed attempt's tensors can be freed
+        if out_of_memory:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            limiter.record_oom(prompt_tokens, batch_size)
+            if batch_size == 1:
+                print(f"A single sample with {prompt_tokens} prompt tokens ran out of memory, skipping it")
+                return (torch.full((1, 1, MAX_CHANNELS), 1024, dtype=torch.long, device=device),
+                        torch.full((1,), -1, dtype=torch.long, device=device))
+
+    half = (batch_size + 1) // 2
+    parts = [
+        generate_speech_ids_safe(model, *_slice_batch(input_ids, attention_mask, rows), device, limiter)
+        for rows in (slice(0, half), slice(half, None))
+    ]
+    return _concat_speech_ids(parts)
+
+
+def decode_speech_ids(spt, speech_ids, li, indices):
+    """Decode each sample's valid speech tokens to audio
+
+    Waveforms stay on the device until every sample is decoded, then reach the host in one transfer.
+
+    Returns:
+        list: One {"audio_data", "sample_rate", "index"} dict per sample, None for failed samples
+    """
+    device_wavs = {}
+
+    # Process batch sample results individually
+    for i in range(speech_ids.shape[0]):
+        try:
+            # Extract valid speech tokens
+            end_idx = li[i] + 1
+            if end_idx <= 0:
+                print(f"Sample {indices[i]} has no valid speech tokens")
+                continue
+
+            this_speech_id = speech_ids[i, :end_idx]
+            print(f"Speech token shape for sample {indices[i]}: {this_speech_id.shape}")
+
+            # Decode generated audio
+            with torch.no_grad():
+                codes_list = [this_speech_id.permute(1, 0)]  # Convert to SPT expected format
+                decode_result = spt.decode(codes_list, overlap_seconds=10)
+                audio_result = decode_result["syn_wav_list"][0].detach().float()
+
+                if audio_result.ndim == 1:  # If 1D [samples]
+                    audio_result = audio_result.unsqueeze(0)  # Convert to 2D [1, samples]
+            device_wavs[i] = audio_result
+
+        except Exception as e:
+            print(f"Error processing sample {indices[i]}: {str(e)}, skipping...")
+            import traceback
+            traceback.print_exc()
+
+    # One device-to-host copy for all finished waveforms of the batch
+    host_wavs = dict(zip(device_wavs, to_host(list(device_wavs.values()))))
+
+    # Save audio data instead of file path
+    audio_results = []
+    for i in range(speech_ids.shape[0]):
+        if i not in host_wavs:
+            audio_results.append(None)
+            continue
+        audio_results.append({
+            "audio_data": host_wavs[i],
+            "sample_rate": spt.output_sample_rate,
+            "index": indices[i]
+        })
+        print(f"Audio generation completed: sample {indices[i]}")
+
+    return audio_results
+
+
+def extract_speech_codes(speech_ids, li, indices):
+    """Each sample's valid speech tokens as compact host arrays, for decoding later (see decode_codes.py)
+
+    Returns:
+        list: One {"codes": (T, 8) uint16 array, "frame_rate", "index"} dict per sample, None for failed samples
+    """
+    lengths = (li + 1).tolist()
+    speech_ids = speech_ids.cpu()  # One device-to-host copy for the whole batch
+    code_results = []
+    for i, length in enumerate(lengths):
+        if length <= 0:
+            print(f"Sample {indices[i]} has no valid speech tokens")
+            code_results.append(None)
+            continue
+        try:
+            codes = to_code_array(speech_ids[i, :length])
+        except Exception as e:
+            # E.g. a stray text token in channel 0; only this sample fails
+            print(f"Error processing sample {indices[i]}: {str(e)}, skipping...")
+            code_results.append(None)
+            continue
+        code_results.append({
+            "codes": codes,
+            "frame_rate": CODE_FRAME_RATE,
+            "index": indices[i]
+        })
+        print(f"Speech token shape for sample {indices[i]}: ({length}, {speech_ids.shape[-1]})")
+    return code_results
 
-    merged_lines.append(f"{current_tag}{''.join(current_content)}".strip())
-    
-    return "".join(merged_lines).replace(''', "'").replace(''', "'")
 
+def process_batch(batch_items, tokenizer, model, spt, device, system_prompt, start_idx, use_normalize=False, code_cache=None, prompt_trim=None, indices=None, limiter=None, codes_only=False):
+    """Process a batch of data items and generate audio, return audio data and metadata
 
-def process_batch(batch_items, tokenizer, model, spt, device, system_prompt, start_idx, use_normalize=False):
-    """Process a batch of data items and generate audio, return audio data and metadata"""
+    Runs the stages serially; pipeline.GenerationPipeline overlaps the same stages across micro-batches.
+    Items are numbered from start_idx unless explicit indices are given. Invalid items are rejected
+    before the GPU stages and OOMs in generation split the batch, so neither fails the whole batch.
+    With codes_only, the codec decode is skipped and the results hold speech codes instead of audio
+    (see extract_speech_codes).
+    """
     try:
-        # Prepare batch data
-        batch_size = len(batch_items)
-        texts = []
-        prompts = [system_prompt] * batch_size
-        prompt_audios = []
-        actual_texts_data = []  # Store actual text data used
-        
-        print(f"Processing {batch_size} samples starting from index {start_idx}...")
-        
-        # Extract text and audio from each sample
-        for i, item in enumerate(batch_items):
-            # Use new processing function
-            processed_item = process_jsonl_item(item)
-            
-            text = processed_item["text"]
-            prompt_text = processed_item["prompt_text"]
-            
-            # Merge text, if prompt_text is empty, full_text is just text
-            full_text = prompt_text + text if prompt_text else text
-            original_full_text = full_text  # Save original text
-            
-            # Apply text normalization based on parameter
-            if use_normalize:
-                full_text = normalize_text(full_text)
-            
-            # Replace speaker tags
-            final_text = full_text.replace("[S1]", "<speaker1>").replace("[S2]", "<speaker2>")
-            texts.append(final_text)
-            
-            # Save actual text information used
-            actual_texts_data.append({
-                "index": start_idx + i,
-                "original_text": original_full_text,
-                "normalized_text": normalize_text(original_full_text) if use_normalize else None,
-                "final_text": final_text,
-                "use_normalize": use_normalize
-            })
-            
-            # Get reference audio
-            prompt_audios.append(processed_item["prompt_audio"])
-        
-        # Process inputs
-        input_ids_list = []
-        for i, (text, prompt, audio_path) in enumerate(zip(texts, prompts, prompt_audios)):
-            # Load audio data here
-            audio_data = load_audio_data(audio_path) if audio_path else None
-            inputs = process_inputs(tokenizer, spt, prompt, text, device, audio_data)
-            inputs = shifting_inputs(inputs, tokenizer)
-            input_ids_list.append(inputs)
-        
-        # Pad batch inputs
-        input_ids, attention_mask = rpadding(input_ids_list, MAX_CHANNELS, tokenizer)
-        
-        # Batch generation
-        print(f"Starting batch audio generation...")
-        start = input_ids.shape[1] - MAX_CHANNELS + 1
-        
-        # Move inputs to GPU
-        input_ids = input_ids.to(device)
-        attention_mask = attention_mask.to(device)
-        
-        # Generate model outputs
-        outputs = model.generate(
-            input_ids=input_ids, 
-            attention_mask=attention_mask,
-        )
-        print(f"Original outputs shape: {outputs.shape}")
-        print(f"Start value: {start}")
-        print(f"Shape after slicing: {outputs[:, start:].shape}")
-        print(f"MAX_CHANNELS: {MAX_CHANNELS}")
-        print(f"Calculated seq_len: {outputs.shape[1] - MAX_CHANNELS + 1}")
-        # Process outputs
-        outputs = outputs[:, start:]
-        seq_len = outputs.shape[1] - MAX_CHANNELS + 1
-        speech_ids = torch.full((outputs.shape[0], seq_len, MAX_CHANNELS), 0).to(device)
-        
-        
-        # Adjust output format
-        for j in range(MAX_CHANNELS):
-            speech_ids[..., j] = outputs[:, j : seq_len + j, j]
-            if j == 0: 
-                speech_ids[..., j] = speech_ids[..., j] - 151665
-        
-        # Find valid positions for each sample
-        li = find_max_valid_positions(speech_ids)
-        
-        # Store audio result data
-        audio_results = []
-        
-        # Process batch sample results individually
-        for i in range(batch_size):
-            try:
-                # Extract valid speech tokens
-                end_idx = li[i] + 1
-                if end_idx <= 0:
-                    print(f"Sample {start_idx + i} has no valid speech tokens")
-                    audio_results.append(None)
-                    continue
-                    
-                this_speech_id = speech_ids[i, :end_idx]
-                print(f"Speech token shape for sample {start_idx + i}: {this_speech_id.shape}")
-                
-                # Decode generated audio
-                with torch.no_grad():
-                    codes_list = [this_speech_id.permute(1, 0)]  # Convert to SPT expected format
-                    decode_result = spt.decode(codes_list, overlap_seconds=10)
-                    audio_result = decode_result["syn_wav_list"][0].cpu().detach()
-                    
-                    if audio_result.ndim == 1:  # If 1D [samples]
-                        audio_result = audio_result.unsqueeze(0)  # Convert to 2D [1, samples]
-                
-                # Save audio data instead of file path
-                audio_results.append({
-                    "audio_data": audio_result,
-                    "sample_rate": spt.output_sample_rate,
-                    "index": start_idx + i
-                })
-                print(f"Audio generation completed: sample {start_idx + i}")
-                
-            except Exception as e:
-                print(f"Error processing sample {start_idx + i}: {str(e)}, skipping...")
-                import traceback
-                traceback.print_exc()
-                audio_results.append(None)
-        
+        print(f"Processing {len(batch_items)} samples starting from index {start_idx}...")
+        if indices is None:
+            indices = list(range(start_idx, start_idx + len(batch_items)))
+        all_indices = indices
+        batch_items, indices, failed_texts_data = split_valid_items(batch_items, indices, use_normalize)
+
+        actual_texts_data, audio_results = [], []
+        if batch_items:
+            texts, prompts, prompt_audios, actual_texts_data = prepare_batch_texts(batch_items, system_prompt, indices, use_normalize)
+
+            # Load audio data here, one tensor per speaker so each reference is encoded (and cached) on its own
+            speaker_wavs = load_batch_speaker_audios(prompt_audios, trim_options=prompt_trim)
+
+            # Encode the unique prompt segments of the whole batch in length-bucketed codec calls
+            prompt_codes = encode_batch_prompt_codes(spt, speaker_wavs, device, code_cache)
+
+            # Process inputs
+            input_ids, attention_mask = build_batch_inputs(tokenizer, spt, texts, prompts, prompt_codes, device)
+
+            # Batch generation
+            print(f"Starting batch audio generation...")
+            speech_ids, li = generate_speech_ids_safe(model, input_ids, attention_mask, device, limiter)
+
+            # Store audio result data, or only the speech codes to decode later
+            if codes_only:
+                audio_results = extract_speech_codes(speech_ids, li, indices)
+            else:
+                audio_results = decode_speech_ids(spt, speech_ids, li, indices)
+
         # Clean up GPU memory
         torch.cuda.empty_cache()
-        
-        # Return text data and audio data
-        return actual_texts_data, audio_results
-        
+
+        # Return text data and audio data in input order, None audio for rejected items
+        return merge_failed_results(all_indices, actual_texts_data, audio_results, failed_texts_data)
+
     except Exception as e:
         print(f"Error during batch processing: {str(e)}")
         raise
+
+
+def merge_failed_results(indices, actual_texts_data, audio_results, failed_texts_data):
+    """Put the entries of rejected items back among a batch's results, in the order of indices"""
+    by_index = {text_data["index"]: (text_data, audio_result) for text_data, audio_result in zip(actual_texts_data, audio_results)}
+    by_index.update({text_data["index"]: (text_data, None) for text_data in failed_texts_data})
+    ordered = [by_index[index] for index in indices]
+    return [text_data for text_data, _ in ordered], [audio_result for _, audio_result in ordered]
@@ -1,12 +1,13 @@
 import gradio as gr
 import torch
-import torchaudio
 import tempfile
 import json
 import os
 from typing import Optional, Tuple
 
-from generation_utils import load_model, process_batch
+from generation_utils import load_model, process_batch, estimate_item_tokens
+from pipeline import RequestBatcher
+from audio_writer import audio_extension, save_audio
 
 def load_examples_from_jsonl():
     """
@@ -144,23 +145,50 @@ MODEL_PATH = "fnlp/MOSS-TTSD-v0.5"
 SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
 SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
 MAX_CHANNELS = 8
+# Uploaded references are trimmed of silence and capped, so a long upload does not inflate the prompt
+PROMPT_TRIM = {"max_seconds": 20.0}
+# Concurrent requests arriving within BATCH_WAIT_SECONDS are generated together, grouped by length
+MAX_BATCH_SIZE = 4
+BATCH_WAIT_SECONDS = 0.05
+# Lossless 16-bit FLAC is a fraction of the float WAV size, so results reach the browser faster
+OUTPUT_AUDIO_FORMAT = "flac"
 
 # Global variables for caching loaded models
 tokenizer = None
 model = None
 spt = None
 device = None
+batcher = None
+
+def run_request_batch(indices, items, use_normalize):
+    """Generate a coalesced batch of requests that share their normalization setting"""
+    return process_batch(
+        batch_items=items,
+        tokenizer=tokenizer,
+        model=model,
+        spt=spt,
+        device=device,
+        system_prompt=SYSTEM_PROMPT,
+        start_idx=0,
+        use_normalize=use_normalize,
+        prompt_trim=PROMPT_TRIM,
+        indices=indices
+    )
 
 def initialize_model():
     """Initialize model (load only on first call)"""
-    global tokenizer, model, spt, device
+    global tokenizer, model, spt, device, batcher
     
     if tokenizer is None:
         print("Initializing model...")
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        tokenizer, model, spt = load_model(MODEL_PATH, SPT_CONFIG_PATH, SPT_CHECKPOINT_PATH)
-        spt = spt.to(device)
-        model = model.to(device)
+        tokenizer, model, spt = load_model(MODEL_PATH, SPT_CONFIG_PATH, SPT_CHECKPOINT_PATH, device=device)
+        batcher = RequestBatcher(
+            run_request_batch,
+            lambda item: estimate_item_tokens(item, tokenizer, SYSTEM_PROMPT),
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_seconds=BATCH_WAIT_SECONDS
+        )
         print("Model initialization completed!")
     
     return tokenizer, model, spt, device
@@ -229,29 +257,18 @@ def process_single_audio_generation(
         # import accelerate
         # accelerate.utils.set_seed(42)
         
-        # Process batch (single item)
-        actual_texts_data, audio_results = process_batch(
-            batch_items=[item],
-            tokenizer=tokenizer,
-            model=model,
-            spt=spt,
-            device=device,
-            system_prompt=SYSTEM_PROMPT,
-            start_idx=0,
-            use_normalize=use_normalize
-        )
+        # Generate, batched with any concurrent requests of similar length
+        text_data, audio_result = batcher(item, group=use_normalize)
         
         # Check results
-        if not audio_results or audio_results[0] is None:
-            return None, "Error: Audio generation failed"
-        
-        audio_result = audio_results[0]
+        if audio_result is None:
+            return None, f"Error: Audio generation failed{': ' + text_data['error'] if text_data.get('error') else ''}"
         
         # Create temporary output file
-        output_path = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
+        output_path = tempfile.NamedTemporaryFile(suffix=f".{audio_extension(OUTPUT_AUDIO_FORMAT)}", delete=False).name
         
         # Save audio
-        torchaudio.save(output_path, audio_result["audio_data"], audio_result["sample_rate"])
+        save_audio(output_path, audio_result["audio_data"], audio_result["sample_rate"], OUTPUT_AUDIO_FORMAT)
         
         # Build status information (using English since this is server-side output)
         status_info = f"""
@@ -262,9 +279,9 @@ def process_single_audio_generation(
    - Channels: {audio_result["audio_data"].shape[0]}
 
 📝 Text Processing Information:
-   - Original Text: {actual_texts_data[0]['original_text'][:100]}...
-   - Final Text: {actual_texts_data[0]['final_text'][:100]}...
-   - Use Normalize: {actual_texts_data[0]['use_normalize']}
+   - Original Text: {text_data['original_text'][:100]}...
+   - Final Text: {text_data['final_text'][:100]}...
+   - Use Normalize: {text_data['use_normalize']}
         """
         
         return output_path, status_info
@@ -531,5 +548,6 @@ def create_gradio_interface() -> gr.Blocks:
 if __name__ == "__main__":
     demo = create_gradio_interface()
     
-    # Launch interface
+    # Launch interface; concurrent requests reach the batcher together
+    demo.queue(default_concurrency_limit=MAX_BATCH_SIZE)
     demo.launch()
@@ -1,11 +1,18 @@
 import json
 import torch
-import torchaudio
 import accelerate
 import argparse
 import os
+import time
 
-from generation_utils import load_model, process_batch
+from generation_utils import load_model, process_batch, estimate_item_tokens, bucket_batches
+from code_cache import PromptCodeCache
+from job_manifest import JobManifest
+from model_bundle import resolve_bundle, bundle_model_id
+from attention_backend import LOAD_ATTN_IMPLEMENTATION, DEFAULT_CACHE_PATH as DEFAULT_ATTN_CACHE, select_attn_implementation
+from audio_writer import AUDIO_FORMATS, AudioWriter
+from pipeline import GenerationPipeline, iter_jsonl
+from speech_codes import CodeStore
 
 MODEL_PATH = "fnlp/MOSS-TTSD-v0.5"
 SYSTEM_PROMPT = "You are a speech synthesizer that generates natural, realistic, and human-like conversational audio from dialogue text."
@@ -13,6 +20,83 @@ SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
 SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
 MAX_CHANNELS = 8
 
+
+def save_audio_results(audio_results, output_dir, writer, manifest=None, keys=None):
+    """Queue audio results for writing as output_{index} files, return the number of files queued
+
+    The AudioWriter encodes and writes them on background threads in its format. With a manifest, files
+    are named after the item's content hash from keys (index -> key) and marked completed once written.
+    """
+    queued_count = 0
+    for audio_result in audio_results:
+        if audio_result is not None:
+            index = audio_result["index"]
+            on_done = None
+            if manifest is None:
+                output_path = writer.output_path(output_dir, f"output_{index}")
+            else:
+                key = keys[index]
+                output_path = manifest.output_path(output_dir, index, key, extension=writer.extension)
+                on_done = lambda path, key=key, index=index: manifest.mark_done(key, index, path)
+            writer.submit(output_path, audio_result["audio_data"], audio_result["sample_rate"], on_done)
+            queued_count += 1
+    return queued_count
+
+
+def save_code_results(code_results, texts_data, code_store, run_metadata, manifest=None, keys=None):
+    """Append speech codes to a CodeStore with their text metadata, return the number of entries written
+
+    Each entry is named output_{index} (with the content hash suffix when a manifest is used), the name
+    decode_codes.py gives the decoded audio file.
+
+    Args:
+        code_results: Results of a codes-only batch (see generation_utils.extract_speech_codes)
+        texts_data: Text metadata of the same items, stored alongside the codes
+        code_store: speech_codes.CodeStore the codes are appended to
+        run_metadata: Settings of the job that decode_codes.py needs, e.g. the codec checkpoint
+    """
+    texts_by_index = {text_data["index"]: text_data for text_data in texts_data}
+    saved = []
+    for code_result in code_results:
+        if code_result is None:
+            continue
+        index = code_result["index"]
+        key = keys[index] if manifest is not None else str(index)
+        name = f"output_{index}_{key[:10]}" if manifest is not None else f"output_{index}"
+        text_data = texts_by_index.get(index, {})
+        code_store.append(code_result["codes"], key=key, metadata=dict(
+            run_metadata,
+            name=name,
+            index=index,
+            frame_rate=code_result["frame_rate"],
+            text=text_data.get("original_text"),
+            final_text=text_data.get("final_text"),
+        ))
+        print(f"Saved speech codes of sample {index} to {code_store.path}")
+        saved.append((key, index))
+    if manifest is not None and saved:
+        # The entries must be on disk before the manifest records them as done
+        code_store.sync()
+        for key, index in saved:
+            manifest.mark_done(key, index, code_store.path)
+    return len(saved)
+
+
+def save_results(args, texts_data, results, manifest=None, keys=None):
+    """Save the audio or, with --codes_only, the speech codes of a batch"""
+    if args.codes_only:
+        return save_code_results(results, texts_data, args.code_store, args.codes_metadata, manifest, keys)
+    return save_audio_results(results, args.output_dir, args.audio_writer, manifest, keys)
+
+
+def finish_writes(args, queued_count):
+    """Wait for the background audio writes, return the number of files actually saved"""
+    if args.codes_only:
+        return queued_count
+    args.audio_writer.wait()
+    return args.audio_writer.written
+
+
 def main():
     parser = argparse.ArgumentParser(description="TTS inference with Asteroid model")
     parser.add_argument("--jsonl", default="examples/examples.jsonl",help="Path to JSONL file (default: examples/examples.jsonl)")
@@ -26,8 +110,40 @@ def main():
                        help="Whether to use text normalization (default: False)")
     parser.add_argument("--dtype", choices=["bf16", "fp16", "fp32"], default="bf16",
                        help="Model data type (default: bf16)")
-    parser.add_argument("--attn_implementation", choices=["flash_attention_2", "sdpa", "eager"], default="flash_attention_2",
-                       help="Attention implementation (default: flash_attention_2)")
+    parser.add_argument("--attn_implementation", choices=["auto", "flash_attention_2", "sdpa", "eager"], default="flash_attention_2",
+                       help="Attention implementation; auto loads once, probes the backends in place and caches the fastest "
+                            "for this host in --attn_cache (default: flash_attention_2)")
+    parser.add_argument("--attn_cache", default=DEFAULT_ATTN_CACHE,
+                       help=f"Cache file of probed attention implementations per host, with --attn_implementation auto (default: {DEFAULT_ATTN_CACHE})")
+    parser.add_argument("--bundle", default=None,
+                       help="Load the LM, tokenizer and codec from an offline bundle made by model_bundle.py, without Hub lookups (default: None)")
+    parser.add_argument("--codec_precision", choices=["fp32", "bf16", "fp16", "int8"], default="fp32",
+                       help="XY_Tokenizer precision, int8 is CPU only and rejected on GPU hosts (default: fp32)")
+    parser.add_argument("--code_cache_dir", default=None,
+                       help="Directory to persist reference-audio codes across runs (default: None, in-memory only)")
+    parser.add_argument("--trim_prompts", action="store_true", default=False,
+                       help="Remove silence and collapse long pauses in prompt audio (default: False)")
+    parser.add_argument("--prompt_max_seconds", type=float, default=None,
+                       help="With --trim_prompts, cap each speaker's prompt audio to its best-SNR window of this length (default: None)")
+    parser.add_argument("--micro_batch_size", type=int, default=None,
+                       help="Process items in micro-batches of this size with overlapped loading, generation and decoding (default: None, one batch)")
+    parser.add_argument("--max_batch_tokens", type=int, default=None,
+                       help="Stream the JSONL and form micro-batches under this padded budget of prompt tokens plus predicted output frames; "
+                            "--micro_batch_size then caps the items per micro-batch (default: None)")
+    parser.add_argument("--resume", action="store_true", default=False,
+                       help="Record completed items in <output_dir>/manifest.jsonl and skip them when the job is rerun (default: False)")
+    parser.add_argument("--lookahead", type=int, default=64,
+                       help="Items bucketed by length together when forming micro-batches (default: 64)")
+    parser.add_argument("--min_padding_efficiency", type=float, default=0.5,
+                       help="Close a micro-batch before its share of non-padding prompt and output positions drops below this (default: 0.5)")
+    parser.add_argument("--io_workers", type=int, default=4,
+                       help="Threads for prompt audio loading in micro-batch mode (default: 4)")
+    parser.add_argument("--audio_format", choices=sorted(AUDIO_FORMATS), default="wav",
+                       help="Output audio format: wav (32-bit float), pcm16 (16-bit wav), flac or opus; "
+                            "files are encoded and written on background threads (default: wav)")
+    parser.add_argument("--codes_only", action="store_true", default=False,
+                       help="Skip the codec decode and append each item's speech codes to the code store <output_dir>/codes; "
+                            "decode them later with decode_codes.py (default: False)")
     
     args = parser.parse_args()
     
@@ -47,32 +163,95 @@ def main():
     print(f"Using dtype: {args.dtype} ({torch_dtype})")
     print(f"Using attention implementation: {args.attn_implementation}")
     
-    # Load models
+    # Load models: tokenizer, LM and codec concurrently, each moved to the device as soon as it is loaded
     print("Loading models...")
-    tokenizer, model, spt = load_model(MODEL_PATH, SPT_CONFIG_PATH, SPT_CHECKPOINT_PATH, 
-                                      torch_dtype=torch_dtype, attn_implementation=args.attn_implementation)
-    spt = spt.to(device)
-    model = model.to(device)
+    load_start = time.perf_counter()
+    model_paths = resolve_bundle(args.bundle) if args.bundle else \
+        {"model_path": MODEL_PATH, "spt_config_path": SPT_CONFIG_PATH, "spt_checkpoint_path": SPT_CHECKPOINT_PATH}
+    load_attn_implementation = LOAD_ATTN_IMPLEMENTATION if args.attn_implementation == "auto" else args.attn_implementation
+    tokenizer, model, spt = load_model(**model_paths, torch_dtype=torch_dtype, attn_implementation=load_attn_implementation,
+                                       spt_precision=args.codec_precision, device=device, local_files_only=bool(args.bundle))
+    if args.attn_implementation == "auto":
+        args.attn_implementation = select_attn_implementation(model, cache_path=args.attn_cache)
+    print(f"Models loaded in {time.perf_counter() - load_start:.1f}s")
     
+    if not os.path.exists(args.jsonl):
+        print(f"Error: JSONL file '{args.jsonl}' not found")
+        return
+
+    # Fix the seed for reproducibility
+    if args.seed is not None:
+        accelerate.utils.set_seed(args.seed)
+        print(f"Set random seed to {args.seed}")
+    
+    code_cache = PromptCodeCache(args.code_cache_dir) if args.code_cache_dir else None
+    prompt_trim = {"max_seconds": args.prompt_max_seconds} if args.trim_prompts else None
+    # The LM actually loaded: a bundle is identified by its source model and weight files
+    model_id = bundle_model_id(args.bundle) if args.bundle else MODEL_PATH
+    # Stored with every codes file, so a later decode can check it uses the same codec
+    args.codes_metadata = {"model": model_id, "codec": spt.checkpoint_id, "seed": args.seed}
+    args.code_store = CodeStore(os.path.join(args.output_dir, "codes"), channels=MAX_CHANNELS) if args.codes_only else None
+
+    manifest = None
+    if args.resume:
+        # Everything besides the item itself that changes the generated audio
+        settings = {
+            "model": model_id,
+            "codec": spt.checkpoint_id,
+            "dtype": args.dtype,
+            "codec_precision": args.codec_precision,
+            "seed": args.seed,
+            "use_normalize": args.use_normalize,
+            "prompt_trim": prompt_trim,
+            "codes_only": args.codes_only,
+            "audio_format": args.audio_format,
+        }
+        manifest = JobManifest(os.path.join(args.output_dir, "manifest.jsonl"), settings)
+        print(f"Resuming job: {len(manifest.completed)} items already completed")
+
+    print("Starting inference...")
+    with AudioWriter(args.audio_format) as args.audio_writer:
+        if args.micro_batch_size or args.max_batch_tokens:
+            run_streaming(args, tokenizer, model, spt, device, code_cache, prompt_trim, manifest)
+        else:
+            run_single_batch(args, tokenizer, model, spt, device, code_cache, prompt_trim, manifest)
+
+
+def write_summary(summary_file, actual_texts_data, mode="a"):
+    """Write text summaries of the given items to a jsonl file, appending by default"""
+    with open(summary_file, mode, encoding="utf-8") as f:
+        for item in actual_texts_data:
+            f.write(json.dumps({
+                "index": item["index"],
+                "text": item["original_text"],
+                "normalized_text": item["normalized_text"],
+                "final_text": item["final_text"]
+            }, ensure_ascii=False) + "\n")
+
+
+def run_single_batch(args, tokenizer, model, spt, device, code_cache, prompt_trim, manifest=None):
+    """Generate every item of the JSONL file in one batch"""
     # Load the items from the JSONL file
     try:
         with open(args.jsonl, "r") as f:
             items = [json.loads(line) for line in f.readlines()]
         print(f"Loaded {len(items)} items from {args.jsonl}")
-    except FileNotFoundError:
-        print(f"Error: JSONL file '{args.jsonl}' not found")
-        return
     except json.JSONDecodeError as e:
         print(f"Error parsing JSONL file: {e}")
         return
-    
-    # Fix the seed for reproducibility
-    if args.seed is not None:
-        accelerate.utils.set_seed(args.seed)
-        print(f"Set random seed to {args.seed}")
-    
+
+    total_count = len(items)
+    indices, keys = list(range(len(items))), None
+    if manifest is not None:
+        pending = list(manifest.pending(enumerate(items)))
+        indices = [index for index, _, _ in pending]
+        items = [item for _, item, _ in pending]
+        keys = {index: key for index, _, key in pending}
+        if not items:
+            print(f"Inference completed. All {total_count} items were already generated")
+            return
+
     # Process the batch of items
-    print("Starting inference...")
     actual_texts_data, audio_results = process_batch(
         batch_items=items,
         tokenizer=tokenizer,
@@ -81,40 +260,87 @@ def main():
         device=device,
         system_prompt=SYSTEM_PROMPT,
         start_idx=0,
-        use_normalize=args.use_normalize
+        use_normalize=args.use_normalize,
+        code_cache=code_cache,
+        prompt_trim=prompt_trim,
+        indices=indices,
+        codes_only=args.codes_only
     )
-    
-    # Save summary if requested
+
+    # Save summary if requested; a resumed job appends to the summary of earlier runs
     if args.summary_file:
-        summary_data = []
-        for item in actual_texts_data:
-            summary_data.append({
-                "text": item["original_text"],
-                "normalized_text": item["normalized_text"],
-                "final_text": item["final_text"]
-            })
-        
-        with open(args.summary_file, "w", encoding="utf-8") as f:
-            for item in summary_data:
-                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        write_summary(args.summary_file, actual_texts_data, mode="a" if manifest is not None else "w")
         print(f"Saved summary to {args.summary_file}")
-    
-    # Save the audio results to files
-    saved_count = 0
-    for idx, audio_result in enumerate(audio_results):
-        if audio_result is not None:
-            output_path = os.path.join(args.output_dir, f"output_{idx}.wav")
-            torchaudio.save(
-                output_path,
-                audio_result["audio_data"],
-                audio_result["sample_rate"]
-            )
-            print(f"Saved audio to {output_path}")
-            saved_count += 1
-        else:
+
+    # Save the audio results (or speech codes) to files
+    saved_count = save_results(args, actual_texts_data, audio_results, manifest, keys)
+    for idx, audio_result in zip(indices, audio_results):
+        if audio_result is None:
             print(f"Skipping sample {idx} due to generation error")
-    
-    print(f"Inference completed. Saved {saved_count}/{len(items)} audio files to {args.output_dir}")
+    saved_count = finish_writes(args, saved_count)
+
+    print(f"Inference completed. Saved {saved_count}/{len(items)} {'codes' if args.codes_only else 'audio'} files to {args.output_dir}")
+
+
+def run_streaming(args, tokenizer, model, spt, device, code_cache, prompt_trim, manifest=None):
+    """Read the JSONL lazily and generate it in overlapped micro-batches, writing each one as it completes
+
+    Only the lookahead window and the micro-batches in flight are held in memory, so the job size is not
+    bounded by host or device memory.
+    """
+    item_count = 0
+    keys = {}  # index -> content hash of the items in flight, with a manifest
+
+    def counted_items():
+        nonlocal item_count
+        indexed_items = enumerate(iter_jsonl(args.jsonl))
+        if manifest is not None:
+            for index, item, key in manifest.pending(indexed_items):
+                keys[index] = key
+                item_count += 1
+                yield index, item
+            return
+        for index, item in indexed_items:
+            item_count += 1
+            yield index, item
+
+    # Length-bucketed micro-batches; each one's padding efficiency is printed as it is formed
+    micro_batches = bucket_batches(
+        counted_items(),
+        lambda item: estimate_item_tokens(item, tokenizer, SYSTEM_PROMPT),
+        max_batch_tokens=args.max_batch_tokens,
+        max_batch_size=args.micro_batch_size,
+        lookahead=args.lookahead,
+        min_efficiency=args.min_padding_efficiency,
+    )
+
+    if args.summary_file and manifest is None:
+        open(args.summary_file, "w").close()
+    saved_count = 0
+
+    def on_result(batch_texts_data, audio_results):
+        nonlocal saved_count
+        saved_count += save_results(args, batch_texts_data, audio_results, manifest, keys)
+        for text_data in batch_texts_data:
+            keys.pop(text_data["index"], None)
+        for text_data, audio_result in zip(batch_texts_data, audio_results):
+            if audio_result is None:
+                print(f"Skipping sample {text_data['index']} due to generation error")
+        if args.summary_file:
+            write_summary(args.summary_file, batch_texts_data)
+
+    # Overlapped stages: each micro-batch is written while later ones are still generating
+    pipeline = GenerationPipeline(tokenizer, model, spt, device, SYSTEM_PROMPT,
+                                  use_normalize=args.use_normalize, code_cache=code_cache,
+                                  prompt_trim=prompt_trim, io_workers=args.io_workers,
+                                  codes_only=args.codes_only)
+    pipeline.run(micro_batches, on_result)
+    pipeline.print_timings()
+
+    saved_count = finish_writes(args, saved_count)
+    if args.summary_file:
+        print(f"Saved summary to {args.summary_file}")
+    print(f"Inference completed. Saved {saved_count}/{item_count} {'codes' if args.codes_only else 'audio'} files to {args.output_dir}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import threading
+
+import torch
+
+from code_cache import checkpoint_fingerprint
+from speech_codes import CodeStore
+from generation_utils import process_jsonl_item, _speaker_inputs
+
+
+def _audio_fingerprint(audio_input):
+    """Identify a prompt audio input by content: file size and sampled bytes for paths, samples for tuples"""
+    if isinstance(audio_input, str):
+        return checkpoint_fingerprint(audio_input) if os.path.isfile(audio_input) else audio_input
+    if isinstance(audio_input, tuple) and len(audio_input) == 2:
+        wav, sr = audio_input
+        hasher = hashlib.sha256(f"{sr}:{wav.numel()}:".encode())
+        hasher.update(wav.detach().to(torch.float32).cpu().contiguous().numpy().tobytes())
+        return hasher.hexdigest()[:16]
+    return str(audio_input)
+
+
+def item_key(item, settings, index):
+    """Content hash of one generation: its position, text, prompt text and prompt audio, plus the job settings
+
+    The index is part of the key, so identical lines of an input file each get their own output.
+
+    Args:
+        item: Data item in any format accepted by process_jsonl_item
+        settings: JSON-serialisable dict of everything else that changes the output (model, seed, ...)
+        index: Position of the item in the input
+
+    Returns:
+        str: Hex digest
+    """
+    processed_item = process_jsonl_item(item)
+    prompt_audio = processed_item["prompt_audio"]
+    content = {
+        "index": index,
+        "text": processed_item["text"],
+        "prompt_text": processed_item["prompt_text"],
+        "prompt_audio": [_audio_fingerprint(audio) for audio in _speaker_inputs(prompt_audio)] if prompt_audio else None,
+        "settings": settings,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class JobManifest:
+    """Append-only record of completed items that lets an interrupted job resume
+
+    Each line of the manifest holds the content hash of an item (see item_key), its index and its output
+    file, or the CodeStore directory of a codes-only job. A line is appended and fsynced only after the
+    output was written and synced, and an entry counts as completed only if its output is still there: a
+    non-empty file, or an entry with its key in the reopened store. A crash at any point at worst
+    regenerates the items in flight.
+    """
+
+    def __init__(self, manifest_path, settings):
+        self.manifest_path = manifest_path
+        self.settings = settings
+        self._lock = threading.Lock()
+        self.completed = {}
+        if os.path.exists(manifest_path):
+            stores = {}
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Partial last line of an interrupted write
+                    if self._output_exists(entry, stores):
+                        self.completed[entry["key"]] = entry
+            for store in stores.values():
+                store.close()
+
+    @staticmethod
+    def _output_exists(entry, stores):
+        path = entry["file"]
+        if os.path.isdir(path):
+            # Codes-only output: the store directory always exists, the entry itself may have been lost
+            if path not in stores:
+                stores[path] = CodeStore(path)
+            return entry["key"] in stores[path]
+        return os.path.isfile(path) and os.path.getsize(path) > 0
+
+    def key(self, item, index):
+        return item_key(item, self.settings, index)
+
+    def is_done(self, key):
+        return key in self.completed
+
+    def output_path(self, output_dir, index, key, prefix="output", extension="wav"):
+        """Output file name of an item; the hash suffix keeps outputs of edited or reordered inputs distinct"""
+        return os.path.join(output_dir, f"{prefix}_{index}_{key[:10]}.{extension}")
+
+    def mark_done(self, key, index, output_path):
+        entry = {"key": key, "index": index, "file": output_path}
+        with self._lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed[key] = entry
+
+    def pending(self, indexed_items):
+        """Yield the (index, item, key) triples that are not completed yet, reporting skipped items"""
+        skipped = 0
+        for index, item in indexed_items:
+            key = self.key(item, index)
+            if self.is_done(key):
+                skipped += 1
+                continue
+            yield index, item, key
+        if skipped:
+            print(f"Skipped {skipped} items already completed in {self.manifest_path}")
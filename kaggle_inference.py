@@ -6,7 +6,6 @@ Kaggle优化版推理脚本
 
 import json
 import torch
-import torchaudio
 import accelerate
 import argparse
 import os
@@ -19,7 +18,12 @@ warnings.filterwarnings("ignore")
 
 # 尝试导入项目模块
 try:
-    from generation_utils import load_model, process_batch
+    from generation_utils import load_model, estimate_item_tokens, bucket_batches
+    from pipeline import GenerationPipeline, iter_jsonl
+    from job_manifest import JobManifest
+    from model_bundle import resolve_bundle, bundle_model_id
+    from audio_writer import AUDIO_FORMATS, AudioWriter
+    from attention_backend import LOAD_ATTN_IMPLEMENTATION, select_attn_implementation
 except ImportError as e:
     print(f"❌ 导入错误: {e}")
     print("💡 请确保所有项目文件都在当前目录中")
@@ -33,7 +37,8 @@ KAGGLE_CONFIG = {
     "SPT_CHECKPOINT_PATH": "XY_Tokenizer/weights/xy_tokenizer.ckpt",
     "MAX_CHANNELS": 8,
     "DEFAULT_OUTPUT_DIR": "outputs",
-    "TEMP_DIR": "temp_audio"
+    "TEMP_DIR": "temp_audio",
+    "ATTN_CACHE": "attn_backend.json"
 }
 
 def check_kaggle_environment():
@@ -70,38 +75,33 @@ def optimize_for_kaggle():
     for dir_name in [KAGGLE_CONFIG["DEFAULT_OUTPUT_DIR"], KAGGLE_CONFIG["TEMP_DIR"]]:
         os.makedirs(dir_name, exist_ok=True)
 
-def load_models_with_fallback():
-    """加载模型（带降级处理）"""
+def load_models_with_fallback(bundle=None, attn_cache=None, reprobe_attn=False):
+    """加载模型：权重只加载一次（eager attention，所有环境都支持），再用极小的合成前向探测各 attention 实现，
+    原地切换到最快的可用实现，结果按主机缓存在 attn_cache JSON 文件中，后续运行只需验证一次。
+    tokenizer、LM 和编解码器并行加载，bundle 为离线模型包目录（见 model_bundle.py）"""
     print("📦 加载模型...")
     
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    model_paths = resolve_bundle(bundle) if bundle else {
+        "model_path": KAGGLE_CONFIG["MODEL_PATH"],
+        "spt_config_path": KAGGLE_CONFIG["SPT_CONFIG_PATH"],
+        "spt_checkpoint_path": KAGGLE_CONFIG["SPT_CHECKPOINT_PATH"],
+    }
     
-    # 尝试不同的attention实现
-    attention_implementations = ["flash_attention_2", "sdpa", "eager"]
+    tokenizer, model, spt = load_model(
+        **model_paths,
+        torch_dtype=torch.bfloat16,
+        attn_implementation=LOAD_ATTN_IMPLEMENTATION,
+        device=device,
+        local_files_only=bool(bundle)
+    )
+    print("✅ 模型加载成功")
     
-    for attn_impl in attention_implementations:
-        try:
-            print(f"🔧 尝试使用 {attn_impl} attention...")
-            
-            tokenizer, model, spt = load_model(
-                KAGGLE_CONFIG["MODEL_PATH"], 
-                KAGGLE_CONFIG["SPT_CONFIG_PATH"], 
-                KAGGLE_CONFIG["SPT_CHECKPOINT_PATH"],
-                torch_dtype=torch.bfloat16,
-                attn_implementation=attn_impl
-            )
-            
-            spt = spt.to(device)
-            model = model.to(device)
-            
-            print(f"✅ 模型加载成功 (使用 {attn_impl})")
-            return tokenizer, model, spt, device, attn_impl
-            
-        except Exception as e:
-            print(f"❌ {attn_impl} 失败: {e}")
-            continue
-    
-    raise RuntimeError("所有attention实现都失败了")
+    # 探测attention实现（flash_attention_2 → sdpa → eager），失败的实现不会触发重新加载
+    print("🔧 探测attention实现...")
+    attn_impl = select_attn_implementation(model, cache_path=attn_cache, reprobe=reprobe_attn)
+    print(f"✅ 使用 {attn_impl} attention")
+    return tokenizer, model, spt, device, attn_impl
 
 def create_sample_data():
     """创建示例数据（如果没有输入文件）"""
@@ -130,7 +130,15 @@ def main():
     parser.add_argument("--output_dir", default=KAGGLE_CONFIG["DEFAULT_OUTPUT_DIR"], help="输出目录")
     parser.add_argument("--use_normalize", action="store_true", default=True, help="使用文本规范化")
     parser.add_argument("--seed", type=int, default=42, help="随机种子")
-    parser.add_argument("--max_samples", type=int, default=5, help="最大处理样本数（Kaggle限制）")
+    parser.add_argument("--max_samples", type=int, default=None, help="最大处理样本数（默认不限制）")
+    parser.add_argument("--max_batch_tokens", type=int, default=12000, help="每个微批次的token预算（提示token + 预测输出帧）")
+    parser.add_argument("--micro_batch_size", type=int, default=4, help="每个微批次的最大样本数")
+    parser.add_argument("--audio_format", choices=sorted(AUDIO_FORMATS), default="wav",
+                        help="输出音频格式：wav（32位浮点）、pcm16（16位wav）、flac 或 opus，后两者可大幅减小输出体积")
+    parser.add_argument("--bundle", default=None, help="离线模型包目录（model_bundle.py 生成），无需访问 Hub，启动更快")
+    parser.add_argument("--resume", action="store_true", default=False, help="断点续跑：记录已完成样本，重新运行时跳过（会话超时后使用）")
+    parser.add_argument("--attn_cache", default=KAGGLE_CONFIG["ATTN_CACHE"], help="attention实现探测结果缓存文件（按GPU和库版本区分）")
+    parser.add_argument("--reprobe_attn", action="store_true", default=False, help="忽略缓存，重新探测attention实现")
     
     args = parser.parse_args()
     
@@ -148,25 +156,17 @@ def main():
         print("⚠️ 未指定输入文件或文件不存在，使用示例数据")
         args.jsonl = create_sample_data()
     
-    # 4. 加载数据
-    try:
-        with open(args.jsonl, "r", encoding="utf-8") as f:
-            items = [json.loads(line.strip()) for line in f if line.strip()]
-        
-        # 限制样本数量（Kaggle资源限制）
-        if len(items) > args.max_samples:
-            print(f"⚠️ 样本数量过多，限制为前{args.max_samples}个")
-            items = items[:args.max_samples]
-        
-        print(f"📊 加载了 {len(items)} 个样本")
-        
-    except Exception as e:
-        print(f"❌ 数据加载失败: {e}")
-        return
+    # 4. 流式读取数据（按token预算分批，内存占用有界，无需截断样本）
+    def iter_items():
+        for idx, item in enumerate(iter_jsonl(args.jsonl)):
+            if args.max_samples is not None and idx >= args.max_samples:
+                print(f"⚠️ 达到 --max_samples 限制，只处理前{args.max_samples}个样本")
+                break
+            yield idx, item
     
     # 5. 加载模型
     try:
-        tokenizer, model, spt, device, attn_impl = load_models_with_fallback()
+        tokenizer, model, spt, device, attn_impl = load_models_with_fallback(args.bundle, args.attn_cache, args.reprobe_attn)
     except Exception as e:
         print(f"❌ 模型加载失败: {e}")
         return
@@ -176,61 +176,95 @@ def main():
         accelerate.utils.set_seed(args.seed)
         print(f"🎲 设置随机种子: {args.seed}")
     
-    # 7. 开始推理
+    # 实际加载的模型：离线模型包按源模型和权重文件指纹区分
+    model_id = bundle_model_id(args.bundle) if args.bundle else KAGGLE_CONFIG["MODEL_PATH"]
+    
+    # 断点续跑：已完成的样本记录在 manifest.jsonl 中
+    manifest = None
+    keys = {}
+    indexed_items = iter_items()
+    if args.resume:
+        settings = {
+            "model": model_id,
+            "codec": spt.checkpoint_id,
+            "dtype": "bf16",
+            "seed": args.seed,
+            "use_normalize": args.use_normalize,
+            "audio_format": args.audio_format,
+        }
+        os.makedirs(args.output_dir, exist_ok=True)
+        manifest = JobManifest(os.path.join(args.output_dir, "manifest.jsonl"), settings)
+        print(f"🔁 断点续跑: 已完成 {len(manifest.completed)} 个样本")
+        
+        def pending_items():
+            for idx, item, key in manifest.pending(iter_items()):
+                keys[idx] = key
+                yield idx, item
+        indexed_items = pending_items()
+    
+    # 7. 开始推理（微批次流水线，每个微批次完成后立即保存）
     print("🎵 开始音频生成...")
     try:
-        actual_texts_data, audio_results = process_batch(
-            batch_items=items,
-            tokenizer=tokenizer,
-            model=model,
-            spt=spt,
-            device=device,
-            system_prompt=KAGGLE_CONFIG["SYSTEM_PROMPT"],
-            start_idx=0,
-            use_normalize=args.use_normalize
-        )
-        
-        # 8. 保存结果
-        saved_count = 0
+        total_samples = 0
         results_info = []
+        # 后台线程编码并写入音频，不阻塞生成
+        writer = AudioWriter(args.audio_format, report=False)
+        os.makedirs(args.output_dir, exist_ok=True)
+        
+        def on_saved(output_path, idx, audio_result, key=None):
+            if key is not None:
+                manifest.mark_done(key, idx, output_path)
+            # 计算音频时长
+            duration = audio_result["audio_data"].shape[-1] / audio_result["sample_rate"]
+            results_info.append({
+                "index": idx,
+                "file": output_path,
+                "duration": f"{duration:.2f}s",
+                "sample_rate": audio_result["sample_rate"]
+            })
+            print(f"✅ 保存音频 {idx}: {output_path} ({duration:.2f}s)")
         
-        for idx, audio_result in enumerate(audio_results):
-            if audio_result is not None:
-                output_path = os.path.join(args.output_dir, f"kaggle_output_{idx}.wav")
-                
-                try:
-                    torchaudio.save(
-                        output_path,
-                        audio_result["audio_data"],
-                        audio_result["sample_rate"]
-                    )
-                    
-                    # 计算音频时长
-                    duration = audio_result["audio_data"].shape[-1] / audio_result["sample_rate"]
-                    
-                    results_info.append({
-                        "index": idx,
-                        "file": output_path,
-                        "duration": f"{duration:.2f}s",
-                        "sample_rate": audio_result["sample_rate"]
-                    })
-                    
-                    print(f"✅ 保存音频 {idx}: {output_path} ({duration:.2f}s)")
-                    saved_count += 1
-                    
-                except Exception as e:
-                    print(f"❌ 保存音频 {idx} 失败: {e}")
-            else:
-                print(f"⚠️ 跳过样本 {idx}（生成失败）")
+        def on_result(batch_texts_data, audio_results):
+            nonlocal total_samples
+            total_samples += len(audio_results)
+            # 8. 保存结果
+            for text_data, audio_result in zip(batch_texts_data, audio_results):
+                idx = text_data["index"]
+                if audio_result is None:
+                    print(f"⚠️ 跳过样本 {idx}（生成失败）")
+                    continue
+                key = keys.pop(idx) if manifest is not None else None
+                if manifest is None:
+                    output_path = writer.output_path(args.output_dir, f"kaggle_output_{idx}")
+                else:
+                    output_path = manifest.output_path(args.output_dir, idx, key, prefix="kaggle_output", extension=writer.extension)
+                writer.submit(output_path, audio_result["audio_data"], audio_result["sample_rate"],
+                              lambda path, idx=idx, audio_result=audio_result, key=key: on_saved(path, idx, audio_result, key))
+        
+        # 按长度分桶组成微批次，并打印每个批次的填充效率
+        micro_batches = bucket_batches(
+            indexed_items,
+            lambda item: estimate_item_tokens(item, tokenizer, KAGGLE_CONFIG["SYSTEM_PROMPT"]),
+            max_batch_tokens=args.max_batch_tokens,
+            max_batch_size=args.micro_batch_size,
+            min_efficiency=0.5,
+        )
+        pipeline = GenerationPipeline(tokenizer, model, spt, device, KAGGLE_CONFIG["SYSTEM_PROMPT"],
+                                      use_normalize=args.use_normalize)
+        pipeline.run(micro_batches, on_result)
+        pipeline.print_timings()
+        writer.close()
+        saved_count = writer.written
+        results_info.sort(key=lambda info: info["index"])
         
         # 9. 生成结果报告
         report_path = os.path.join(args.output_dir, "kaggle_results.json")
         report = {
-            "total_samples": len(items),
+            "total_samples": total_samples,
             "successful_generations": saved_count,
-            "failed_generations": len(items) - saved_count,
+            "failed_generations": total_samples - saved_count,
             "model_info": {
-                "model_path": KAGGLE_CONFIG["MODEL_PATH"],
+                "model_path": model_id,
                 "attention_implementation": attn_impl,
                 "device": device,
                 "use_normalize": args.use_normalize
@@ -249,7 +283,7 @@ def main():
         gc.collect()
         
         print("=" * 60)
-        print(f"🎉 推理完成！成功生成 {saved_count}/{len(items)} 个音频文件")
+        print(f"🎉 推理完成！成功生成 {saved_count}/{total_samples} 个音频文件")
         print(f"📁 输出目录: {args.output_dir}")
         
     except Exception as e:
@@ -259,7 +259,7 @@ else:
     print("请检查上面的错误信息")
 
 print("\n💡 使用建议:")
-print("1. 根据GPU内存调整--max_samples参数")
+print("1. 根据GPU内存调整--max_batch_tokens参数（不再需要用--max_samples截断）")
 print("2. 使用--use_normalize提高文本处理质量")
 print("3. 监控Kaggle的9小时使用限制")
 print("4. 及时下载生成的音频文件")
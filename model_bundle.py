@@ -0,0 +1,122 @@
+"""Offline model bundle: everything load_model needs in one directory, resolved without Hub lookups
+
+    python model_bundle.py --output_dir moss_ttsd_bundle
+    python inference.py --bundle moss_ttsd_bundle ...
+
+Layout:
+    bundle.json                   paths below plus the codec identity used in cache keys
+    lm/                           LM weights, config and tokenizer files (a Hub snapshot of the model)
+    codec/xy_tokenizer_config.yaml
+    codec/xy_tokenizer.safetensors  generator-only codec weights, memory-mapped on load
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+
+from XY_Tokenizer.xy_tokenizer.model import XY_Tokenizer
+from code_cache import checkpoint_fingerprint
+
+BUNDLE_FILE = "bundle.json"
+BUNDLE_VERSION = 1
+MODEL_PATH = "fnlp/MOSS-TTSD-v0.5"
+SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
+SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
+
+
+def create_bundle(output_dir, model_path=MODEL_PATH, spt_config_path=SPT_CONFIG_PATH, spt_checkpoint_path=SPT_CHECKPOINT_PATH):
+    """Collect the LM, its tokenizer and the codec into a bundle directory
+
+    Args:
+        output_dir: Bundle directory to create
+        model_path: Hub id or local directory of the LM
+        spt_config_path: XY_Tokenizer config file
+        spt_checkpoint_path: XY_Tokenizer checkpoint, converted to generator-only safetensors
+
+    Returns:
+        dict: The bundle description written to bundle.json
+    """
+    os.makedirs(os.path.join(output_dir, "codec"), exist_ok=True)
+
+    lm_dir = os.path.join(output_dir, "lm")
+    if os.path.isdir(model_path):
+        shutil.copytree(model_path, lm_dir, dirs_exist_ok=True)
+    else:
+        from huggingface_hub import snapshot_download
+        snapshot_download(model_path, local_dir=lm_dir)
+    print(f"LM and tokenizer stored in {lm_dir}")
+
+    codec_config = os.path.join("codec", "xy_tokenizer_config.yaml")
+    codec_checkpoint = os.path.join("codec", "xy_tokenizer.safetensors")
+    shutil.copyfile(spt_config_path, os.path.join(output_dir, codec_config))
+    if spt_checkpoint_path.endswith(".safetensors"):
+        shutil.copyfile(spt_checkpoint_path, os.path.join(output_dir, codec_checkpoint))
+    else:
+        XY_Tokenizer.convert_checkpoint(spt_checkpoint_path, os.path.join(output_dir, codec_checkpoint))
+    print(f"Codec stored in {os.path.join(output_dir, 'codec')}")
+
+    bundle = {
+        "version": BUNDLE_VERSION,
+        "source_model": model_path,
+        "model": "lm",
+        "codec_config": codec_config,
+        "codec_checkpoint": codec_checkpoint,
+        # Identity of the original checkpoint, so code caches and job manifests stay valid with the bundle
+        "codec_id": checkpoint_fingerprint(spt_checkpoint_path),
+    }
+    with open(os.path.join(output_dir, BUNDLE_FILE), "w", encoding="utf-8") as f:
+        json.dump(bundle, f, indent=2)
+    return bundle
+
+
+def _read_bundle(bundle_dir):
+    with open(os.path.join(bundle_dir, BUNDLE_FILE), "r", encoding="utf-8") as f:
+        bundle = json.load(f)
+    if bundle.get("version") != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported model bundle version {bundle.get('version')} in {bundle_dir}")
+    return bundle
+
+
+def bundle_model_id(bundle_dir):
+    """Identity of a bundle's LM for job settings: its source model and a fingerprint of its weight files"""
+    bundle = _read_bundle(bundle_dir)
+    lm_dir = os.path.join(bundle_dir, bundle["model"])
+    hasher = hashlib.sha256()
+    for name in sorted(os.listdir(lm_dir)):
+        if name.endswith((".safetensors", ".bin")):
+            hasher.update(f"{name}:{checkpoint_fingerprint(os.path.join(lm_dir, name))}".encode())
+    return f"{bundle['source_model']}@{hasher.hexdigest()[:16]}"
+
+
+def resolve_bundle(bundle_dir):
+    """load_model arguments of a bundle: model_path, spt_config_path, spt_checkpoint_path and checkpoint_id"""
+    bundle = _read_bundle(bundle_dir)
+    return {
+        "model_path": os.path.join(bundle_dir, bundle["model"]),
+        "spt_config_path": os.path.join(bundle_dir, bundle["codec_config"]),
+        "spt_checkpoint_path": os.path.join(bundle_dir, bundle["codec_checkpoint"]),
+        "checkpoint_id": bundle["codec_id"],
+    }
+
+
+def load_bundle(bundle_dir, **kwargs):
+    """load_model from a bundle, without Hub lookups; kwargs are passed on (device, torch_dtype, ...)"""
+    from generation_utils import load_model  # Not needed to create a bundle
+    return load_model(**resolve_bundle(bundle_dir), local_files_only=True, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create an offline model bundle for fast, Hub-free startup")
+    parser.add_argument("--output_dir", required=True, help="Bundle directory to create")
+    parser.add_argument("--model_path", default=MODEL_PATH, help=f"Hub id or local directory of the LM (default: {MODEL_PATH})")
+    parser.add_argument("--spt_config_path", default=SPT_CONFIG_PATH, help=f"XY_Tokenizer config (default: {SPT_CONFIG_PATH})")
+    parser.add_argument("--spt_checkpoint_path", default=SPT_CHECKPOINT_PATH, help=f"XY_Tokenizer checkpoint (default: {SPT_CHECKPOINT_PATH})")
+    args = parser.parse_args()
+
+    bundle = create_bundle(args.output_dir, args.model_path, args.spt_config_path, args.spt_checkpoint_path)
+    print(f"Model bundle written to {args.output_dir}: {json.dumps(bundle)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,6 @@ from transformers.generation.configuration_utils import GenerationConfig
 from transformers.generation.stopping_criteria import StoppingCriteriaList
 from transformers import PreTrainedModel, GenerationMixin, Qwen3Config, Qwen3Model
 from transformers.generation.logits_process import LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TopKLogitsWarper, TopPLogitsWarper, TemperatureLogitsWarper
-from liger_kernel.transformers.model.loss_utils import LigerForCausalLMLoss
 
 
 class AsteroidTTSConfig(Qwen3Config):
@@ -387,6 +386,8 @@ class AsteroidTTSInstruct(AsteroidTTSPretrainedModel, CustomMixin):
             for i in range(self.config.channels):
                 vocab_size = self.config.vocab_size if i == 0 else self.config.speech_vocab_size
                 if skip_logits:
+                    # Training-only dependency, imported on first use so inference never loads it
+                    from liger_kernel.transformers.model.loss_utils import LigerForCausalLMLoss
                     loss_all[i] = LigerForCausalLMLoss(
                         hidden_states=hidden_states,
                         lm_head_weight=self.lm_heads[i].weight,
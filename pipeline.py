@@ -0,0 +1,333 @@
+import json
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+from generation_utils import (
+    prepare_batch_texts,
+    load_batch_speaker_audios,
+    encode_batch_prompt_codes,
+    build_batch_inputs,
+    generate_speech_ids_safe,
+    decode_speech_ids,
+    extract_speech_codes,
+    split_valid_items,
+    failed_text_data,
+    merge_failed_results,
+    bucket_batches,
+)
+
+STAGES = ("load", "encode", "generate", "decode", "write")
+GPU_STAGES = ("encode", "generate", "decode")
+_DONE = object()  # End-of-stream marker passed between stages
+
+
+class GenerationPipeline:
+    """Overlapped version of process_batch for a stream of micro-batches
+
+    Each micro-batch flows through five stages connected by bounded queues:
+        load      parse items and read/resample prompt audio on a thread pool
+        encode    encode prompt audio with the codec and build the model inputs
+        generate  run the LM
+        decode    decode speech tokens with the codec
+        write     hand the results to the caller's on_result callback
+    While one micro-batch is generating, the next one is loaded and encoded and the previous one is
+    decoded and written. Results are delivered in input order. On CUDA, the codec encode and decode
+    stages issue their work on their own streams, so their kernels can run alongside generation on the
+    default stream instead of queuing behind it; every GPU stage waits for its stream before handing a
+    micro-batch on.
+
+    Failures are isolated: invalid items are rejected in the load stage, OOMs in generation split the
+    micro-batch (see generation_utils.generate_speech_ids_safe), and an error in any other stage fails
+    only its own micro-batch, whose items are reported with None audio.
+
+    With codes_only, the decode stage only copies the speech codes to the host and the results hold codes
+    instead of audio (see generation_utils.extract_speech_codes).
+    """
+
+    def __init__(self, tokenizer, model, spt, device, system_prompt, use_normalize=False, code_cache=None,
+                 prompt_trim=None, io_workers=4, queue_size=2, limiter=None, codes_only=False):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.spt = spt
+        self.device = device
+        self.system_prompt = system_prompt
+        self.use_normalize = use_normalize
+        self.code_cache = code_cache
+        self.prompt_trim = prompt_trim
+        self.io_workers = io_workers
+        self.queue_size = queue_size
+        self.limiter = limiter
+        self.codes_only = codes_only
+        self.timings = {stage: {"seconds": 0.0, "batches": 0} for stage in STAGES}
+        self.wall_seconds = 0.0
+        self._timings_lock = threading.Lock()  # Load runs on several pool threads
+
+    def _load(self, indices, batch_items):
+        valid_items, valid_indices, failed_texts_data = split_valid_items(batch_items, indices, self.use_normalize)
+        batch = {"indices": indices, "items": dict(zip(indices, batch_items)), "valid_indices": valid_indices,
+                 "failed": failed_texts_data, "texts_data": [], "audio_results": [], "error": None}
+        if valid_items:
+            self._run_isolated("load", batch, self._load_valid, valid_items)
+        return batch
+
+    def _load_valid(self, batch, valid_items):
+        batch["texts"], batch["prompts"], prompt_audios, batch["texts_data"] = prepare_batch_texts(
+            valid_items, self.system_prompt, batch["valid_indices"], self.use_normalize)
+        batch["speaker_wavs"] = load_batch_speaker_audios(prompt_audios, trim_options=self.prompt_trim)
+
+    def _encode(self, batch):
+        prompt_codes = encode_batch_prompt_codes(self.spt, batch.pop("speaker_wavs"), self.device, self.code_cache)
+        batch["input_ids"], batch["attention_mask"] = build_batch_inputs(
+            self.tokenizer, self.spt, batch["texts"], batch["prompts"], prompt_codes, self.device)
+
+    def _generate(self, batch):
+        print(f"Starting batch audio generation for samples {batch['valid_indices']}...")
+        batch["speech_ids"], batch["li"] = generate_speech_ids_safe(
+            self.model, batch.pop("input_ids"), batch.pop("attention_mask"), self.device, self.limiter)
+
+    def _decode(self, batch):
+        if self.codes_only:
+            batch["audio_results"] = extract_speech_codes(batch.pop("speech_ids"), batch.pop("li"), batch["valid_indices"])
+            return
+        batch["audio_results"] = decode_speech_ids(self.spt, batch.pop("speech_ids"), batch.pop("li"), batch["valid_indices"])
+
+    @staticmethod
+    def _on_stream(stream, fn, batch):
+        """Run a GPU stage on a micro-batch on its stream (None: the default stream) and wait for the results"""
+        with torch.cuda.stream(stream) if stream is not None else nullcontext():
+            current = torch.cuda.current_stream()
+            # Tensors made on another stage's stream must not be reused by the allocator while this one reads them
+            for value in batch.values():
+                if isinstance(value, torch.Tensor) and value.is_cuda:
+                    value.record_stream(current)
+            fn(batch)
+            current.synchronize()  # The next stage runs on another stream
+
+    def _run_isolated(self, stage, batch, fn, *args):
+        """Run one stage on a micro-batch; an error fails that micro-batch only"""
+        if batch["error"] is not None or not batch["valid_indices"]:
+            return
+        try:
+            fn(batch, *args)
+        except Exception as e:
+            print(f"Error in {stage} stage for samples {batch['valid_indices']}: {e}, skipping them...")
+            import traceback
+            traceback.print_exc()
+            batch["error"] = f"{stage} failed: {e}"
+
+    def _results(self, batch):
+        """(actual_texts_data, audio_results) of a finished micro-batch in input order"""
+        failed = list(batch["failed"])
+        texts_data, audio_results = batch["texts_data"], batch["audio_results"]
+        if batch["error"] is not None:
+            failed += [failed_text_data(index, batch["items"][index], batch["error"], self.use_normalize)
+                       for index in batch["valid_indices"]]
+            texts_data, audio_results = [], []
+        return merge_failed_results(batch["indices"], texts_data, audio_results, failed)
+
+    def run(self, micro_batches, on_result):
+        """Process micro-batches and call on_result(actual_texts_data, audio_results) for each, in order
+
+        Args:
+            micro_batches: Iterable of (indices, batch_items); it is consumed lazily
+            on_result: Callback run on the write stage, e.g. to save the audio files of a micro-batch
+
+        Returns:
+            dict: Per-stage busy time and batch count, see also print_timings
+        """
+        stop = threading.Event()
+        errors = []
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(STAGES) - 1)]
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _DONE
+
+        def timed(stage, fn, *args):
+            begin = time.perf_counter()
+            result = fn(*args)
+            with self._timings_lock:
+                self.timings[stage]["seconds"] += time.perf_counter() - begin
+                self.timings[stage]["batches"] += 1
+            return result
+
+        def fail(e):
+            errors.append(e)
+            stop.set()
+
+        def load_stage(pool):
+            # Futures are queued in submission order, so at most queue_size micro-batches are read ahead
+            try:
+                for indices, batch_items in micro_batches:
+                    if stop.is_set():
+                        break
+                    put(queues[0], pool.submit(timed, "load", self._load, indices, batch_items))
+            except Exception as e:
+                fail(e)
+            put(queues[0], _DONE)
+
+        def worker_stage(stage, fn, in_q, out_q):
+            try:
+                while True:
+                    item = get(in_q)
+                    if item is _DONE:
+                        break
+                    if stage == "encode":
+                        item = item.result()  # Loaded on the I/O pool
+                    timed(stage, fn, item)  # Stages update the micro-batch in place
+                    if out_q is not None:
+                        put(out_q, item)
+            except Exception as e:
+                fail(e)
+            if out_q is not None:
+                put(out_q, _DONE)
+
+        use_streams = torch.cuda.is_available() and torch.device(self.device).type == "cuda"
+        streams = {stage: torch.cuda.Stream(device=self.device) for stage in ("encode", "decode")} if use_streams else {}
+
+        def isolated(stage, fn):
+            if use_streams and stage in GPU_STAGES:
+                stream = streams.get(stage)
+                return lambda batch: self._run_isolated(stage, batch, lambda b: self._on_stream(stream, fn, b))
+            return lambda batch: self._run_isolated(stage, batch, fn)
+
+        def write(batch):
+            on_result(*self._results(batch))
+
+        wall_begin = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.io_workers) as pool:
+            threads = [
+                threading.Thread(target=load_stage, args=(pool,), daemon=True),
+                threading.Thread(target=worker_stage, args=("encode", isolated("encode", self._encode), queues[0], queues[1]), daemon=True),
+                threading.Thread(target=worker_stage, args=("generate", isolated("generate", self._generate), queues[1], queues[2]), daemon=True),
+                threading.Thread(target=worker_stage, args=("decode", isolated("decode", self._decode), queues[2], queues[3]), daemon=True),
+                threading.Thread(target=worker_stage, args=("write", write, queues[3], None), daemon=True),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.wall_seconds += time.perf_counter() - wall_begin
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if errors:
+            print(f"Error during pipelined processing: {errors[0]}")
+            raise errors[0]
+        return self.timings
+
+    def print_timings(self):
+        """Print per-stage busy time; stages overlap, so their sum can exceed the wall time"""
+        print(f"Pipeline wall time: {self.wall_seconds:.2f}s")
+        for stage in STAGES:
+            timing = self.timings[stage]
+            print(f"  {stage:<8} {timing['seconds']:8.2f}s busy over {timing['batches']} micro-batches")
+
+
+class RequestBatcher:
+    """Coalesces concurrent single-item requests, e.g. from a web UI, into length-bucketed batches
+
+    A worker thread waits for a request, gathers the others that arrive within max_wait_seconds, groups
+    them with generation_utils.bucket_batches and runs each batch through run_batch. Requests with
+    different group keys (e.g. different normalization settings) never share a batch.
+
+    Args:
+        run_batch: Function (indices, batch_items, group) -> (actual_texts_data, audio_results), e.g. a
+            process_batch call
+        cost_fn: Function item -> (prompt_tokens, output_frames), e.g. generation_utils.estimate_item_tokens
+        max_batch_size: Maximum number of requests per batch
+        max_batch_tokens: Optional padded token budget of one batch
+        max_wait_seconds: How long the first request of a batch waits for others
+        min_efficiency: Lowest padding efficiency of a batch, see generation_utils.bucket_batches
+    """
+
+    def __init__(self, run_batch, cost_fn, max_batch_size=4, max_batch_tokens=None, max_wait_seconds=0.05,
+                 min_efficiency=0.5):
+        self.run_batch = run_batch
+        self.cost_fn = cost_fn
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait_seconds = max_wait_seconds
+        self.min_efficiency = min_efficiency
+        self._requests = queue.Queue()
+        self._counter = 0
+        self._counter_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit(self, item, group=None):
+        """Queue one item; the future resolves to its (text_data, audio_result)"""
+        future = Future()
+        with self._counter_lock:
+            index = self._counter
+            self._counter += 1
+        self._requests.put((index, item, group, future))
+        return future
+
+    def __call__(self, item, group=None, timeout=None):
+        return self.submit(item, group).result(timeout)
+
+    def _gather(self):
+        requests = [self._requests.get()]
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                requests.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return requests
+
+    def _worker(self):
+        while True:
+            requests = self._gather()
+            groups = {}
+            for request in requests:
+                groups.setdefault(request[2], []).append(request)
+            for group, group_requests in groups.items():
+                futures = {index: future for index, _, _, future in group_requests}
+                try:
+                    batches = list(bucket_batches(
+                        [(index, item) for index, item, _, _ in group_requests], self.cost_fn,
+                        max_batch_tokens=self.max_batch_tokens, max_batch_size=self.max_batch_size,
+                        lookahead=len(group_requests), min_efficiency=self.min_efficiency))
+                except Exception as e:
+                    for future in futures.values():
+                        future.set_exception(e)
+                    continue
+                for indices, batch_items in batches:
+                    try:
+                        actual_texts_data, audio_results = self.run_batch(indices, batch_items, group)
+                        for index, text_data, audio_result in zip(indices, actual_texts_data, audio_results):
+                            futures[index].set_result((text_data, audio_result))
+                    except Exception as e:
+                        for index in indices:
+                            if not futures[index].done():
+                                futures[index].set_exception(e)
+
+
+def iter_jsonl(path):
+    """Lazily yield the items of a JSONL file, skipping blank lines"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
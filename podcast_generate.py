@@ -1,12 +1,12 @@
 import os
 import torch
-import torchaudio
 import requests
 from bs4 import BeautifulSoup
 import re
 from PyPDF2 import PdfReader
 import openai
 from generation_utils import load_model, process_batch
+from audio_writer import AUDIO_FORMATS, AudioWriter
 import argparse
 
 # =============== Configuration Section ===============
@@ -355,13 +355,14 @@ def generate_podcast_script(content, language='zh'):
 
 # =============== Main Function ===============
 
-def process_input_to_audio(input_path: str, output_dir: str = "examples", language: str = 'zh'):
+def process_input_to_audio(input_path: str, output_dir: str = "examples", language: str = 'zh', audio_format: str = "wav"):
     """Complete processing pipeline: from input to audio output
     
     Args:
         input_path (str): Input path (URL, PDF or TXT file)
         output_dir (str): Output directory
         language (str): Language for the podcast script ('en' or 'zh')
+        audio_format (str): Output audio format, a key of audio_writer.AUDIO_FORMATS
     """
     
     # Select prompts based on language
@@ -398,9 +399,7 @@ def process_input_to_audio(input_path: str, output_dir: str = "examples", langua
 
     # 3. Load TTS model
     print("\nStep 3: Load TTS model")
-    tokenizer, model, spt = load_model(MODEL_PATH, SPT_CONFIG_PATH, SPT_CHECKPOINT_PATH)
-    spt = spt.to(device)
-    model = model.to(device)
+    tokenizer, model, spt = load_model(MODEL_PATH, SPT_CONFIG_PATH, SPT_CHECKPOINT_PATH, device=device)
     print("TTS model loading completed")
     
     # 4. Prepare TTS input data with language-specific prompts
@@ -435,13 +434,12 @@ def process_input_to_audio(input_path: str, output_dir: str = "examples", langua
     print("\nStep 6: Save audio files")
     os.makedirs(output_dir, exist_ok=True)
     
-    for idx, audio_result in enumerate(audio_results):
-        if audio_result is not None:
-            output_path = os.path.join(output_dir, f"generated_podcast_{idx}.wav")
-            torchaudio.save(output_path, audio_result["audio_data"], audio_result["sample_rate"])
-            print(f"Audio saved to: {output_path}")
-        else:
-            print(f"Audio generation failed: sample {idx}")
+    with AudioWriter(audio_format) as writer:
+        for idx, audio_result in enumerate(audio_results):
+            if audio_result is not None:
+                writer.submit(writer.output_path(output_dir, f"generated_podcast_{idx}"), audio_result["audio_data"], audio_result["sample_rate"])
+            else:
+                print(f"Audio generation failed: sample {idx}")
     
     print("\nProcessing completed!")
 
@@ -454,6 +452,7 @@ if __name__ == "__main__":
     parser.add_argument("input_path", help="Input path: URL address, PDF file path or TXT file path")
     parser.add_argument("-o", "--output", default="outputs", help="Output directory (default: outputs)")
     parser.add_argument("-l", "--language", default="zh", choices=['en', 'zh'], help="Language of the podcast script (en or zh, default: zh)")
+    parser.add_argument("-f", "--audio_format", default="wav", choices=sorted(AUDIO_FORMATS), help="Output audio format: wav, pcm16, flac or opus (default: wav)")
     
     args = parser.parse_args()
     
@@ -462,4 +461,4 @@ if __name__ == "__main__":
     print(f"Output directory: {args.output}")
     print(f"Script language: {args.language}")
     
-    process_input_to_audio(args.input_path, args.output, args.language)
\ No newline at end of file
+    process_input_to_audio(args.input_path, args.output, args.language, args.audio_format)
\ No newline at end of file
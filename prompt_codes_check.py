@@ -0,0 +1,64 @@
+"""Check that per-speaker prompt encoding with code-level concatenation matches the waveform-concat path
+
+Each speaker's reference is encoded on its own and the codes are concatenated (encode_prompt_codes); the
+reference path encodes the concatenated waveform. Both must yield the same number of frames, and the codes
+must agree overall and around the speaker boundaries, where the codec's receptive field sees the other speaker.
+
+    python prompt_codes_check.py --jsonl examples/examples.jsonl
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from XY_Tokenizer.xy_tokenizer.model import XY_Tokenizer
+from generation_utils import process_jsonl_item, load_speaker_audios, check_prompt_code_concat
+from pipeline import iter_jsonl
+
+SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
+SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare code-level and waveform-level concatenation of speaker prompts")
+    parser.add_argument("--jsonl", default="examples/examples.jsonl", help="Items with prompt audio (default: examples/examples.jsonl)")
+    parser.add_argument("--max_items", type=int, default=None, help="Check at most this many items with prompt audio (default: all)")
+    parser.add_argument("--boundary_frames", type=int, default=4, help="Frames on each side of a speaker boundary (default: 4)")
+    parser.add_argument("--min_agreement", type=float, default=0.9, help="Fail if the overall code agreement is below this (default: 0.9)")
+    parser.add_argument("--min_boundary_agreement", type=float, default=0.5,
+                        help="Fail if the code agreement around speaker boundaries is below this (default: 0.5)")
+    parser.add_argument("--spt_config_path", default=SPT_CONFIG_PATH, help=f"XY_Tokenizer config (default: {SPT_CONFIG_PATH})")
+    parser.add_argument("--spt_checkpoint_path", default=SPT_CHECKPOINT_PATH, help=f"XY_Tokenizer checkpoint (default: {SPT_CHECKPOINT_PATH})")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    spt = XY_Tokenizer.load_from_checkpoint(config_path=args.spt_config_path, ckpt_path=args.spt_checkpoint_path, parts=("encoder",))
+    spt = spt.to(device).eval()
+
+    results = []
+    for index, item in enumerate(iter_jsonl(args.jsonl)):
+        prompt_audio = process_jsonl_item(item)["prompt_audio"]
+        if not prompt_audio:
+            continue
+        wavs = load_speaker_audios(prompt_audio, target_sample_rate=spt.input_sample_rate)
+        result = check_prompt_code_concat(spt, wavs, device, boundary_frames=args.boundary_frames)
+        print(f"Item {index}: {len(wavs)} speakers, {result['code_concat_frames']} / {result['waveform_concat_frames']} frames, "
+              f"agreement {result['agreement']:.4f}, boundary agreement {result['boundary_agreement']:.4f}")
+        assert result["code_concat_frames"] == result["waveform_concat_frames"], f"frame count mismatch in item {index}"
+        results.append(result)
+        if args.max_items is not None and len(results) >= args.max_items:
+            break
+
+    if not results:
+        raise SystemExit(f"No items with prompt audio in {args.jsonl}")
+    agreement = float(np.mean([result["agreement"] for result in results]))
+    boundary_agreement = float(np.mean([result["boundary_agreement"] for result in results]))
+    print(f"{len(results)} items: agreement {agreement:.4f}, boundary agreement {boundary_agreement:.4f}")
+    assert agreement >= args.min_agreement, f"code agreement {agreement:.4f} below {args.min_agreement}"
+    assert boundary_agreement >= args.min_boundary_agreement, \
+        f"boundary code agreement {boundary_agreement:.4f} below {args.min_boundary_agreement}"
+    print("Code-level concatenation matches the waveform-concat path")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import re
+import threading
+from collections import OrderedDict
+
+
+def build_prompt(prompt, text):
+    """The LM input text of one item, up to the start of speech"""
+    return f"<|begin_of_style|>{prompt}<|end_of_style|>\n<|begin_of_text|>{text}<|end_of_text|>\n<|begin_of_speech|>"
+
+
+class PromptTokenizer:
+    """Segment-memoizing, batched wrapper of the LM tokenizer for prompt assembly
+
+    Prompts are split at the tokenizer's added tokens (<|begin_of_style|>, <|begin_of_text|>, speaker tags
+    if they are added tokens, ...), which the tokenizer never merges with their neighbours. The segments in
+    between - the system prompt, speaker prompt texts, script turns - are memoized, so the system prompt is
+    tokenized once per process. The uncached segments of a whole batch go through one batch call of the
+    fast tokenizer.
+
+    The first encoded prompts are compared with tokenizer.encode; if a tokenizer does not split at added
+    tokens this way, every later call falls back to plain batch encoding.
+
+    Args:
+        tokenizer: Hugging Face tokenizer
+        cache_size: Number of distinct segments whose ids are kept
+        verify_count: Number of prompts compared with tokenizer.encode before the segmenting is trusted
+    """
+
+    def __init__(self, tokenizer, cache_size=65536, verify_count=4):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._added = dict(tokenizer.get_added_vocab())
+        self._split = re.compile("(" + "|".join(re.escape(token) for token in sorted(self._added, key=len, reverse=True)) + ")") \
+            if self._added else None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._to_verify = verify_count
+        self._exact = self._split is not None
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, seq):
+        return self.encode_batch([seq])[0]
+
+    def encode_batch(self, seqs):
+        """Token ids of each sequence, equal to tokenizer.encode(seq)"""
+        if not self._exact:
+            return self._encode_plain(seqs)
+
+        pieces_list = [[piece for piece in self._split.split(seq) if piece] for seq in seqs]
+        known, missing = {}, {}
+        with self._lock:
+            for pieces in pieces_list:
+                for piece in pieces:
+                    if piece in self._added or piece in known or piece in missing:
+                        continue
+                    if piece in self._cache:
+                        self._cache.move_to_end(piece)
+                        known[piece] = self._cache[piece]
+                        self.hits += 1
+                    else:
+                        missing[piece] = None
+                        self.misses += 1
+
+        # One batch call for every new segment of the batch
+        if missing:
+            known.update(zip(missing, self.tokenizer(list(missing), add_special_tokens=False)["input_ids"]))
+            with self._lock:
+                for piece in missing:
+                    self._cache[piece] = known[piece]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        results = []
+        for pieces in pieces_list:
+            ids = []
+            for piece in pieces:
+                if piece in self._added:
+                    ids.append(self._added[piece])
+                else:
+                    ids.extend(known[piece])
+            results.append(ids)
+
+        if self._to_verify > 0:
+            self._verify(seqs, results)
+            if not self._exact:
+                return self._encode_plain(seqs)
+        return results
+
+    def _verify(self, seqs, results):
+        for seq, ids in zip(seqs, results):
+            if self._to_verify <= 0:
+                return
+            self._to_verify -= 1
+            if list(self.tokenizer.encode(seq)) != list(ids):
+                print("Warning: segmented prompt tokenization differs from tokenizer.encode, using plain batch encoding")
+                self._exact = False
+                return
+
+    def _encode_plain(self, seqs):
+        return [list(ids) for ids in self.tokenizer(list(seqs))["input_ids"]]
@@ -0,0 +1,265 @@
+import os
+import json
+import threading
+
+import numpy as np
+import torch
+
+from audio_writer import to_host
+
+STORE_VERSION = 1
+IGNORE_INDEX = -100  # Label value of positions without loss
+_SPEECH_IGNORE = np.iinfo(np.uint16).max  # Stored in place of IGNORE_INDEX in the uint16 speech channels
+
+
+def to_code_array(speech_ids):
+    """(T, nq) speech tokens as a compact uint16 array; XY_Tokenizer codebooks have 1024 entries"""
+    if isinstance(speech_ids, torch.Tensor):
+        speech_ids = speech_ids.detach().cpu().numpy()
+    speech_ids = np.asarray(speech_ids)
+    if speech_ids.size and (speech_ids.min() < 0 or speech_ids.max() > np.iinfo(np.uint16).max):
+        raise ValueError(f"Speech codes out of uint16 range: [{speech_ids.min()}, {speech_ids.max()}]")
+    return np.ascontiguousarray(speech_ids, dtype=np.uint16)
+
+
+class CodeStore:
+    """Append-only, memory-mappable container of variable-length (T, channels) code sequences
+
+    A store is a directory:
+        store.json    layout: number of channels and whether channel 0 is a text channel
+        speech.bin    uint16 speech channels, one row per frame
+        text.bin      int32 channel 0 (text ids, or speech codes plus the text offset), only with text_channel
+        index.jsonl   one line per entry: key, first frame, length and metadata
+    Speech channels take 2 bytes per value instead of 8 for int64 arrays or ~30 for pickled lists, and
+    IGNORE_INDEX labels are kept as a reserved uint16 value. The data files are memory-mapped, so opening
+    a store reads only its index.
+
+    Data is appended before its index line and the index is the source of truth, so an interrupted writer
+    never exposes a partial entry; the next writer drops the orphaned rows. Appends are serialized by a
+    lock; a store should have one writing process at a time.
+
+    Args:
+        path: Store directory, created on the first append if missing
+        channels: Number of channels per frame, for a new store
+        text_channel: Keep channel 0 as int32, for a new store (LM input ids and labels)
+    """
+
+    def __init__(self, path, channels=8, text_channel=False):
+        self.path = path
+        self.channels = channels
+        self.text_channel = text_channel
+        self._lock = threading.Lock()
+        self._entries = []
+        self._by_key = {}
+        self._rows = 0  # Frames covered by the index
+        self._index_bytes = 0  # Size of the valid part of index.jsonl
+        self._files = None  # Append handles, opened on the first append
+        self._maps = None
+        self._mapped_rows = -1
+
+        layout_path = os.path.join(path, "store.json")
+        if os.path.exists(layout_path):
+            with open(layout_path, "r", encoding="utf-8") as f:
+                layout = json.load(f)
+            if layout.get("version") != STORE_VERSION:
+                raise ValueError(f"Unsupported code store version {layout.get('version')} in {path}")
+            self.channels, self.text_channel = layout["channels"], layout["text_channel"]
+            self._load_index()
+
+    @property
+    def speech_channels(self):
+        return self.channels - 1 if self.text_channel else self.channels
+
+    def _data_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _data_rows(self):
+        """Complete frames present in every data file"""
+        rows = os.path.getsize(self._data_path("speech.bin")) // (2 * self.speech_channels) \
+            if os.path.exists(self._data_path("speech.bin")) else 0
+        if self.text_channel:
+            text_rows = os.path.getsize(self._data_path("text.bin")) // 4 if os.path.exists(self._data_path("text.bin")) else 0
+            rows = min(rows, text_rows)
+        return rows
+
+    def _load_index(self):
+        data_rows = self._data_rows()
+        index_path = self._data_path("index.jsonl")
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "rb") as f:
+            position = 0
+            for line in f:
+                position += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Partial last line of an interrupted write
+                if entry["offset"] + entry["length"] > data_rows:
+                    break  # Index line of data that never reached the disk
+                self._add_entry(entry)
+                self._index_bytes = position
+
+    def _add_entry(self, entry):
+        self._entries.append(entry)
+        self._rows = max(self._rows, entry["offset"] + entry["length"])
+        if entry.get("key") is not None:
+            self._by_key[entry["key"]] = len(self._entries) - 1
+
+    def _open_for_append(self):
+        os.makedirs(self.path, exist_ok=True)
+        layout_path = self._data_path("store.json")
+        if not os.path.exists(layout_path):
+            with open(layout_path, "w", encoding="utf-8") as f:
+                json.dump({"version": STORE_VERSION, "channels": self.channels, "text_channel": self.text_channel}, f)
+        # Drop rows and index lines written after the last complete entry, e.g. by an interrupted writer
+        names = ["speech.bin"] + (["text.bin"] if self.text_channel else [])
+        sizes = {"speech.bin": self._rows * 2 * self.speech_channels, "text.bin": self._rows * 4,
+                 "index.jsonl": self._index_bytes}
+        for name in names + ["index.jsonl"]:
+            with open(self._data_path(name), "ab") as f:
+                f.truncate(sizes[name])
+        self._files = {name: open(self._data_path(name), "ab") for name in names}
+        self._files["index"] = open(self._data_path("index.jsonl"), "ab")
+
+    def append(self, codes, key=None, metadata=None):
+        """Add one (T, channels) sequence, return its position
+
+        Args:
+            codes: (T, channels) integer array or tensor; speech channels hold 0..65534 or IGNORE_INDEX
+            key: Optional lookup key, e.g. a content hash; a later entry with the same key replaces it in lookups
+            metadata: Optional JSON-serialisable dict kept in the index
+        """
+        if isinstance(codes, torch.Tensor):
+            codes = codes.detach().cpu().numpy()
+        codes = np.asarray(codes)
+        if codes.ndim != 2 or codes.shape[1] != self.channels:
+            raise ValueError(f"Expected codes of shape (T, {self.channels}), got {codes.shape}")
+
+        speech = codes[:, 1:] if self.text_channel else codes
+        speech = to_code_array(np.where(speech == IGNORE_INDEX, _SPEECH_IGNORE, speech))
+        with self._lock:
+            if self._files is None:
+                self._open_for_append()
+            entry = {"key": key, "offset": self._rows, "length": int(codes.shape[0])}
+            if metadata:
+                entry["metadata"] = metadata
+            self._files["speech.bin"].write(speech.tobytes())
+            self._files["speech.bin"].flush()
+            if self.text_channel:
+                self._files["text.bin"].write(np.ascontiguousarray(codes[:, 0], dtype=np.int32).tobytes())
+                self._files["text.bin"].flush()
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+            self._files["index"].write(line)
+            self._files["index"].flush()
+            self._add_entry(entry)
+            self._index_bytes += len(line)
+            return len(self._entries) - 1
+
+    def sync(self):
+        """Force every appended entry to disk, e.g. before recording it as done in a JobManifest"""
+        with self._lock:
+            if self._files is not None:
+                for f in self._files.values():
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._by_key
+
+    def find(self, key):
+        """Position of the entry with this key, None if absent"""
+        return self._by_key.get(key)
+
+    def keys(self):
+        return [entry.get("key") for entry in self._entries]
+
+    @property
+    def lengths(self):
+        """Frames of every entry, from the index alone"""
+        return np.array([entry["length"] for entry in self._entries], dtype=np.int64)
+
+    def metadata(self, i):
+        return self._entries[i].get("metadata", {})
+
+    def _mapped(self):
+        """Memory maps of the data files, reopened once appends outgrow them"""
+        with self._lock:
+            if self._mapped_rows < self._rows:
+                if self._files is not None:
+                    for f in self._files.values():
+                        f.flush()
+                self._maps = {"speech": np.memmap(self._data_path("speech.bin"), dtype=np.uint16, mode="r",
+                                                  shape=(self._rows, self.speech_channels))} if self._rows else {}
+                if self.text_channel and self._rows:
+                    self._maps["text"] = np.memmap(self._data_path("text.bin"), dtype=np.int32, mode="r", shape=(self._rows,))
+                self._mapped_rows = self._rows
+            return self._maps
+
+    def speech(self, i):
+        """Zero-copy (T, speech_channels) uint16 view of an entry's speech channels"""
+        entry = self._entries[i]
+        if entry["length"] == 0:
+            return np.zeros((0, self.speech_channels), dtype=np.uint16)
+        return self._mapped()["speech"][entry["offset"]:entry["offset"] + entry["length"]]
+
+    def get(self, i, dtype=np.int64):
+        """(T, channels) codes of an entry, with IGNORE_INDEX restored"""
+        entry = self._entries[i]
+        out = np.empty((entry["length"], self.channels), dtype=dtype)
+        speech = self.speech(i)
+        speech_out = out[:, 1:] if self.text_channel else out
+        speech_out[...] = speech
+        speech_out[speech == _SPEECH_IGNORE] = IGNORE_INDEX
+        if self.text_channel and entry["length"]:
+            out[:, 0] = self._mapped()["text"][entry["offset"]:entry["offset"] + entry["length"]]
+        return out
+
+    def close(self):
+        with self._lock:
+            if self._files is not None:
+                for f in self._files.values():
+                    f.close()
+                self._files = None
+            self._maps, self._mapped_rows = None, -1
+
+
+def plan_decode_batches(code_files, max_batch_size=8, max_batch_frames=None):
+    """Group code sequences of similar length into decode batches
+
+    Args:
+        code_files: List of (id, num_frames) pairs
+        max_batch_size: Maximum number of sequences per batch
+        max_batch_frames: Optional budget of batch_size * longest length; the codec pads to the longest item
+
+    Returns:
+        list: Lists of ids
+    """
+    batches, batch, longest = [], [], 0
+    for path, num_frames in sorted(code_files, key=lambda entry: entry[1]):
+        new_longest = max(longest, num_frames)
+        over_budget = max_batch_frames is not None and new_longest * (len(batch) + 1) > max_batch_frames
+        if batch and (len(batch) >= max_batch_size or over_budget):
+            batches.append(batch)
+            batch, new_longest = [], num_frames
+        batch.append(path)
+        longest = new_longest
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def decode_code_batch(spt, codes_list, device, overlap_seconds=10):
+    """Decode several (T, nq) code arrays with one codec call
+
+    Returns:
+        list: One (1, samples) CPU waveform per input
+    """
+    with torch.no_grad():
+        codes_list = [torch.from_numpy(np.asarray(codes, dtype=np.int64)).permute(1, 0) for codes in codes_list]
+        decode_result = spt.decode(codes_list, overlap_seconds=overlap_seconds, device=device)
+    wavs = [wav.detach().float() for wav in decode_result["syn_wav_list"]]
+    return to_host([wav.unsqueeze(0) if wav.ndim == 1 else wav for wav in wavs])
@@ -0,0 +1,91 @@
+"""Cold-start benchmark: import time and model loading, sequential against concurrent, Hub paths against a bundle
+
+Every measurement runs in a fresh interpreter, so module imports and CUDA initialization are paid each
+time as on a new worker. The OS page cache stays warm after the first run; drop it between runs (e.g.
+`sync; echo 3 > /proc/sys/vm/drop_caches` as root) to measure a truly cold disk.
+
+    python startup_benchmark.py --repeats 3
+    python startup_benchmark.py --bundle moss_ttsd_bundle
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+MODEL_PATH = "fnlp/MOSS-TTSD-v0.5"
+SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
+SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
+
+
+def child(mode, bundle):
+    """Run one measurement in this process and print its timings as JSON"""
+    start = time.perf_counter()
+    import torch
+    import generation_utils
+    timings = {"import": time.perf_counter() - start,
+               "liger_imported": "liger_kernel" in sys.modules}
+
+    if mode != "import":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if bundle:
+            from model_bundle import resolve_bundle
+            model_paths = dict(resolve_bundle(bundle), local_files_only=True)
+        else:
+            model_paths = {"model_path": MODEL_PATH, "spt_config_path": SPT_CONFIG_PATH, "spt_checkpoint_path": SPT_CHECKPOINT_PATH}
+        load_start = time.perf_counter()
+        generation_utils.load_model(**model_paths, device=device, parallel=(mode == "parallel"))
+        if device == "cuda":
+            torch.cuda.synchronize()
+        timings["load"] = time.perf_counter() - load_start
+    timings["total"] = time.perf_counter() - start
+    print("STARTUP_TIMINGS " + json.dumps(timings))
+
+
+def measure(mode, bundle):
+    command = [sys.executable, os.path.abspath(__file__), "--child", mode]
+    if bundle:
+        command += ["--bundle", bundle]
+    process_start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall = time.perf_counter() - process_start
+    for line in result.stdout.splitlines():
+        if line.startswith("STARTUP_TIMINGS "):
+            timings = json.loads(line[len("STARTUP_TIMINGS "):])
+            timings["process"] = wall  # Includes interpreter startup
+            return timings
+    raise RuntimeError(f"{mode} run failed:\n{result.stderr[-2000:]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cold-start import and model loading time")
+    parser.add_argument("--repeats", type=int, default=3, help="Fresh processes per configuration (default: 3)")
+    parser.add_argument("--bundle", default=None, help="Also measure loading from this model bundle (default: None)")
+    parser.add_argument("--modes", nargs="+", default=["import", "sequential", "parallel"],
+                        choices=["import", "sequential", "parallel"], help="Configurations to measure")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.bundle)
+        return
+
+    configurations = [(mode, None) for mode in args.modes]
+    if args.bundle:
+        configurations += [(mode, args.bundle) for mode in args.modes if mode != "import"]
+
+    print(f"{'configuration':<24} {'import':>8} {'load':>8} {'process':>8}  (median seconds of {args.repeats})")
+    for mode, bundle in configurations:
+        runs = [measure(mode, bundle) for _ in range(args.repeats)]
+        median = {key: statistics.median(run[key] for run in runs) for key in ("import", "process")}
+        load = f"{statistics.median(run['load'] for run in runs):8.2f}" if "load" in runs[0] else f"{'-':>8}"
+        name = f"{mode}{' (bundle)' if bundle else ''}"
+        print(f"{name:<24} {median['import']:8.2f} {load} {median['process']:8.2f}")
+        if runs[0]["liger_imported"]:
+            print(f"  Warning: liger_kernel was imported at startup in {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import re
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+# Patterns and tables of normalize_text, built once at import
+_NUMBERED_TAG = re.compile(r'\[(\d+)\]')
+_NON_SPEAKER_BRACKETS = re.compile(r'\[(?!S\d+\])([^\]]*)\]')
+_SPEAKER_SPLIT = re.compile(r'(?=\[S\d+\])')
+_SPEAKER_TAG = re.compile(r'^(\[S\d+\])\s*(.*)')
+_REMOVE_CHARS = "【】《》（）『』「」" "\"\\-" "～~"
+_DECORATIVE = re.compile(f"[{re.escape(_REMOVE_CHARS)}]")
+_CHINESE_LAUGH = re.compile(r'哈{2,}')
+_ENGLISH_LAUGH = re.compile(r'\b(ha(\s*ha)+)\b', flags=re.IGNORECASE)
+_INTERNAL_PUNCT = str.maketrans({
+    '！': '，', '!': ',',
+    '；': '，', ';': ',',
+    '：': '，', ':': ',',
+    '、': '，',
+    '？': '，', '?': ','
+})
+# The historical final replacement, kept byte for byte: it rewrites the literal text `, "'").replace(`
+_FINAL_REPLACE = (', "\'").replace(', "'")
+
+
+class TextNormalizer:
+    """Multi-speaker script normalization with precompiled patterns and an LRU cache
+
+    Produces exactly the output of generation_utils.normalize_text (see text_normalizer_check.py):
+    1. Don't preserve line breaks.
+    2. Remove brackets for non-speaker tags (if [] doesn't contain S1/S2...Sx format, remove the brackets themselves).
+    3. Remove decorative symbols: 【】《》（）『』「」"-"" .
+    4. Internal punctuation ！；：、 → ，；only allow ？ and ，。
+    5. Multiple 。 keep only the last one, others → ，。
+    6. Replace consecutive "哈" (>=2) with "(笑)".
+    7. Auto-recognize [S1] / [S2] … tags; if missing, treat as whole segment.
+    8. Merge adjacent identical speaker tags.
+
+    Args:
+        cache_size: Number of distinct texts whose result is memoized, e.g. repeated prompt texts
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._cached = functools.lru_cache(maxsize=cache_size)(self._normalize) if cache_size else self._normalize
+
+    def __call__(self, text: str) -> str:
+        return self._cached(text)
+
+    normalize = __call__
+
+    def normalize_batch(self, texts, num_workers=None, chunksize=64, min_parallel=1024):
+        """Normalize many texts, fanning out to a process pool for large corpora
+
+        Args:
+            texts: List of texts
+            num_workers: Worker processes; None or below 2 normalizes in this process with the cache
+            chunksize: Texts sent to a worker at a time
+            min_parallel: Below this many distinct texts the pool is not worth starting
+
+        Returns:
+            list: Normalized texts in input order
+        """
+        unique = list(dict.fromkeys(texts))
+        if not num_workers or num_workers < 2 or len(unique) < min_parallel:
+            return [self(text) for text in texts]
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = dict(zip(unique, pool.map(_normalize_in_worker, unique, chunksize=chunksize)))
+        return [results[text] for text in texts]
+
+    def cache_info(self):
+        return self._cached.cache_info() if self.cache_size else None
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        # Replace [1], [2] etc. format with [S1], [S2] etc. format
+        text = _NUMBERED_TAG.sub(r'[S\1]', text)
+
+        # Remove brackets for non-speaker tags (keep content, only remove brackets themselves)
+        text = _NON_SPEAKER_BRACKETS.sub(r'\1', text)
+
+        # Use positive lookahead to split text by speaker tags (tags themselves are still preserved)
+        segments = _SPEAKER_SPLIT.split(text.replace("\n", " "))
+        processed_parts = []
+
+        for seg in segments:
+            seg = seg.strip()
+            if not seg:
+                continue
+
+            # Extract tags
+            m = _SPEAKER_TAG.match(seg)
+            tag, content = m.groups() if m else ('', seg)
+
+            # Remove irrelevant symbols
+            content = _DECORATIVE.sub("", content)
+
+            # Handle consecutive "哈" characters: replace 2 or more with "(笑)"
+            content = _CHINESE_LAUGH.sub('(笑)', content)
+
+            # Handle English laughter (e.g., "haha", "ha ha")
+            content = _ENGLISH_LAUGH.sub('(laughs)', content)
+
+            # First handle multi-character punctuation marks
+            content = content.replace('——', '，')
+            content = content.replace('……', '，')
+
+            # Handle single-character internal punctuation marks
+            content = content.translate(_INTERNAL_PUNCT)
+            content = content.strip()
+
+            # Keep only the final period
+            if len(content) > 1:
+                last_ch = "。" if content[-1] == "，" else ("." if content[-1] == "," else content[-1])
+                body = content[:-1].replace('。', '，')
+                content = body + last_ch
+
+            processed_parts.append((tag, content))
+
+        if not processed_parts:
+            return ""
+
+        # Merge consecutive same speakers
+        merged_lines = []
+        current_tag, first_content = processed_parts[0]
+        current_content = [first_content]
+
+        for tag, content in processed_parts[1:]:
+            if tag == current_tag and current_tag:
+                current_content.append(content)
+            else:
+                merged_lines.append(f"{current_tag}{''.join(current_content)}".strip())
+                current_tag = tag
+                current_content = [content]
+
+        merged_lines.append(f"{current_tag}{''.join(current_content)}".strip())
+
+        return "".join(merged_lines).replace(*_FINAL_REPLACE)
+
+
+# Shared instance used by generation_utils.normalize_text and the process pool workers
+DEFAULT_NORMALIZER = TextNormalizer()
+
+
+def _normalize_in_worker(text):
+    return DEFAULT_NORMALIZER(text)
@@ -0,0 +1,174 @@
+"""Check that TextNormalizer reproduces the original normalize_text byte for byte, and time both
+
+    python text_normalizer_check.py --jsonl examples/examples.jsonl
+"""
+import re
+import json
+import time
+import random
+import argparse
+
+from text_normalizer import TextNormalizer
+
+
+# Reference implementation: normalize_text as it was before TextNormalizer, kept verbatim
+def reference_normalize_text(text: str) -> str:
+    """
+    Normalize multi-speaker script.
+
+    1. Don't preserve line breaks.
+    2. Remove brackets for non-speaker tags (if [] doesn't contain S1/S2...Sx format, remove the brackets themselves).
+    3. Remove decorative symbols: 【】《》（）『』「」"-"" .
+    4. Internal punctuation ！；：、 → ，；only allow ？ and ，。
+    5. Multiple 。 keep only the last one, others → ，。
+    6. Replace consecutive "哈" (>=2) with "(笑)".
+    7. Auto-recognize [S1] / [S2] … tags; if missing, treat as whole segment.
+    8. Merge adjacent identical speaker tags.
+    """
+    # Replace [1], [2] etc. format with [S1], [S2] etc. format
+    text = re.sub(r'\[(\d+)\]', r'[S\1]', text)
+
+    # Remove decorative characters
+    remove_chars = "【】《》（）『』「」""\"\-""～~"
+
+
+    # Remove brackets for non-speaker tags (keep content, only remove brackets themselves)
+    text = re.sub(r'\[(?!S\d+\])([^\]]*)\]', r'\1', text)
+
+    # Use positive lookahead to split text by speaker tags (tags themselves are still preserved)
+    segments = re.split(r'(?=\[S\d+\])', text.replace("\n", " "))
+    processed_parts = []
+
+    for seg in segments:
+        seg = seg.strip()
+        if not seg:
+            continue
+
+        # Extract tags
+        m = re.match(r'^(\[S\d+\])\s*(.*)', seg)
+        tag, content = m.groups() if m else ('', seg)
+
+        # Remove irrelevant symbols
+        content = re.sub(f"[{re.escape(remove_chars)}]", "", content)
+
+        # Handle consecutive "哈" characters: replace 2 or more with "(笑)"
+        content = re.sub(r'哈{2,}', '(笑)', content)
+
+        # Handle English laughter (e.g., "haha", "ha ha")
+        content = re.sub(r'\b(ha(\s*ha)+)\b', '(laughs)', content, flags=re.IGNORECASE)
+
+        # First handle multi-character punctuation marks
+        content = content.replace('——', '，')
+        content = content.replace('……', '，')
+
+        # Handle single-character internal punctuation marks
+        internal_punct_map = str.maketrans({
+            '！': '，', '!': ',',
+            '；': '，', ';': ',',
+            '：': '，', ':': ',',
+            '、': '，', 
+            '？': '，', '?': ','
+        })
+        content = content.translate(internal_punct_map)
+        content = content.strip()
+
+        # Keep only the final period
+        if len(content) > 1:
+            last_ch = "。" if content[-1] == "，" else ("." if content[-1] == "," else content[-1])
+            body = content[:-1].replace('。', '，')
+            content = body + last_ch
+
+        processed_parts.append({'tag': tag, 'content': content})
+
+    if not processed_parts:
+        return ""
+
+    # Merge consecutive same speakers
+    merged_lines = []
+    current_tag = processed_parts[0]['tag']
+    current_content = [processed_parts[0]['content']]
+
+    for part in processed_parts[1:]:
+        if part['tag'] == current_tag and current_tag:
+            current_content.append(part['content'])
+        else:
+            merged_lines.append(f"{current_tag}{''.join(current_content)}".strip())
+            current_tag = part['tag']
+            current_content = [part['content']]
+
+    merged_lines.append(f"{current_tag}{''.join(current_content)}".strip())
+    
+    return "".join(merged_lines).replace(''', "'").replace(''', "'")
+
+
+SAMPLE_TEXTS = [
+    "[S1]你好！今天天气怎么样？[S2]哈哈哈，还不错；我们去公园吧：好吗、好的。",
+    "[1]Hello! How are you?[2]Haha, ha ha, I'm fine; thanks: really.\n[1]Great……see you——bye。",
+    "【标题】《书名》（注释）『引用』「对话」\"quote\" a-b ～~ [笑] [S3]",
+    "[S1][S1]重复的说话人。。。[S1]还是我。[S2]",
+    "no tags at all, just text... ha",
+    "",
+    "   \n  ",
+    ", \"'\").replace(",
+    "[S1]A[S2]B[S2]C[S1]D",
+]
+
+
+def random_texts(count, seed=0):
+    """Random scripts assembled from the characters the normalizer treats specially"""
+    rng = random.Random(seed)
+    alphabet = list("【】《》（）『』「」\"\\-～~！!；;：:、？?。，,.哈ha H\n[]S12 文字text") + ["[S1]", "[S2]", "[3]", "——", "……", ", \"'\").replace("]
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 80))) for _ in range(count)]
+
+
+def check(texts):
+    normalizer = TextNormalizer()
+    for text in texts:
+        expected = reference_normalize_text(text)
+        assert normalizer(text) == expected, f"mismatch for {text!r}: {normalizer(text)!r} != {expected!r}"
+        assert normalizer(text) == expected, f"cached mismatch for {text!r}"
+    assert normalizer.normalize_batch(texts) == [reference_normalize_text(text) for text in texts], "batch mismatch"
+    print(f"All {len(texts)} texts match the reference implementation")
+
+
+def benchmark(texts, repeats=3):
+    def timed(fn):
+        begin = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - begin) / repeats * 1000
+
+    # Repeated prompt texts, as in a job that reuses a few reference speakers
+    repeated = texts[:500] * 10
+    results = {
+        "reference": timed(lambda: [reference_normalize_text(text) for text in texts]),
+        "TextNormalizer (uncached)": timed(lambda: TextNormalizer(cache_size=0).normalize_batch(texts)),
+        "reference, repeated": timed(lambda: [reference_normalize_text(text) for text in repeated]),
+        "TextNormalizer, repeated": timed(lambda: TextNormalizer().normalize_batch(repeated)),
+    }
+    print(f"Normalizing {len(texts)} texts ({len(repeated)} for the repeated cases):")
+    for name, ms in results.items():
+        print(f"  {name:<28} {ms:10.2f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark TextNormalizer against the original normalize_text")
+    parser.add_argument("--jsonl", default=None, help="Optional JSONL file whose text fields are added to the check")
+    parser.add_argument("--random_texts", type=int, default=5000, help="Number of random texts checked")
+    args = parser.parse_args()
+
+    texts = SAMPLE_TEXTS + random_texts(args.random_texts)
+    if args.jsonl:
+        with open(args.jsonl, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    texts += [value for key, value in item.items() if "text" in key and isinstance(value, str)]
+
+    check(texts)
+    benchmark(texts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""Self-hosted, OpenAI-compatible speech endpoint with dynamic batching
+
+Serves the /v1/audio/speech contract of the hosted MOSS-TTSD API that use_api.py talks to:
+
+    python tts_server.py --port 8000
+    SILICONFLOW_API_BASE=http://127.0.0.1:8000/v1 SILICONFLOW_API_KEY=local python use_api.py
+
+Request body (the OpenAI client merges extra_body into it):
+    model            ignored, one model is served
+    input            dialogue text, e.g. "[S1]...[S2]..."
+    response_format  wav (16-bit, default), flac, opus or pcm (raw 16-bit little-endian mono)
+    references       optional list of {"audio": data URI or base64, "text": transcript}; one merged reference,
+                     or one "[S1]..." and one "[S2]..." reference per speaker
+    voice, speed, max_tokens and other fields are accepted and ignored
+
+Concurrent requests are collected for --batch_wait_seconds and generated together by a
+pipeline.RequestBatcher, so several clients share one model.generate call. Reference audio is decoded on
+the request threads and its codes are cached across requests, so a reused voice is encoded once.
+"""
+import os
+import json
+import time
+import base64
+import binascii
+import argparse
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import torch
+import accelerate
+
+import audio_ingest
+from generation_utils import load_model, process_batch, estimate_item_tokens, prompt_read_seconds
+from pipeline import RequestBatcher
+from code_cache import PromptCodeCache
+from model_bundle import resolve_bundle
+from attention_backend import LOAD_ATTN_IMPLEMENTATION, DEFAULT_CACHE_PATH as DEFAULT_ATTN_CACHE, select_attn_implementation
+from audio_writer import encode_audio
+
+MODEL_PATH = "fnlp/MOSS-TTSD-v0.5"
+SYSTEM_PROMPT = "You are a speech synthesizer that generates natural, realistic, and human-like conversational audio from dialogue text."
+SPT_CONFIG_PATH = "XY_Tokenizer/config/xy_tokenizer_config.yaml"
+SPT_CHECKPOINT_PATH = "XY_Tokenizer/weights/xy_tokenizer.ckpt"
+
+# response_format -> (audio_writer format, Content-Type); pcm is written without a container
+RESPONSE_FORMATS = {
+    "wav": ("pcm16", "audio/wav"),
+    "flac": ("flac", "audio/flac"),
+    "opus": ("opus", "audio/ogg"),
+    "pcm": (None, "audio/pcm"),
+}
+_MIME_EXTENSIONS = {"audio/mp3": ".mp3", "audio/mpeg": ".mp3", "audio/wav": ".wav", "audio/x-wav": ".wav",
+                    "audio/wave": ".wav", "audio/flac": ".flac", "audio/ogg": ".ogg", "audio/opus": ".opus",
+                    "audio/webm": ".webm"}
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class APIError(Exception):
+    """A request failure reported to the client as an OpenAI-style error body"""
+
+    def __init__(self, status, message, error_type="invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+
+def decode_reference_audio(audio, max_seconds=None):
+    """Decode a data URI or bare base64 reference into a (wav, sr) tuple, at most max_seconds of it if set"""
+    if not isinstance(audio, str) or not audio:
+        raise APIError(400, "reference audio must be a data URI or base64 string")
+    mime, payload = "", audio
+    if audio.startswith("data:"):
+        header, _, payload = audio.partition(",")
+        mime = header[len("data:"):].split(";")[0].lower()
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise APIError(400, "reference audio is not valid base64")
+
+    # Decoders need a file with a recognisable extension, e.g. for mp3
+    with tempfile.NamedTemporaryFile(suffix=_MIME_EXTENSIONS.get(mime, ".wav"), delete=False) as f:
+        f.write(data)
+        path = f.name
+    try:
+        return audio_ingest.load_waveform(path, max_seconds=max_seconds)
+    except Exception as e:
+        raise APIError(400, f"unreadable reference audio: {e}")
+    finally:
+        os.remove(path)
+
+
+def build_item(text, references=None, max_reference_seconds=None):
+    """Data item in a process_jsonl_item format from the request text and references
+
+    Args:
+        text: Dialogue text to synthesize
+        references: None, one merged reference, or one reference per speaker tagged [S1] and [S2]
+        max_reference_seconds: Decode at most this much of each reference
+
+    Returns:
+        dict: Item with (wav, sr) tuples in place of prompt audio paths
+    """
+    if not isinstance(text, str) or not text.strip():
+        raise APIError(400, "input must be a non-empty string")
+    references = references or []
+    if not isinstance(references, list) or not all(isinstance(ref, dict) for ref in references):
+        raise APIError(400, "references must be a list of {\"audio\", \"text\"} objects")
+
+    if len(references) == 0:
+        return {"text": text}
+    if len(references) == 1:
+        return {"text": text, "prompt_audio": decode_reference_audio(references[0].get("audio"), max_reference_seconds),
+                "prompt_text": references[0].get("text", "")}
+    if len(references) == 2:
+        item = {"text": text}
+        # Tagged references may come in any order; untagged ones are taken as S1, S2
+        tagged = sorted(references, key=lambda ref: 1 if ref.get("text", "").lstrip().startswith("[S2]") else 0)
+        for speaker, ref in enumerate(tagged, 1):
+            item[f"prompt_audio_speaker{speaker}"] = decode_reference_audio(ref.get("audio"), max_reference_seconds)
+            ref_text = ref.get("text", "").strip()
+            item[f"prompt_text_speaker{speaker}"] = ref_text[len(f"[S{speaker}]"):] if ref_text.startswith(f"[S{speaker}]") else ref_text
+        return item
+    raise APIError(400, f"expected at most 2 references, got {len(references)}")
+
+
+def pcm16_bytes(audio_data):
+    """(1, samples) float waveform as raw 16-bit little-endian PCM"""
+    samples = (audio_data.detach().cpu().float().clamp(-1.0, 1.0)[0] * 32767).round().to(torch.int16)
+    return samples.numpy().astype("<i2").tobytes()
+
+
+class SpeechService:
+    """Generation behind the endpoint: coalesces concurrent requests into process_batch calls
+
+    Args:
+        tokenizer, model, spt, device: As returned by generation_utils.load_model
+        max_batch_size: Maximum number of requests per generation batch
+        max_batch_tokens: Optional padded token budget of one batch
+        batch_wait_seconds: How long the first request of a batch waits for others
+        min_efficiency: Lowest padding efficiency of a batch, see generation_utils.bucket_batches
+        use_normalize: Normalize request texts
+        code_cache: Optional PromptCodeCache shared by all requests
+        prompt_trim: Optional keyword arguments of audio_ingest.trim_prompt for every reference
+    """
+
+    def __init__(self, tokenizer, model, spt, device, max_batch_size=4, max_batch_tokens=None, batch_wait_seconds=0.05,
+                 min_efficiency=0.5, use_normalize=False, code_cache=None, prompt_trim=None):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.spt = spt
+        self.device = device
+        self.use_normalize = use_normalize
+        self.code_cache = code_cache
+        self.prompt_trim = prompt_trim
+        self.reference_read_seconds = prompt_read_seconds(prompt_trim)
+        self.batcher = RequestBatcher(
+            self._run_batch,
+            lambda item: estimate_item_tokens(item, tokenizer, SYSTEM_PROMPT),
+            max_batch_size=max_batch_size,
+            max_batch_tokens=max_batch_tokens,
+            max_wait_seconds=batch_wait_seconds,
+            min_efficiency=min_efficiency
+        )
+
+    def _run_batch(self, indices, items, group):
+        print(f"Generating a batch of {len(items)} requests")
+        return process_batch(
+            batch_items=items,
+            tokenizer=self.tokenizer,
+            model=self.model,
+            spt=self.spt,
+            device=self.device,
+            system_prompt=SYSTEM_PROMPT,
+            start_idx=0,
+            use_normalize=self.use_normalize,
+            code_cache=self.code_cache,
+            prompt_trim=self.prompt_trim,
+            indices=indices
+        )
+
+    def synthesize(self, item, timeout=None):
+        """Generate one item, batched with concurrent requests
+
+        Returns:
+            tuple: ((1, samples) CPU waveform, sample_rate)
+        """
+        try:
+            text_data, audio_result = self.batcher(item, timeout=timeout)
+        except FutureTimeoutError:
+            raise APIError(504, f"no audio within {timeout} seconds", "timeout_error")
+        except Exception as e:
+            raise APIError(500, f"generation failed: {e}", "server_error")
+        if audio_result is None:
+            if text_data.get("error"):
+                raise APIError(400, text_data["error"])
+            raise APIError(500, "generation produced no audio", "server_error")
+        return audio_result["audio_data"], audio_result["sample_rate"]
+
+
+class SpeechRequestHandler(BaseHTTPRequestHandler):
+    """OpenAI-style routes; settings and the SpeechService hang off the server object"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} - {format % args}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, error):
+        self._send_json(error.status, {"error": {"message": str(error), "type": error.error_type, "param": None, "code": None}})
+
+    def _check_auth(self):
+        if self.server.api_key and self.headers.get("Authorization", "") != f"Bearer {self.server.api_key}":
+            raise APIError(401, "invalid API key", "authentication_error")
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": self.server.model_name, "object": "model", "owned_by": "local"}]})
+        else:
+            self._send_error(APIError(404, f"unknown route {path}", "not_found_error"))
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        try:
+            if path != "/v1/audio/speech":
+                raise APIError(404, f"unknown route {path}", "not_found_error")
+            self._check_auth()
+            length = int(self.headers.get("Content-Length", 0))
+            if length > self.server.max_request_bytes:
+                self.close_connection = True  # The unread body would otherwise be parsed as the next request
+                raise APIError(413, f"request body over {self.server.max_request_bytes} bytes")
+            try:
+                request = json.loads(self.rfile.read(length))
+            except ValueError:
+                raise APIError(400, "request body must be JSON")
+            if not isinstance(request, dict):
+                raise APIError(400, "request body must be a JSON object")
+
+            response_format = request.get("response_format") or "wav"
+            if response_format not in RESPONSE_FORMATS:
+                raise APIError(400, f"unsupported response_format {response_format}, expected one of {sorted(RESPONSE_FORMATS)}")
+            audio_format, content_type = RESPONSE_FORMATS[response_format]
+
+            start = time.perf_counter()
+            item = build_item(request.get("input"), request.get("references"), self.server.service.reference_read_seconds)
+            audio_data, sample_rate = self.server.service.synthesize(item, timeout=self.server.request_timeout)
+            body = pcm16_bytes(audio_data) if audio_format is None else encode_audio(audio_data, sample_rate, audio_format)
+            print(f"Generated {audio_data.shape[-1] / sample_rate:.1f}s of audio in {time.perf_counter() - start:.2f}s")
+        except APIError as e:
+            self._send_error(e)
+            return
+        except Exception as e:
+            self._send_error(APIError(500, f"could not encode audio: {e}", "server_error"))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Sample-Rate", str(sample_rate))
+        self.end_headers()
+        for offset in range(0, len(body), STREAM_CHUNK_BYTES):
+            self.wfile.write(body[offset:offset + STREAM_CHUNK_BYTES])
+
+
+def create_server(service, host="127.0.0.1", port=8000, api_key=None, model_name=MODEL_PATH, max_request_bytes=64 * 1024 * 1024,
+                  request_timeout=None):
+    """HTTP server of the endpoint, one thread per connection; call serve_forever() to run it"""
+    server = ThreadingHTTPServer((host, port), SpeechRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.api_key = api_key
+    server.model_name = model_name
+    server.max_request_bytes = max_request_bytes
+    server.request_timeout = request_timeout
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible /v1/audio/speech server with dynamic batching")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000)")
+    parser.add_argument("--api_key", default=os.getenv("MOSS_TTSD_API_KEY"),
+                        help="Require this bearer token; any key is accepted if unset (default: $MOSS_TTSD_API_KEY)")
+    parser.add_argument("--bundle", default=None,
+                        help="Load the LM, tokenizer and codec from an offline bundle made by model_bundle.py (default: None)")
+    parser.add_argument("--dtype", choices=["bf16", "fp16", "fp32"], default="bf16", help="Model data type (default: bf16)")
+    parser.add_argument("--attn_implementation", choices=["auto", "flash_attention_2", "sdpa", "eager"], default="auto",
+                        help="Attention implementation; auto probes the backends once and caches the fastest (default: auto)")
+    parser.add_argument("--attn_cache", default=DEFAULT_ATTN_CACHE,
+                        help=f"Cache file of probed attention implementations per host (default: {DEFAULT_ATTN_CACHE})")
+    parser.add_argument("--max_batch_size", type=int, default=4, help="Maximum requests per generation batch (default: 4)")
+    parser.add_argument("--max_batch_tokens", type=int, default=None,
+                        help="Padded budget of prompt tokens plus predicted output frames per batch (default: None)")
+    parser.add_argument("--batch_wait_seconds", type=float, default=0.05,
+                        help="How long the first request of a batch waits for concurrent ones (default: 0.05)")
+    parser.add_argument("--min_padding_efficiency", type=float, default=0.5,
+                        help="Split a batch before its share of non-padding positions drops below this (default: 0.5)")
+    parser.add_argument("--request_timeout", type=float, default=None,
+                        help="Seconds a request may wait for its audio (default: None, no limit)")
+    parser.add_argument("--use_normalize", action="store_true", default=False,
+                        help="Whether to use text normalization (default: False)")
+    parser.add_argument("--prompt_max_seconds", type=float, default=None,
+                        help="Trim silence from references and cap each to its best-SNR window of this length; "
+                             "only about twice this much of each reference is decoded (default: None)")
+    parser.add_argument("--code_cache_dir", default=None,
+                        help="Directory to persist reference-audio codes across restarts (default: None, in-memory only)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed, set once at startup (default: None)")
+    args = parser.parse_args()
+
+    torch_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}[args.dtype]
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+
+    print("Loading models...")
+    load_start = time.perf_counter()
+    model_paths = resolve_bundle(args.bundle) if args.bundle else \
+        {"model_path": MODEL_PATH, "spt_config_path": SPT_CONFIG_PATH, "spt_checkpoint_path": SPT_CHECKPOINT_PATH}
+    load_attn_implementation = LOAD_ATTN_IMPLEMENTATION if args.attn_implementation == "auto" else args.attn_implementation
+    tokenizer, model, spt = load_model(**model_paths, torch_dtype=torch_dtype, attn_implementation=load_attn_implementation,
+                                       device=device, local_files_only=bool(args.bundle))
+    if args.attn_implementation == "auto":
+        select_attn_implementation(model, cache_path=args.attn_cache)
+    print(f"Models loaded in {time.perf_counter() - load_start:.1f}s")
+
+    if args.seed is not None:
+        accelerate.utils.set_seed(args.seed)
+        print(f"Set random seed to {args.seed}")
+
+    service = SpeechService(
+        tokenizer, model, spt, device,
+        max_batch_size=args.max_batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        batch_wait_seconds=args.batch_wait_seconds,
+        min_efficiency=args.min_padding_efficiency,
+        use_normalize=args.use_normalize,
+        prompt_trim={"max_seconds": args.prompt_max_seconds} if args.prompt_max_seconds else None,
+        # Clients tend to reuse a few voices; their codes are encoded once
+        code_cache=PromptCodeCache(args.code_cache_dir)
+    )
+    server = create_server(service, args.host, args.port, api_key=args.api_key, request_timeout=args.request_timeout)
+    print(f"Serving /v1/audio/speech on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()